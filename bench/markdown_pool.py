@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare rendering with a fresh `markdown.Markdown` per document against a
+`MarkdownPool`.
+
+    $ PYTHONPATH=src python bench/markdown_pool.py [-n DOCUMENTS] [-e EXTENSION ...]
+"""
+
+import optparse
+import os.path
+import time
+
+from markdoc.config import Config
+from markdoc.render import MarkdownPool
+
+
+SMALL_PAGE = u"""\
+# Page %(i)d
+
+A short page with a [link](/other/page%(i)d) and some *emphasis*.
+
+* one
+* two
+"""
+
+
+def run(config, count, pooled):
+    pool = MarkdownPool(config)
+    start = time.time()
+    for i in xrange(count):
+        path = 'dir%d/page%d.md' % (i % 10, i)
+        text = SMALL_PAGE % {'i': i}
+        if pooled:
+            pool.convert(path, text)
+        else:
+            config.markdown(curr_path=path).convert(text)
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--documents', type='int', default=2000)
+    parser.add_option('-e', '--extension', action='append', dest='extensions',
+                      default=None)
+    options, _ = parser.parse_args()
+    
+    extensions = options.extensions
+    if extensions is None:
+        extensions = ['toc', 'footnotes', 'tables', 'def_list', 'abbr']
+    config = Config(os.path.abspath('markdoc.yaml'),
+                    {'markdown': {'extensions': extensions}})
+    
+    fresh = run(config, options.documents, pooled=False)
+    pooled = run(config, options.documents, pooled=True)
+    print 'extensions: %s' % (', '.join(extensions) or '(none)')
+    print 'fresh instance per document: %.3fs (%.3fms/doc)' % (
+        fresh, 1000 * fresh / options.documents)
+    print 'pooled instance:             %.3fs (%.3fms/doc)' % (
+        pooled, 1000 * pooled / options.documents)
+    print 'speedup: %.2fx' % (fresh / pooled)
+
+
+if __name__ == '__main__':
+    main()
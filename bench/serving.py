@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure how fast the WSGI application sends large static files.
+
+    $ PYTHONPATH=src python bench/serving.py [--size MB] [-n DOWNLOADS]
+                                             [-c CHUNK_SIZE] [-o results.json]
+
+A file of the requested size is put in the HTML root of an empty wiki, and
+downloaded repeatedly through a `wsgiref` server running in another thread, in
+each of three ways: read in 4KB chunks (as the server used to), read in chunks
+of `--chunk-size` (the `server.chunk-size` setting), and handed to the server's
+`wsgi.file_wrapper`. The median throughput of each is printed, and optionally
+saved as JSON.
+
+`wsgiref` has no `sendfile()` support on Python 2, so its file wrapper reads
+the file in chunks as well; under a server which does use `sendfile()` (such as
+gunicorn or uWSGI), the file wrapper is faster still.
+"""
+
+import httplib
+import logging
+import optparse
+import os
+import os.path as p
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import markdoc
+from markdoc.cache import parse_size
+from markdoc.config import Config
+from markdoc.wsgi import MarkdocWSGIApplication
+
+
+class QuietHandler(WSGIRequestHandler):
+    
+    def log_message(self, *args):
+        pass
+
+
+def without_file_wrapper(app):
+    def wrapper(environ, start_response):
+        environ.pop('wsgi.file_wrapper', None)
+        return app(environ, start_response)
+    return wrapper
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def download(port, path):
+    """Download a path from the server, returning the number of bytes read."""
+    
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        total = 0
+        data = response.read(256 * 1024)
+        while data:
+            total += len(data)
+            data = response.read(256 * 1024)
+        return total
+    finally:
+        connection.close()
+
+
+def measure(app, path, size, downloads):
+    """Return the median throughput (in MB/s) of downloads from `app`."""
+    
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        rates = []
+        for _ in xrange(downloads):
+            start = time.time()
+            received = download(server.server_port, path)
+            elapsed = time.time() - start
+            if received != size:
+                raise RuntimeError('expected %d bytes, got %d' % (size, received))
+            rates.append(size / elapsed / (1024 * 1024))
+        return median(rates)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=64, metavar='MB',
+                      help="Size of the file to serve (default 64MB)")
+    parser.add_option('-n', '--downloads', type='int', default=5,
+                      help="Times to download it in each mode (default 5)")
+    parser.add_option('-c', '--chunk-size', default='256K',
+                      help="The server.chunk-size to compare (default 256K)")
+    parser.add_option('-o', '--output', default=None, metavar='FILE',
+                      help="Save the results as JSON")
+    options, _ = parser.parse_args()
+    
+    logging.getLogger('markdoc').setLevel(logging.WARN)
+    size = options.size * 1024 * 1024
+    chunk_size = parse_size(options.chunk_size)
+    
+    wiki_root = tempfile.mkdtemp(prefix='markdoc-bench-')
+    try:
+        config = Config(p.join(wiki_root, 'markdoc.yaml'), {})
+        os.makedirs(config.html_dir)
+        fp = open(p.join(config.html_dir, 'large.bin'), 'wb')
+        try:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(options.size):
+                fp.write(block)
+        finally:
+            fp.close()
+        
+        modes = [
+            ('chunked 4K', 4096, False),
+            ('chunked %s' % options.chunk_size, chunk_size, False),
+            ('wsgi.file_wrapper', chunk_size, True),
+        ]
+        results = {}
+        for name, mode_chunk_size, file_wrapper in modes:
+            config['server.chunk-size'] = mode_chunk_size
+            app = MarkdocWSGIApplication(config)
+            if not file_wrapper:
+                app = without_file_wrapper(app)
+            rate = measure(app, '/large.bin', size, options.downloads)
+            results[name] = {'mb_per_second': rate, 'chunk_size': mode_chunk_size}
+            print '%-24s %10.1f MB/s' % (name, rate)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(wiki_root)
+    
+    if options.output:
+        fp = open(options.output, 'w')
+        try:
+            json.dump({'size': size, 'downloads': options.downloads,
+                       'results': results}, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+
+
+if __name__ == '__main__':
+    main()
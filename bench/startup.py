@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure how long the `markdoc` command takes to start up.
+
+    $ PYTHONPATH=src python bench/startup.py [-n RUNS] [--budget MS]
+                                             [-o results.json]
+
+Each of a handful of cheap commands (which do no real work, so their running
+time is almost entirely spent importing modules and parsing arguments) is run
+in a fresh interpreter against a tiny wiki, and the median wall-clock time is
+reported after subtracting that of an interpreter which does nothing at all.
+The exit status is 1 if any command's startup overhead exceeds `--budget`
+milliseconds.
+"""
+
+import optparse
+import os
+import os.path as p
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+COMMANDS = [
+    ['--help'],
+    ['show-config'],
+    ['vcs-ignore', 'git', '-o', '-'],
+]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def child_environ():
+    """Return the environment for commands, with an absolute `PYTHONPATH`."""
+    
+    environ = os.environ.copy()
+    if environ.get('PYTHONPATH'):
+        environ['PYTHONPATH'] = os.pathsep.join(
+            p.abspath(path) for path in environ['PYTHONPATH'].split(os.pathsep))
+    return environ
+
+
+def time_command(argv, cwd, runs):
+    """Return the median time (in milliseconds) taken to run `argv`."""
+    
+    environ = child_environ()
+    devnull = open(os.devnull, 'w')
+    try:
+        timings = []
+        for _ in xrange(runs):
+            start = time.time()
+            status = subprocess.call(argv, cwd=cwd, env=environ,
+                                     stdout=devnull)
+            timings.append(1000 * (time.time() - start))
+            if status != 0:
+                raise RuntimeError('%s exited with status %d' % (
+                    ' '.join(argv), status))
+    finally:
+        devnull.close()
+    return median(timings)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--runs', type='int', default=20,
+                      help="Times to run each command (default 20)")
+    parser.add_option('--budget', type='float', default=150.0, metavar='MS',
+                      help="Allowed startup overhead per command (150ms)")
+    parser.add_option('-o', '--output', default=None, metavar='FILE',
+                      help="Save the results as JSON")
+    options, _ = parser.parse_args()
+    
+    wiki_root = tempfile.mkdtemp(prefix='markdoc-bench-')
+    try:
+        fp = open(p.join(wiki_root, 'markdoc.yaml'), 'w')
+        try:
+            fp.write('wiki-name: Startup Benchmark\n')
+        finally:
+            fp.close()
+        
+        baseline = time_command([sys.executable, '-c', 'pass'], wiki_root,
+                                options.runs)
+        print '%-32s %8.1fms' % ('(bare interpreter)', baseline)
+        
+        results = {}
+        for command in COMMANDS:
+            name = ' '.join(command)
+            elapsed = time_command(
+                [sys.executable, '-m', 'markdoc.cli.main'] + command,
+                wiki_root, options.runs)
+            results[name] = {'ms': elapsed, 'overhead_ms': elapsed - baseline}
+            print '%-32s %8.1fms %+8.1fms' % (name, elapsed, elapsed - baseline)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(wiki_root)
+    
+    if options.output:
+        fp = open(options.output, 'w')
+        try:
+            json.dump({'baseline_ms': baseline, 'budget_ms': options.budget,
+                       'runs': options.runs, 'results': results},
+                      fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+    
+    over = sorted(name for name, result in results.iteritems()
+                  if result['overhead_ms'] > options.budget)
+    if over:
+        print 'Over the %.0fms budget: %s' % (options.budget, ', '.join(over))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
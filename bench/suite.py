@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark Markdoc against a synthetic wiki.
+
+    $ PYTHONPATH=src python bench/suite.py [-n PAGES] [-o results.json]
+                                           [--baseline old.json]
+
+A wiki of the requested size is generated (see `wikigen.py`) in a temporary
+directory, or an existing one is used with `--wiki` (note that its build
+outputs are deleted, and one document is modified). Each benchmark is timed
+by wall clock, and the results are printed and optionally saved as JSON. Given
+a `--baseline` (the JSON from an earlier run), each result is compared with it,
+and the exit status is 1 if any is slower by more than `--tolerance`.
+"""
+
+import logging
+import optparse
+import os
+import os.path as p
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, p.dirname(p.abspath(__file__)))
+
+import markdoc
+from markdoc.builder import Builder
+from markdoc.cli import commands
+from markdoc.config import Config
+from markdoc.listing import LISTING_STATE_FILENAME
+from wikigen import generate_wiki
+
+
+class Suite(object):
+    
+    def __init__(self, wiki_root, sample=1000, requests=1000, jobs=1):
+        self.wiki_root = wiki_root
+        self.sample = sample
+        self.requests = requests
+        self.jobs = jobs
+        self.results = {}
+    
+    def config(self, **settings):
+        config = Config.for_directory(self.wiki_root)
+        config['build-jobs'] = self.jobs
+        config.update(settings)
+        return config
+    
+    def time(self, name, function, count=1):
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        self.results[name] = {'seconds': seconds, 'count': count,
+                              'per_item': seconds / max(count, 1)}
+        print '%-24s %10.3fs %8d items %10.3fms/item' % (
+            name, seconds, count, 1000 * seconds / max(count, 1))
+        sys.stdout.flush()
+    
+    def clean(self):
+        config = self.config()
+        for directory in (config.html_dir, config.temp_dir, config.cache_dir):
+            if p.islink(directory):
+                os.remove(directory)
+            elif p.isdir(directory):
+                shutil.rmtree(directory)
+    
+    def run(self):
+        self.clean()
+        config = self.config()
+        documents = list(Builder(config).walk())
+        rnd = random.Random(0)
+        sample = rnd.sample(documents, min(self.sample, len(documents)))
+        
+        self.time('walk', lambda: list(Builder(self.config()).walk()),
+                  len(documents))
+        
+        def render():
+            builder = Builder(self.config(**{'cache.enabled': False}))
+            for path in sample:
+                builder.render_cache.render(path)
+        self.time('render', render, len(sample))
+        
+        build_args = commands.build.parser.parse_args([])
+        self.time('build (cold)', lambda: commands.build(self.config(), build_args),
+                  len(documents))
+        self.time('build (no-op)', lambda: commands.build(self.config(), build_args),
+                  len(documents))
+        
+        fp = open(p.join(config.wiki_dir, sample[0]), 'a')
+        try:
+            fp.write('\nOne more line.\n')
+        finally:
+            fp.close()
+        self.time('build (one change)',
+                  lambda: commands.build(self.config(), build_args), 1)
+        
+        def build_listing():
+            os.remove(p.join(config.temp_dir, LISTING_STATE_FILENAME))
+            commands.build_listing(self.config(), None)
+        directories = sum(1 for _ in os.walk(config.html_dir))
+        self.time('build_listing', build_listing, directories)
+        
+        self.time_wsgi(sample)
+    
+    def time_wsgi(self, sample):
+        import webob
+        from markdoc.wsgi import MarkdocWSGIApplication
+        
+        app = MarkdocWSGIApplication(self.config())
+        rnd = random.Random(1)
+        paths = []
+        for _ in xrange(self.requests):
+            document = p.splitext(rnd.choice(sample))[0]
+            paths.append('/' + '/'.join(document.split(p.sep)))
+            if rnd.random() < 0.2:
+                # Some requests for directory listings.
+                paths[-1] = paths[-1].rsplit('/', 1)[0] + '/'
+        
+        def requests():
+            for path in paths:
+                response = webob.Request.blank(path).get_response(app)
+                response.body
+        self.time('wsgi', requests, len(paths))
+    
+    def to_dict(self, pages):
+        return {'meta': {'markdoc': markdoc.__version__,
+                         'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'pages': pages,
+                         'jobs': self.jobs},
+                'results': self.results}
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison with a baseline; return the names which regressed."""
+    
+    regressions = []
+    print
+    print '%-24s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'ratio')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['per_item']
+        new = results[name]['per_item']
+        ratio = old and new / old or 0
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = ' SLOWER'
+        elif ratio and ratio < 1 - tolerance:
+            flag = ' faster'
+        print '%-24s %9.3fms %9.3fms %7.2fx%s' % (name, 1000 * old, 1000 * new,
+                                                  ratio, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--pages', type='int', default=1000,
+                      help="Size of the generated wiki (default 1000)")
+    parser.add_option('--wiki', default=None, metavar='DIR',
+                      help="Use an existing wiki instead of generating one")
+    parser.add_option('-j', '--jobs', type='int', default=1)
+    parser.add_option('--sample', type='int', default=1000,
+                      help="Documents to render in the render benchmark")
+    parser.add_option('--requests', type='int', default=1000,
+                      help="Requests to make in the WSGI benchmark")
+    parser.add_option('-o', '--output', default=None, metavar='FILE',
+                      help="Save the results as JSON")
+    parser.add_option('--baseline', default=None, metavar='FILE',
+                      help="Compare with the results of an earlier run")
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help="Allowed slowdown relative to the baseline (0.25)")
+    options, _ = parser.parse_args()
+    
+    logging.getLogger('markdoc').setLevel(logging.WARN)
+    
+    temp_dir = None
+    wiki_root = options.wiki
+    if wiki_root is None:
+        temp_dir = tempfile.mkdtemp(prefix='markdoc-bench-')
+        wiki_root = p.join(temp_dir, 'wiki')
+        start = time.time()
+        generate_wiki(wiki_root, pages=options.pages)
+        print 'Generated %d pages in %.1fs' % (options.pages, time.time() - start)
+    
+    try:
+        suite = Suite(wiki_root, sample=options.sample,
+                      requests=options.requests, jobs=options.jobs)
+        suite.run()
+        pages = len(list(Builder(suite.config()).walk()))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    
+    data = suite.to_dict(pages)
+    if options.output:
+        fp = open(options.output, 'w')
+        try:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+    
+    if options.baseline:
+        fp = open(options.baseline)
+        try:
+            baseline = json.load(fp)
+        finally:
+            fp.close()
+        if compare(data['results'], baseline['results'], options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generate a synthetic Markdoc wiki for benchmarking.
+
+    $ python bench/wikigen.py DESTINATION [-n PAGES] [--seed N] [--max-depth N]
+
+Pages are spread over a directory tree of varying depth, and contain headings,
+paragraphs, lists, links to other pages and (some of them) code blocks and
+tables. The same arguments always produce the same wiki.
+"""
+
+import optparse
+import os
+import os.path as p
+import random
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad '
+         'minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+         'ex ea commodo consequat duis aute irure in reprehenderit voluptate '
+         'velit esse cillum eu fugiat nulla pariatur excepteur sint occaecat '
+         'cupidatat non proident sunt culpa qui officia deserunt mollit anim '
+         'id est laborum').split()
+
+CONFIG = """\
+wiki-name: Synthetic Wiki (%(pages)d pages)
+
+markdown:
+  extensions: [tables, def_list]
+"""
+
+CODE_BLOCK = """\
+    def function_%(i)d(argument):
+        \"\"\"%(sentence)s\"\"\"
+        for item in range(argument):
+            yield item * %(i)d
+"""
+
+
+def sentence(rnd, words=12):
+    chosen = [rnd.choice(WORDS) for _ in xrange(rnd.randint(words // 2, words))]
+    return ' '.join(chosen).capitalize() + '.'
+
+
+def paragraph(rnd, sentences=5):
+    return ' '.join(sentence(rnd) for _ in xrange(rnd.randint(1, sentences)))
+
+
+def table(rnd, rows=6):
+    lines = ['| Name | Value | Description |',
+             '| ---- | ----- | ----------- |']
+    for i in xrange(rnd.randint(2, rows)):
+        lines.append('| %s | %d | %s |' % (rnd.choice(WORDS), rnd.randint(0, 1000),
+                                            sentence(rnd, 6)))
+    return '\n'.join(lines)
+
+
+def page_paths(pages, rnd, max_depth=4, fanout=8, per_directory=40):
+    
+    """
+    Return a list of `pages` relative document paths.
+    
+    Directories hold about `per_directory` pages each, and are nested to
+    varying depths of up to `max_depth`.
+    """
+    
+    directories = ['']
+    paths = []
+    while len(paths) < pages:
+        directory = rnd.choice(directories)
+        count = min(pages - len(paths), rnd.randint(1, per_directory))
+        for i in xrange(count):
+            paths.append(p.join(directory, 'page-%d.md' % len(paths)))
+        
+        depth = directory and directory.count(p.sep) + 1 or 0
+        if depth < max_depth:
+            for i in xrange(rnd.randint(1, fanout)):
+                directories.append(p.join(directory, 'section-%d' % len(directories)))
+    return paths
+
+
+def page(rnd, index, path, paths, code=0.3, tables=0.2):
+    """Return the Markdown text of a single page."""
+    
+    parts = ['# %s %d' % (sentence(rnd, 4).rstrip('.'), index), paragraph(rnd)]
+    for section in xrange(rnd.randint(1, 4)):
+        parts.append('## %s' % sentence(rnd, 5).rstrip('.'))
+        parts.append(paragraph(rnd))
+        
+        links = ['*   [%s](/%s)' % (rnd.choice(WORDS), p.splitext(target)[0])
+                 for target in rnd.sample(paths, min(len(paths), 3))]
+        parts.append('\n'.join(links))
+        
+        if rnd.random() < code:
+            parts.append(CODE_BLOCK % {'i': index, 'sentence': sentence(rnd)})
+        if rnd.random() < tables:
+            parts.append(table(rnd))
+    return '\n\n'.join(parts) + '\n'
+
+
+def generate_wiki(destination, pages=1000, seed=0, max_depth=4, code=0.3,
+                  tables=0.2):
+    
+    """
+    Generate a wiki with the given number of pages in `destination`.
+    
+    Returns the list of document paths (relative to the wiki directory).
+    """
+    
+    rnd = random.Random(seed)
+    paths = page_paths(pages, rnd, max_depth=max_depth)
+    
+    wiki_dir = p.join(destination, 'wiki')
+    for directory in (destination, wiki_dir, p.join(destination, 'static')):
+        if not p.isdir(directory):
+            os.makedirs(directory)
+    
+    fp = open(p.join(destination, 'markdoc.yaml'), 'w')
+    try:
+        fp.write(CONFIG % {'pages': pages})
+    finally:
+        fp.close()
+    
+    for index, path in enumerate(paths):
+        filename = p.join(wiki_dir, path)
+        if not p.isdir(p.dirname(filename)):
+            os.makedirs(p.dirname(filename))
+        fp = open(filename, 'w')
+        try:
+            fp.write(page(rnd, index, path, paths, code=code, tables=tables))
+        finally:
+            fp.close()
+    return paths
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] DESTINATION')
+    parser.add_option('-n', '--pages', type='int', default=1000,
+                      help="Number of pages to generate (default 1000)")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--max-depth', type='int', default=4)
+    parser.add_option('--code', type='float', default=0.3,
+                      help="Probability of a code block in each section")
+    parser.add_option('--tables', type='float', default=0.2,
+                      help="Probability of a table in each section")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a destination directory is required')
+    if p.exists(args[0]) and os.listdir(args[0]):
+        parser.error("destination isn't empty")
+    
+    paths = generate_wiki(args[0], pages=options.pages, seed=options.seed,
+                          max_depth=options.max_depth, code=options.code,
+                          tables=options.tables)
+    print 'Generated %d pages in %s' % (len(paths), args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -72,4 +72,5 @@ setup(
     package_data     = {'markdoc': find_package_data()},
     entry_points     = {'console_scripts': ['markdoc = markdoc.cli.main:main']},
     install_requires = get_requirements(),
+    extras_require   = {'scandir': ['scandir']},
 )
@@ -44,9 +44,9 @@ logging.getLogger('markdoc').addHandler(console_handler)
 logging.getLogger('markdoc').setLevel(logging.INFO) # Default level.
 
 # These modules all initialize various default config values, so need to be
-# imported straight away.
-import markdoc.builder
+# imported straight away. The ones which depend on Markdown and Jinja2
+# (`markdoc.builder`, `markdoc.render` and `markdoc.templates`) are slow to
+# import, so they're left to the modules and commands which actually use them.
+import markdoc.assets
 import markdoc.directories
-import markdoc.render
 import markdoc.server
-import markdoc.templates
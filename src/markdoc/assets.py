@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-hashed ('fingerprinted') names for static media.
+
+With the `assets.fingerprint` setting on, every static file with one of the
+`assets.extensions` is published in the HTML root under a second name which
+includes a digest of its contents, so that `media/css/style.css` also appears
+as `media/css/style.3f2a9c1b.css`. Templates link to these with the
+`static_url()` function. Since a fingerprinted name always refers to the same
+content, browsers may cache it indefinitely (see the `server.cache-policies`
+setting); when the file changes, so does its name, and so do the pages which
+link to it. The original names are kept, so existing links continue to work.
+It's off by default, since it changes the links in every page.
+
+The mapping from original to fingerprinted names is written to `_assets.json`
+in the HTML root, for the benefit of the server and any other tools.
+"""
+
+import hashlib
+import logging
+import os
+import os.path as p
+import shutil
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from markdoc.cache import write_to
+from markdoc.config import Config
+from markdoc.directories import static_sources
+from markdoc.manifest import file_digest
+from markdoc.sync import merge_trees
+
+
+Config.register_default('assets.fingerprint', False)
+Config.register_default('assets.digest-length', 8)
+Config.register_default('assets.extensions', [
+    '.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.ico', '.woff',
+    '.woff2', '.ttf', '.eot'])
+
+ASSETS_FILENAME = '_assets.json'
+ASSET_STATE_FILENAME = 'assets.json'
+
+
+def fingerprint_name(rel_path, digest):
+    
+    """
+    Insert a digest into a filename, just before its extension.
+        
+        >>> fingerprint_name('media/css/style.css', '3f2a9c1b')
+        'media/css/style.3f2a9c1b.css'
+        >>> fingerprint_name('LICENSE', '3f2a9c1b')
+        'LICENSE.3f2a9c1b'
+    """
+    
+    root, extension = p.splitext(rel_path)
+    return '%s.%s%s' % (root, digest, extension)
+
+
+def url_path(rel_path):
+    """Convert a relative filesystem path into an absolute URL path."""
+    
+    return '/' + '/'.join(rel_path.split(p.sep))
+
+
+class AssetMap(object):
+    
+    """
+    The fingerprinted names of a wiki's static media.
+    
+    `names` maps the relative path of each static file (as it will appear in
+    the HTML root) to its fingerprinted path. Digests are remembered in the
+    cache directory along with each file's size and modification time, so a
+    `scan()` only reads files which are new or have changed.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.enabled = config['assets.fingerprint']
+        self.extensions = frozenset(config['assets.extensions'])
+        self.digest_length = int(config['assets.digest-length'])
+        self.state_filename = p.join(config.cache_dir, ASSET_STATE_FILENAME)
+        self.names = {}
+        self.fingerprinted = frozenset()
+        if self.enabled:
+            self.scan()
+    
+    def scan(self):
+        """Find the static media and their digests, replacing any found before."""
+        
+        state = load_json(self.state_filename)
+        new_state, names = {}, {}
+        
+        _, files = merge_trees(static_sources(self.config),
+                               cvs_exclude=self.config['cvs-exclude'])
+        for rel_path, filename in files.iteritems():
+            if p.splitext(rel_path)[1] not in self.extensions:
+                continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            
+            key = [stat.st_size, stat.st_mtime]
+            cached = state.get(filename)
+            if cached and cached[:2] == key:
+                digest = cached[2]
+            else:
+                digest = file_digest(filename)
+            new_state[filename] = key + [digest]
+            names[rel_path] = fingerprint_name(rel_path, digest[:self.digest_length])
+        
+        self.names = names
+        self.fingerprinted = frozenset(names.itervalues())
+        if new_state != state:
+            self.save_state(new_state)
+    
+    def save_state(self, state):
+        directory = p.dirname(self.state_filename)
+        try:
+            if not p.isdir(directory):
+                os.makedirs(directory)
+            write_to(self.state_filename, json.dumps(state, sort_keys=True),
+                     encoding=None)
+        except (IOError, OSError), exc:
+            # Only a cache; the digests will just be recomputed next time.
+            logging.getLogger('markdoc.assets').warning(
+                'Could not save asset digests: %s' % exc)
+    
+    def url(self, path):
+        
+        """
+        Return the URL path of the fingerprinted copy of a static file.
+        
+        `path` is the file's absolute URL path (like `/media/css/style.css`).
+        Paths which have no fingerprinted copy are returned unchanged.
+        """
+        
+        name = self.names.get(p.sep.join(path.lstrip('/').split('/')))
+        if name is None:
+            return path
+        return url_path(name)
+    
+    def digest(self):
+        """Return a digest of the whole mapping, for the build signature."""
+        
+        digest = hashlib.sha1()
+        for rel_path, name in sorted(self.names.iteritems()):
+            digest.update('%s %s\n' % (rel_path, name))
+        return digest.hexdigest()
+    
+    def publish(self, root, log=None):
+        
+        """
+        Create the fingerprinted copies of the static media in `root`.
+        
+        The static media must already have been synced into `root`. Copies are
+        real copies, never links, since they're served as immutable: a link
+        would change along with its original. A copy which is already there is
+        left alone, since its name includes a digest of its contents, unless
+        it's a link to its original (as made by earlier versions). Copies
+        listed in the previous `_assets.json` which are no longer current are
+        removed, and a new `_assets.json` is written (or, if there are none,
+        such as when fingerprinting is off, the old one is removed). Returns
+        the relative paths of the files created or removed.
+        """
+        
+        log = log or logging.getLogger('markdoc.assets')
+        manifest_filename = p.join(root, ASSETS_FILENAME)
+        previous = load_json(manifest_filename)
+        changed = []
+        
+        for rel_path, name in sorted(self.names.iteritems()):
+            original = p.join(root, rel_path)
+            copy = p.join(root, name)
+            if not p.isfile(original):
+                continue
+            if p.exists(copy) and not same_file(original, copy):
+                continue
+            
+            log.debug('fingerprint %s -> %s' % (rel_path, p.basename(name)))
+            temp = p.join(p.dirname(copy), '.' + p.basename(copy) + '.new')
+            shutil.copy2(original, temp)
+            os.rename(temp, copy)
+            changed.append(name)
+        
+        current = set(url_path(name) for name in self.names.itervalues())
+        for url in set(previous.itervalues()) - current:
+            name = p.sep.join(url.lstrip('/').split('/'))
+            if p.lexists(p.join(root, name)):
+                log.debug('rm %s' % name)
+                os.remove(p.join(root, name))
+                changed.append(name)
+        
+        assets = dict((url_path(rel_path), url_path(name))
+                      for rel_path, name in self.names.iteritems())
+        if not assets:
+            if p.exists(manifest_filename):
+                log.debug('rm %s' % ASSETS_FILENAME)
+                os.remove(manifest_filename)
+        elif assets != previous:
+            write_to(manifest_filename,
+                     json.dumps(assets, indent=2, sort_keys=True,
+                                separators=(',', ': ')),
+                     encoding=None)
+        return changed
+
+
+def same_file(filename1, filename2):
+    """Check whether two filenames are links to the same file."""
+    
+    return p.samestat(os.stat(filename1), os.stat(filename2))
+
+
+def load_json(filename):
+    """Load a JSON mapping, returning an empty one if it's absent or invalid."""
+    
+    try:
+        fp = open(filename)
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(fp)
+        except ValueError:
+            return {}
+    finally:
+        fp.close()
+
+
+def asset_map(config):
+    if getattr(config, '_asset_map', None) is None:
+        config._asset_map = AssetMap(config)
+    return config._asset_map
+
+Config.assets = property(asset_map)
+
+
+def static_url(config, path):
+    """Return the URL path to use for a static file (see `AssetMap.url()`)."""
+    
+    assets = config.assets
+    if not assets.enabled:
+        return path
+    return assets.url(path)
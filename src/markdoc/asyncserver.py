@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+"""
+A single-threaded, non-blocking HTTP/1.1 server for WSGI applications.
+
+The CherryPy server gives each connection a thread of its own for as long as
+it's open, so a handful of slow clients (or idle keep-alive connections) can
+tie up every thread, and further connections queue up and are then dropped.
+This server instead handles every connection from one event loop (built on
+`asyncore` and `asynchat`, so no extra dependencies are required), using
+`poll()` where it's available so that it isn't limited to the 1024 file
+descriptors `select()` can watch.
+
+Responses are sent as the client is ready for them: a response body is only
+read from its iterator (and hence from disk, for files which aren't in the
+response cache) one chunk at a time, whenever the socket can take more, so a
+slow download never holds more than a chunk in memory or keeps any other
+connection waiting.
+
+Connections are kept alive between requests (and pipelined requests are
+answered in order) unless the client asks otherwise, and are closed once they
+have been idle for `server.timeout` seconds.
+"""
+
+import asynchat
+import asyncore
+import errno
+import itertools
+import logging
+import select
+import socket
+import sys
+import time
+import urllib
+from email.utils import formatdate
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import markdoc
+
+
+# The most header data (in bytes) a request may send.
+MAX_HEADER_SIZE = 64 * 1024
+# Responses are sent in pieces of up to this many bytes.
+SEND_BUFFER_SIZE = 256 * 1024
+# Responses without a body.
+NO_BODY_STATUSES = (204, 304)
+
+
+class BadRequest(Exception):
+    """Raised when a request can't be parsed."""
+    pass
+
+
+def parse_request(head):
+    
+    """
+    Parse the head of an HTTP request.
+    
+    Returns `(method, target, version, headers)`, where `headers` is a list of
+    `(name, value)` pairs with upper-case names.
+        
+        >>> parse_request('GET /a?b HTTP/1.1\\r\\nHost: x\\r\\nX-Y:  z\\r\\n w')
+        ('GET', '/a?b', 'HTTP/1.1', [('HOST', 'x'), ('X-Y', 'z w')])
+        >>> parse_request('GET /')
+        ('GET', '/', 'HTTP/0.9', [])
+        >>> parse_request('nonsense')
+        Traceback (most recent call last):
+        ...
+        BadRequest: invalid request line: 'nonsense'
+    """
+    
+    lines = head.split('\r\n')
+    request_line = lines[0].split()
+    if len(request_line) == 2:
+        request_line.append('HTTP/0.9')
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+        raise BadRequest('invalid request line: %r' % lines[0])
+    method, target, version = request_line
+    
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (' ', '\t') and headers:
+            # A continuation of the previous header.
+            name, value = headers[-1]
+            headers[-1] = (name, (value + ' ' + line.strip()).strip())
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            headers.append((name.strip().upper(), value.strip()))
+        elif line:
+            raise BadRequest('invalid header line: %r' % line)
+    return method, target, version, headers
+
+
+class ResponseProducer(object):
+    
+    """
+    An `asynchat` producer which reads a WSGI response body as it's sent.
+    
+    Only one chunk is taken from the body's iterator each time the channel
+    needs more data. If `chunked` is true, the body is sent with the chunked
+    transfer-coding.
+    """
+    
+    def __init__(self, body, chunked=False, iterator=None):
+        self.body = body
+        self.iterator = iterator or iter(body)
+        self.chunked = chunked
+        self.finished = False
+    
+    def more(self):
+        if self.finished:
+            return ''
+        for data in self.iterator:
+            if data:
+                if self.chunked:
+                    return '%x\r\n%s\r\n' % (len(data), data)
+                return data
+        self.close()
+        if self.chunked:
+            return '0\r\n\r\n'
+        return ''
+    
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            if hasattr(self.body, 'close'):
+                self.body.close()
+
+
+class HTTPChannel(asynchat.async_chat):
+    
+    """A single client connection to an `AsyncWSGIServer`."""
+    
+    ac_out_buffer_size = SEND_BUFFER_SIZE
+    
+    def __init__(self, server, sock, client_address):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.client_address = client_address
+        self.last_activity = time.time()
+        self.incoming = []
+        self.incoming_size = 0
+        self.request = None
+        self.producers = []
+        # Set once an error has been sent; anything more is ignored.
+        self.discarding = False
+        self.set_terminator('\r\n\r\n')
+    
+    def readable(self):
+        # Don't read any more requests until the earlier ones are answered,
+        # so a client can't make the server buffer an endless pipeline.
+        return not self.producer_fifo
+    
+    def handle_read(self):
+        self.last_activity = time.time()
+        asynchat.async_chat.handle_read(self)
+    
+    def initiate_send(self):
+        self.last_activity = time.time()
+        asynchat.async_chat.initiate_send(self)
+    
+    def collect_incoming_data(self, data):
+        if self.discarding:
+            return
+        self.incoming.append(data)
+        self.incoming_size += len(data)
+        if self.request is None and self.incoming_size > MAX_HEADER_SIZE:
+            self.incoming = []
+            self.error_response(431, 'Request Header Fields Too Large')
+    
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        self.incoming = []
+        self.incoming_size = 0
+        
+        if self.request is None:
+            if not data.strip():
+                # Blank lines between requests are allowed (RFC 7230, §3.5).
+                return
+            try:
+                self.request = parse_request(data.lstrip('\r\n'))
+            except BadRequest, exc:
+                self.server.log.debug('%s: %s' % (self.client_address[0], exc))
+                return self.error_response(400, 'Bad Request')
+            
+            headers = dict(self.request[3])
+            if 'TRANSFER-ENCODING' in headers:
+                return self.error_response(411, 'Length Required')
+            try:
+                length = int(headers.get('CONTENT-LENGTH', 0))
+            except ValueError:
+                return self.error_response(400, 'Bad Request')
+            if length > 0:
+                # Collect the request body before handling the request.
+                self.set_terminator(length)
+                return
+            body = ''
+        else:
+            body = data
+        
+        request, self.request = self.request, None
+        self.set_terminator('\r\n\r\n')
+        self.handle_request(request, body)
+    
+    def handle_request(self, request, body):
+        method, target, version, headers = request
+        header_dict = dict(headers)
+        
+        connection = header_dict.get('CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        
+        environ = self.server.environ(self.client_address, method, target,
+                                      version, headers, body)
+        status_and_headers = []
+        written = []
+        
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and status_and_headers:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            status_and_headers[:] = [(status, response_headers)]
+            return written.append
+        
+        iterator = None
+        try:
+            result = self.server.app(environ, start_response)
+            if not status_and_headers:
+                # The application may not start the response until the first
+                # piece of the body is asked for.
+                iterator = iter(result)
+                iterator = itertools.chain([next(iterator, '')], iterator)
+            if written:
+                # The application used the deprecated `write()` callable.
+                iterator = itertools.chain(written, iterator or result)
+        except Exception:
+            self.server.log.exception('Error handling %s %s' % (method, target))
+            return self.error_response(500, 'Internal Server Error')
+        
+        status, response_headers = status_and_headers[0]
+        header_names = set(name.lower() for name, value in response_headers)
+        
+        chunked = False
+        if method == 'HEAD' or int(status[:3]) in NO_BODY_STATUSES:
+            if hasattr(result, 'close'):
+                result.close()
+            result, iterator = [], None
+        elif 'content-length' not in header_names:
+            if version == 'HTTP/1.1':
+                chunked = True
+                response_headers = response_headers + [
+                    ('Transfer-Encoding', 'chunked')]
+            else:
+                # The only way to mark the end of the body.
+                keep_alive = False
+        
+        response_headers = list(response_headers)
+        if 'date' not in header_names:
+            response_headers.append(('Date', formatdate(usegmt=True)))
+        if 'server' not in header_names:
+            response_headers.append(('Server', self.server.software))
+        if not keep_alive:
+            response_headers.append(('Connection', 'close'))
+        elif version != 'HTTP/1.1':
+            response_headers.append(('Connection', 'keep-alive'))
+        
+        head = ['HTTP/1.1 %s\r\n' % status]
+        head.extend('%s: %s\r\n' % header for header in response_headers)
+        head.append('\r\n')
+        self.push(''.join(head))
+        
+        producer = ResponseProducer(result, chunked=chunked, iterator=iterator)
+        self.producers = [earlier for earlier in self.producers
+                          if not earlier.finished] + [producer]
+        self.push_with_producer(producer)
+        if not keep_alive:
+            self.close_when_done()
+    
+    def error_response(self, code, reason):
+        """Send a plain-text error, and close the connection."""
+        
+        body = '%d %s\n' % (code, reason)
+        self.discarding = True
+        self.incoming = []
+        self.request = None
+        self.set_terminator(None)
+        self.push('HTTP/1.1 %d %s\r\n'
+                  'Content-Type: text/plain\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: close\r\n\r\n%s' % (code, reason, len(body), body))
+        self.close_when_done()
+    
+    def handle_error(self):
+        exc_type, exc_value = sys.exc_info()[:2]
+        if issubclass(exc_type, socket.error):
+            # The client went away; there's nothing to be done about it.
+            self.server.log.debug('%s: %s' % (self.client_address[0], exc_value))
+        else:
+            self.server.log.exception('Error on connection from %s' %
+                                      self.client_address[0])
+        self.close()
+    
+    def close(self):
+        for producer in self.producers:
+            producer.close()
+        self.producers = []
+        asynchat.async_chat.close(self)
+
+
+class AsyncWSGIServer(asyncore.dispatcher):
+    
+    """
+    Serve a WSGI application from a single-threaded event loop.
+    
+    The constructor and the `start()` and `stop()` methods mirror those of
+    `cherrypy.wsgiserver.CherryPyWSGIServer`, so the two are interchangeable;
+    see `markdoc.server.server_maker()`.
+    """
+    
+    def __init__(self, bind_addr, wsgi_app, server_name=None,
+                 request_queue_size=5, timeout=10):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.app = wsgi_app
+        self.timeout = timeout
+        self.running = False
+        self.paused_until = 0
+        self.software = 'Markdoc/%s' % markdoc.__version__
+        self.log = logging.getLogger('markdoc.asyncserver')
+        
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(bind_addr)
+        # Accepting a connection costs next to nothing here, so there's no
+        # sense in turning clients away because a short backlog is full.
+        self.listen(max(request_queue_size, socket.SOMAXCONN))
+        # The port may have been chosen by the OS.
+        self.bind_addr = self.socket.getsockname()[:2]
+        self.server_name = server_name or socket.getfqdn(self.bind_addr[0])
+    
+    def readable(self):
+        return time.time() >= self.paused_until
+    
+    def handle_accept(self):
+        # Take every waiting connection at once, so that a burst of them
+        # doesn't overflow the (often small) listen backlog.
+        while True:
+            pair = self.accept()
+            if pair is None:
+                break
+            sock, client_address = pair
+            HTTPChannel(self, sock, client_address)
+    
+    def handle_error(self):
+        exc_type, exc_value = sys.exc_info()[:2]
+        if issubclass(exc_type, socket.error) and exc_value.args and \
+                exc_value.args[0] in (errno.EMFILE, errno.ENFILE):
+            # Out of file descriptors; leave new connections waiting in the
+            # backlog for a while, rather than trying (and failing) to accept
+            # them over and over again.
+            self.log.warning('Too many open connections: %s' % exc_value)
+            self.paused_until = time.time() + 1
+        else:
+            self.log.exception('Error accepting a connection')
+    
+    def environ(self, client_address, method, target, version, headers, body):
+        """Build the WSGI environment for a request."""
+        
+        path, _, query = target.partition('?')
+        if path.startswith('http://') or path.startswith('https://'):
+            # An absolute URI; only the path is of interest.
+            path = '/' + path.split('/', 3)[-1] if path.count('/') > 2 else '/'
+        
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.bind_addr[1]),
+            'SERVER_PROTOCOL': version,
+            'SERVER_SOFTWARE': self.software,
+            'REMOTE_ADDR': client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            if name == 'CONTENT-TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT-LENGTH':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.replace('-', '_')
+                if key in environ:
+                    environ[key] += ',' + value
+                else:
+                    environ[key] = value
+        return environ
+    
+    def start(self):
+        """Serve requests until `stop()` is called (or an exception is raised)."""
+        
+        self.running = True
+        use_poll = hasattr(select, 'poll')
+        try:
+            while self.running:
+                asyncore.loop(timeout=min(self.timeout, 1), use_poll=use_poll,
+                              map=self.socket_map, count=1)
+                self.close_idle()
+        finally:
+            self.running = False
+            for dispatcher in self.socket_map.values():
+                dispatcher.close()
+    
+    def stop(self):
+        """Stop serving; `start()` returns within a second or so."""
+        
+        self.running = False
+    
+    def close_idle(self):
+        """Close connections which have been inactive for `timeout` seconds."""
+        
+        cutoff = time.time() - self.timeout
+        for dispatcher in self.socket_map.values():
+            if isinstance(dispatcher, HTTPChannel) and \
+                    dispatcher.last_activity < cutoff:
+                dispatcher.close()
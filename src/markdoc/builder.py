@@ -5,12 +5,42 @@ import os.path as p
 import operator
 import re
 
-from markdoc.cache import DocumentCache, RenderCache, read_from
+import markdoc.exc
+from markdoc.cache import (DiskCache, DocumentCache, RenderCache, parse_size,
+    read_from)
+from markdoc.compress import variant_base
 from markdoc.config import Config
-from markdoc.render import make_relative
+from markdoc.render import (DocumentMetadata, MarkdownPool, make_relative,
+    markdown_signature)
+from markdoc.scan import SCAN_CACHE_FILENAME, DirectoryCache, scan_tree
+import markdoc.templates # Provides `Config.template_env`.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 
 Config.register_default('listing-filename', '_list.html')
+Config.register_default('build-jobs', 1)
+Config.register_default('cache.enabled', True)
+Config.register_default('cache.max-size', '256M')
+
+# Bumped whenever the format of persistent render cache entries changes.
+RENDER_CACHE_FORMAT = 'html+metadata'
+
+
+class RenderError(markdoc.exc.MarkdocError):
+    
+    """An error occurred whilst rendering a particular document."""
+    
+    def __init__(self, path, message):
+        super(RenderError, self).__init__(path, message)
+        self.path = path
+        self.message = message
+    
+    def __str__(self):
+        return 'Error rendering %s:\n%s' % (self.path, self.message)
 
 
 class Builder(object):
@@ -21,10 +51,37 @@ class Builder(object):
         self.config = config
         
         self.doc_cache = DocumentCache(base=self.config.wiki_dir)
+        self.disk_cache = render_disk_cache(config)
+        self.markdown_signature = markdown_signature(config)
+        
+        self.markdown_pool = MarkdownPool(config)
+        
+        # An empty list of extensions means that every file is a document.
+        extensions = config['document-extensions']
+        self.all_extensions = not extensions or '' in extensions
+        self.extensions = frozenset(extensions)
+        # Extensions which `p.splitext()` won't find (like '.tar.gz' or 'md').
+        self.odd_extensions = tuple(ext for ext in extensions
+                                    if not ext.startswith('.') or ext.count('.') > 1)
         
         def render_func(path, doc):
-            level = len(path.lstrip('/').split('/')) - 1
-            return self.config.markdown(curr_path=path).convert(doc)
+            if self.disk_cache is None:
+                return self.markdown_pool.render(path, doc)
+            
+            key = DiskCache.key(RENDER_CACHE_FORMAT, self.markdown_signature,
+                                path, doc)
+            entry = self.disk_cache.get(key)
+            if entry is not None:
+                try:
+                    entry = json.loads(entry)
+                    return entry['html'], DocumentMetadata.from_dict(entry['metadata'])
+                except (ValueError, KeyError, TypeError):
+                    pass # A corrupt entry; just render it again.
+            
+            html, metadata = self.markdown_pool.render(path, doc)
+            self.disk_cache.set(key, json.dumps(
+                {'html': html, 'metadata': metadata.to_dict()}))
+            return html, metadata
         self.render_cache = RenderCache(render_func, self.doc_cache)
         
         render_doc_func = lambda path, doc: self.render_document(path, cache=False)
@@ -79,26 +136,49 @@ class Builder(object):
         """
         Walk through the wiki, yielding info for each document.
         
-        For each document encountered, a `(filename, crumbs)` tuple will be
-        yielded.
+        The path of each document, relative to the wiki directory, is yielded
+        in sorted order. If the render cache is enabled, directory listings are
+        cached along with their modification times (see `markdoc.scan`), so
+        unchanged directories needn't be listed again by the next walk.
         """
         
-        if not self.config['document-extensions']:
-            self.config['document-extensions'].append('')
+        cache = None
+        if self.config['cache.enabled']:
+            cache = DirectoryCache.load(
+                p.join(self.config.cache_dir, SCAN_CACHE_FILENAME),
+                self.config.wiki_dir)
         
-        def valid_extension(filename):
-            return any(filename.endswith(valid_ext)
-                       for valid_ext in self.config['document-extensions'])
+        for path in scan_tree(self.config.wiki_dir, cache=cache):
+            if self.valid_extension(path):
+                yield path
         
-        for dirpath, subdirs, files in os.walk(self.config.wiki_dir):
-            remove_hidden(subdirs); subdirs.sort()
-            remove_hidden(files); files.sort()
-            
-            for filename in filter(valid_extension, files):
-                full_filename = p.join(dirpath, filename)
-                yield p.relpath(full_filename, start=self.config.wiki_dir)
+        if cache is not None:
+            cache.save()
     
-    def listing_context(self, directory):
+    def valid_extension(self, filename):
+        """Determine whether a filename has one of the document extensions."""
+        
+        if self.all_extensions:
+            return True
+        return (p.splitext(filename)[1] in self.extensions or
+                bool(self.odd_extensions) and filename.endswith(self.odd_extensions))
+    
+    def is_document(self, path):
+        
+        """
+        Determine whether a path (relative to the wiki) is a document.
+        
+        This applies the same rules as `walk()`, without walking the wiki: no
+        component of the path may be hidden, and the filename must have one of
+        the document extensions.
+        """
+        
+        components = path.split(p.sep)
+        if any(component.startswith('.') for component in components):
+            return False
+        return self.valid_extension(components[-1])
+    
+    def listing_context(self, directory, index=None):
         
         """
         Generate the template context for a directory listing.
@@ -110,6 +190,11 @@ class Builder(object):
         Directories should always be '/'-delimited when specified, since it is
         assumed that they are URL paths, not filesystem paths.
         
+        If an `index` is given, it should map HTML filenames (relative to the
+        HTML root) to dictionaries with `title` and `output_size` keys, as
+        recorded in the build manifest. Pages found in the index won't need to
+        be read from disk to find their titles or sizes.
+        
         For information on what the produced context will look like, consult the
         `listing` doctest.
         """
@@ -121,6 +206,8 @@ class Builder(object):
         fs_rel_dir = p.sep.join(directory.split('/'))
         fs_abs_dir = p.join(self.config.html_dir, fs_rel_dir)
         skip_files = set([self.config['listing-filename'], 'index.html'])
+        compressed = self.config['compress.extensions']
+        fingerprinted = self.config.assets.fingerprinted
         
         sub_directories, pages, files = [], [], []
         for basename in os.listdir(fs_abs_dir):
@@ -137,17 +224,30 @@ class Builder(object):
             
             else:
                 if (basename in skip_files or basename.startswith('.') or
-                    basename.startswith('_')):
+                    basename.startswith('_') or
+                    variant_base(basename, compressed) is not None or
+                    p.join(fs_rel_dir, basename) in fingerprinted):
                     continue
                 
                 file_dict['slug'] = p.splitext(basename)[0]
-                file_dict['size'] = p.getsize(fs_abs_path)
+                
+                page = None
+                if index is not None:
+                    page = index.get(p.join(fs_rel_dir, basename))
+                
+                if page is not None:
+                    file_dict['size'] = page['output_size']
+                else:
+                    file_dict['size'] = p.getsize(fs_abs_path)
                 file_dict['humansize'] = humansize(file_dict['size'])
                 
                 if p.splitext(basename)[1] == (p.extsep + 'html'):
-                    # Get the title from the file.
-                    contents = read_from(fs_abs_path)
-                    file_dict['title'] = get_title(file_dict['slug'], contents)
+                    if page is not None:
+                        file_dict['title'] = page['title']
+                    else:
+                        # Get the title from the file.
+                        contents = read_from(fs_abs_path)
+                        file_dict['title'] = get_title(file_dict['slug'], contents)
                     # Remove .html from the end of the href.
                     file_dict['href'] = p.splitext(file_dict['href'])[0]
                     pages.append(file_dict)
@@ -167,28 +267,54 @@ class Builder(object):
         }
     
     def render(self, path, cache=True):
-        return self.render_cache.render(path, cache=cache)
+        return self.render_cache.render(path, cache=cache)[0]
+    
+    def metadata(self, path, cache=True):
+        """Return the `DocumentMetadata` gathered while rendering a document."""
+        
+        return self.render_cache.render(path, cache=cache)[1]
     
     def title(self, path, cache=True):
-        return get_title(path, self.render(path, cache=cache))
+        return self.metadata(path, cache=cache).title_for(path)
     
-    def render_document(self, path, cache=True):
-        if cache:
-            return self.document_render_cache.render(path)
+    def document_context(self, path):
+        """Return the template context for a whole document."""
         
         context = {}
         context['content'] = self.render(path)
-        context['title'] = self.title(path)
+        context['metadata'] = self.metadata(path)
+        context['title'] = context['metadata'].title_for(path)
         context['crumbs'] = self.crumbs(path)
         context['make_relative'] = lambda href: make_relative(path, href)
+        return context
+    
+    def render_document(self, path, cache=True):
+        if cache:
+            return self.document_render_cache.render(path)
         
         template = self.config.template_env.get_template('document.html')
-        return template.render(context)
+        return template.render(self.document_context(path))
     
-    def render_listing(self, path):
+    def stream_document(self, path):
+        
+        """
+        Render a whole document as an iterator of unicode chunks.
+        
+        This produces the same HTML as `render_document()`, but piece by piece
+        (using the template's `generate()` method), so that it can be written
+        out without ever holding the whole page in memory. The result isn't
+        cached.
+        """
+        
+        template = self.config.template_env.get_template('document.html')
+        return template.generate(self.document_context(path))
+    
+    def render_listing(self, path, context=None):
         import jinja2
         
-        context = self.listing_context(path)
+        if context is None:
+            context = self.listing_context(path)
+        context = dict(context)
         
         crumbs = [('index', '/')]
         if path not in ['', '/']:
@@ -205,20 +331,29 @@ class Builder(object):
         return template.render(context)
 
 
+def render_disk_cache(config):
+    """Return the persistent render cache for a config, or `None` if disabled."""
+    
+    if not config['cache.enabled']:
+        return None
+    return DiskCache(p.join(config.cache_dir, 'render'),
+                     max_size=parse_size(config['cache.max-size']))
+
+
 def remove_hidden(names):
     """Remove (in-place) all strings starting with a '.' in the given list."""
     
-    i = 0
-    while i < len(names):
-        if names[i].startswith('.'):
-            names.pop(i)
-        else:
-            i += 1
+    names[:] = [name for name in names if not name.startswith('.')]
     return names
 
 
 def get_title(filename, data):
-    """Try to retrieve a title from a filename and its contents."""
+    """
+    Try to retrieve a title from a filename and its (HTML) contents.
+    
+    This is only needed for HTML which Markdoc didn't render itself; for
+    documents, use `Builder.metadata()` instead.
+    """
     
     match = re.search(r'<!-- ?title:(.+)-->', data, re.IGNORECASE)
     if match:
@@ -228,8 +363,7 @@ def get_title(filename, data):
     if match:
         return match.group(1)
     
-    name, extension = p.splitext(p.basename(filename))
-    return re.sub(r'[-_]+', ' ', name).title()
+    return DocumentMetadata().title_for(filename)
 
 
 def humansize(size, base=1024):
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+from collections import OrderedDict
 from functools import wraps
+import hashlib
 import os
 import os.path as p
+import re
+import threading
 import time
 
 
@@ -115,6 +119,288 @@ class RenderCache(object):
     get = render # For compatibility with the document cache.
 
 
+class DiskCache(object):
+    
+    """
+    A persistent, content-addressed cache of rendered results.
+    
+    Entries are stored as individual UTF-8 files beneath a directory, named by
+    a hex digest of everything that went into producing them (see `key()`), so
+    the cache can be shared between builds and processes with no further
+    bookkeeping. Every hit refreshes the modification time of the entry, which
+    `gc()` uses to evict the least recently used entries once the cache grows
+    beyond `max_size` bytes.
+    
+    Since `gc()` has to look at every entry, the cache also keeps a record of
+    its size (see `recorded_size()`), so that `gc_if_full()` only does so when
+    it's needed.
+    """
+    
+    # Kept at the top of the directory, where there are never any entries.
+    SIZE_FILENAME = 'size'
+    ADDED_FILENAME = 'added'
+    
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+    
+    @staticmethod
+    def key(*parts):
+        """Produce a stable hex digest for a sequence of (unicode) strings."""
+        
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update('%d:%s' % (len(part), part))
+        return digest.hexdigest()
+    
+    def filename(self, key):
+        return p.join(self.directory, key[:2], key[2:])
+    
+    def get(self, key):
+        """Return the cached data for a key, or `None` if it isn't cached."""
+        
+        filename = self.filename(key)
+        try:
+            data = read_from(filename)
+        except (IOError, OSError):
+            return None
+        
+        try:
+            os.utime(filename, None) # Mark as recently used.
+        except OSError:
+            pass
+        return data
+    
+    def set(self, key, data):
+        """Atomically store some unicode data under a key."""
+        
+        filename = self.filename(key)
+        directory = p.dirname(filename)
+        if not p.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it in the meantime.
+                if not p.isdir(directory):
+                    raise
+        
+        temp_filename = '%s.%d.new' % (filename, os.getpid())
+        fp = codecs.open(temp_filename, 'w', encoding='utf-8')
+        try:
+            fp.write(data)
+            size = fp.tell()
+        finally:
+            fp.close()
+        os.rename(temp_filename, filename)
+        
+        # Appending a line is atomic, so this is safe from several processes.
+        fp = open(p.join(self.directory, self.ADDED_FILENAME), 'a')
+        try:
+            fp.write('%d\n' % size)
+        finally:
+            fp.close()
+    
+    def entries(self):
+        """Yield `(mtime, size, filename)` for every entry in the cache."""
+        
+        if not p.isdir(self.directory):
+            return
+        for dirpath, subdirs, files in os.walk(self.directory):
+            if dirpath == self.directory:
+                continue # Only the size records live up here.
+            for basename in files:
+                filename = p.join(dirpath, basename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, filename
+    
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+    
+    def recorded_size(self):
+        
+        """
+        Return the size of the cache as recorded, without looking at it.
+        
+        This is the size found by the last `gc()`, plus that of every entry
+        stored since. Entries which are replaced are counted twice, so it may
+        be an overestimate (or an underestimate, by any stored while `gc()`
+        was running); it's `None` if there's no record.
+        """
+        
+        try:
+            total = int(read_from(p.join(self.directory, self.SIZE_FILENAME),
+                                  encoding=None))
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            added = read_from(p.join(self.directory, self.ADDED_FILENAME),
+                              encoding=None)
+        except (IOError, OSError):
+            added = ''
+        return total + sum(int(line) for line in added.split() if line.isdigit())
+    
+    def gc_if_full(self):
+        
+        """
+        Run `gc()` if the recorded size of the cache is over `max_size`.
+        
+        Returns `(0, 0)` without touching the entries otherwise.
+        """
+        
+        if self.max_size is None:
+            return 0, 0
+        size = self.recorded_size()
+        if size is not None and size <= self.max_size:
+            return 0, 0
+        return self.gc()
+    
+    def gc(self, max_size=None):
+        
+        """
+        Evict least recently used entries until the cache fits `max_size`.
+        
+        If `max_size` is not given, the cache's own `max_size` is used; if that
+        is also `None`, nothing is evicted. Returns a `(removed, freed)` tuple
+        of the number of entries removed and the bytes freed.
+        """
+        
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0, 0
+        
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        
+        removed = freed = 0
+        for mtime, size, filename in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+        
+        if p.isdir(self.directory):
+            write_to(p.join(self.directory, self.SIZE_FILENAME), str(total),
+                     encoding=None)
+            try:
+                os.remove(p.join(self.directory, self.ADDED_FILENAME))
+            except OSError:
+                pass
+        return removed, freed
+    
+    def clear(self):
+        """Remove every entry from the cache."""
+        
+        return self.gc(max_size=0)
+
+
+class MemoryCache(object):
+    
+    """
+    A thread-safe in-memory cache, bounded by size, with LRU eviction.
+    
+    Every entry is stored with a `validator` (such as the size and
+    modification time of the file it was read from), and is only returned by
+    `get()` if the validator given then is the same; otherwise it's discarded
+    as stale. Each entry also has a size in bytes, and once the total exceeds
+    `max_size`, the least recently used entries are evicted.
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key, validator):
+        """Return the value for a key, or `None` if it's absent or stale."""
+        
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != validator:
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return None
+            self.entries[key] = entry # Now the most recently used.
+            self.hits += 1
+            return entry[1]
+        finally:
+            self.lock.release()
+    
+    def set(self, key, validator, value, size):
+        
+        """
+        Store a value of the given size, evicting older entries to make room.
+        
+        Values larger than the whole cache aren't stored. Returns whether the
+        value was stored.
+        """
+        
+        if size > self.max_size:
+            return False
+        
+        self.lock.acquire()
+        try:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[key] = (validator, value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+        finally:
+            self.lock.release()
+        return True
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+
+def parse_size(size):
+    
+    """
+    Parse a human-readable size such as '512K', '64M' or '1G' into bytes.
+    
+        >>> parse_size(1024)
+        1024
+        >>> parse_size('64M')
+        67108864
+        >>> parse_size('1.5k')
+        1536
+    """
+    
+    if isinstance(size, (int, long)):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*$', str(size), re.I)
+    if not match:
+        raise ValueError('invalid size: %r' % (size,))
+    number, unit = match.groups()
+    return int(float(number) * (1024 ** 'bkmgt'.index(unit.lower() or 'b')))
+
+
 def read_from(filename, encoding='utf-8'):
     """Read data from a filename, optionally with an encoding."""
     
@@ -127,3 +413,47 @@ def read_from(filename, encoding='utf-8'):
         return fp.read()
     finally:
         fp.close()
+
+
+def write_to(filename, data, encoding='utf-8'):
+    
+    """
+    Atomically write data to a filename, optionally with an encoding.
+    
+    The data is written to a temporary file in the same directory, which is
+    then renamed over the destination; readers will never see a partial file.
+    Returns the number of bytes written.
+    """
+    
+    return write_stream(filename, [data], encoding=encoding)
+
+
+def write_stream(filename, chunks, encoding='utf-8'):
+    
+    """
+    Atomically write an iterable of chunks of data to a filename.
+    
+    Like `write_to()`, but each chunk is encoded and written as it is produced
+    (for example, by a template's `generate()` method), so the whole of the
+    data never needs to be held in memory at once. If the iterable raises an
+    exception, the destination is left untouched. Returns the number of bytes
+    written.
+    """
+    
+    temp_filename = p.join(p.dirname(filename), '.' + p.basename(filename) + '.new')
+    size = 0
+    fp = open(temp_filename, 'wb')
+    try:
+        try:
+            for chunk in chunks:
+                if encoding is not None:
+                    chunk = chunk.encode(encoding)
+                fp.write(chunk)
+                size += len(chunk)
+        finally:
+            fp.close()
+    except:
+        os.remove(temp_filename)
+        raise
+    os.rename(temp_filename, filename)
+    return size
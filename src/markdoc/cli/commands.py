@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import codecs
 from functools import wraps
 import logging
 import os
@@ -8,11 +7,22 @@ import os.path as p
 import pprint
 import re
 import shutil
-import subprocess
 import sys
+import time
 
 import markdoc
-from markdoc.builder import Builder
+from markdoc.cache import parse_size
+from markdoc.compress import compress_outputs, keep_variants
+from markdoc.directories import static_sources
+from markdoc.manifest import (BuildManifest, build_signature, file_digest,
+    output_name, plan_build, plan_changes)
+from markdoc.profile import BuildProfile, no_profile
+from markdoc.publish import (current_generation, generations_dir, link_or_copy,
+    new_generation, prune_generations, publish)
+from markdoc.routes import mark_changed
+from markdoc.shard import (Shard, find_shards, parse_shard, plan_merge,
+    shard_name, shard_of)
+from markdoc.sync import merge_trees, select_trees, sync
 from markdoc.cli.parser import subparsers
 
 
@@ -101,6 +111,10 @@ def vcs_ignore(config, args):
     ignore_file_lines = []
     ignore_file_lines.append(p.relpath(config.html_dir, start=wiki_root))
     ignore_file_lines.append(p.relpath(config.temp_dir, start=wiki_root))
+    ignore_file_lines.append(p.relpath(config.cache_dir, start=wiki_root))
+    ignore_file_lines.append(p.relpath(config.shard_dir, start=wiki_root))
+    if config['publish-mode'] == 'atomic':
+        ignore_file_lines.append(p.relpath(generations_dir(config), start=wiki_root))
     if args.vcs == 'hg':
         ignore_file_lines.insert(0, 'syntax: glob')
         ignore_file_lines.insert(1, '')
@@ -141,12 +155,21 @@ def clean_html(config, args):
     
     log = logging.getLogger('markdoc.clean-html')
     
-    if p.exists(config.html_dir):
+    if p.islink(config.html_dir):
+        # The HTML root is a link to the current generation (see `build`).
+        log.debug('rm %s' % config.html_dir)
+        os.remove(config.html_dir)
+    elif p.exists(config.html_dir):
         log.debug('rm -Rf %s' % config.html_dir)
         shutil.rmtree(config.html_dir)
     
+    if p.exists(generations_dir(config)):
+        log.debug('rm -Rf %s' % generations_dir(config))
+        shutil.rmtree(generations_dir(config))
+    
     log.debug('makedirs %s' % config.html_dir)
     os.makedirs(config.html_dir)
+    mark_changed(config)
 
 
 @command
@@ -163,42 +186,56 @@ def clean_temp(config, args):
     os.makedirs(config.temp_dir)
 
 
-## Synchronization
-
 @command
-def sync_static(config, args):
-    """Sync static files into the HTML root."""
-    
-    log = logging.getLogger('markdoc.sync-static')
+def cache_gc(config, args):
+    """Evict old entries from the persistent render cache."""
     
-    if not p.exists(config.html_dir):
-        log.debug('makedirs %s' % config.html_dir)
-        os.makedirs(config.html_dir)
+    from markdoc.builder import humansize, render_disk_cache
     
-    command = ('rsync -vaxq --cvs-exclude --ignore-errors --include=.htaccess --exclude=.* --exclude=_*').split()
-    display_cmd = command[:]
+    log = logging.getLogger('markdoc.cache-gc')
     
-    if config['use-default-static']:
-        # rsync needs the paths to have trailing slashes to work correctly.
-        command.append(p.join(markdoc.default_static_dir, ''))
-        display_cmd.append(p.basename(markdoc.default_static_dir) + '/')
+    cache = render_disk_cache(config)
+    if cache is None:
+        log.info('The render cache is disabled')
+        return
     
-    if not config['cvs-exclude']:
-        command.remove('--cvs-exclude')
-        display_cmd.remove('--cvs-exclude')
+    if args.clear:
+        removed, freed = cache.clear()
+    else:
+        max_size = cache.max_size
+        if args.max_size is not None:
+            max_size = parse_size(args.max_size)
+        removed, freed = cache.gc(max_size=max_size)
     
-    if p.isdir(config.static_dir):
-        command.append(p.join(config.static_dir, ''))
-        display_cmd.append(p.basename(config.static_dir) + '/')
+    log.info('Removed %d entries (%s); %s remaining' % (
+        removed, humansize(freed), humansize(cache.size())))
+
+cache_gc.parser.add_argument('--max-size', default=None, metavar='SIZE',
+    help="Shrink the cache to SIZE (e.g. '64M'); defaults to the "
+         "'cache.max-size' setting")
+cache_gc.parser.add_argument('--clear', action='store_true', default=False,
+    help="Remove every entry from the cache")
+
+
+## Synchronization
+
+@command
+def sync_static(config, args):
+    """Sync static files into the HTML root."""
     
-    command.append(p.join(config.html_dir, ''))
-    display_cmd.append(p.basename(config.html_dir) + '/')
+    log = logging.getLogger('markdoc.sync-static')
     
-    log.debug(subprocess.list2cmdline(display_cmd))
+    sources = static_sources(config)
+    log.debug('sync %s -> %s' % (
+        ' '.join(p.basename(source) + '/' for source in sources),
+        p.basename(config.html_dir) + '/'))
     
-    subprocess.check_call(command)
+    stats = sync(sources, config.html_dir, delete=False,
+                 cvs_exclude=config['cvs-exclude'], link=config['sync.link'],
+                 log=log)
+    mark_changed(config)
     
-    log.debug('rsync completed')
+    log.info('sync completed: %s' % stats)
 
 
 @command
@@ -207,37 +244,89 @@ def sync_html(config, args):
     
     log = logging.getLogger('markdoc.sync-html')
     
-    if not p.exists(config.html_dir):
-        log.debug('makedirs %s' % config.html_dir)
-        os.makedirs(config.html_dir)
+    sources = [config.temp_dir] + static_sources(config)
+    log.debug('sync --delete %s -> %s' % (
+        ' '.join(p.basename(source) + '/' for source in sources),
+        p.basename(config.html_dir) + '/'))
+    
+    stats = sync(sources, config.html_dir, delete=True,
+                 cvs_exclude=config['cvs-exclude'], link=config['sync.link'],
+                 keep=keep_generated(config), log=log)
+    mark_changed(config)
+    
+    log.info('sync completed: %s' % stats)
+
+
+def keep_generated(config):
     
-    command = ('rsync -vaxq --cvs-exclude --delete --ignore-errors --include=.htaccess --exclude=.* --exclude=_*').split()
-    display_cmd = command[:]
+    """
+    Return a `keep` callable for `sync()` which protects generated files.
     
-    # rsync needs the paths to have trailing slashes to work correctly.
-    command.append(p.join(config.temp_dir, ''))
-    display_cmd.append(p.basename(config.temp_dir) + '/')
+    These are the compressed variants and fingerprinted copies which are made
+    in the HTML root after syncing, and so have no source to be synced from.
+    """
     
-    if config['use-default-static']:
-        command.append(p.join(markdoc.default_static_dir, ''))
-        display_cmd.append(p.basename(markdoc.default_static_dir) + '/')
+    keep_variant = keep_variants(config)
+    fingerprinted = config.assets.fingerprinted
+    return lambda rel_path: keep_variant(rel_path) or rel_path in fingerprinted
+
+
+def static_files(config):
+    """Return the relative paths of every file synced from the static media."""
     
-    if not config['cvs-exclude']:
-        command.remove('--cvs-exclude')
-        display_cmd.remove('--cvs-exclude')
+    directories, files = merge_trees(static_sources(config),
+                                     cvs_exclude=config['cvs-exclude'])
+    return sorted(files)
+
+
+def sync_outputs(config, manifest, plan, static_paths=(), log=None):
     
-    if p.isdir(config.static_dir):
-        command.append(p.join(config.static_dir, ''))
-        display_cmd.append(p.basename(config.static_dir) + '/')
+    """
+    Sync the outputs of a build, and the static media, into the HTML root.
     
-    command.append(p.join(config.html_dir, ''))
-    display_cmd.append(p.basename(config.html_dir) + '/')
+    For a full rebuild (or when the manifest has no record of the static
+    media) everything is synced, as by `sync-html`. Otherwise only the outputs
+    which the plan rendered or removed are synced, and those it rendered are
+    always transferred, however up to date the HTML root's copies look. Static
+    media are synced as well: `static_paths` for a partial plan, or else every
+    static file, along with any which the manifest lists from the last build
+    but which have since disappeared. The manifest's record of the static media
+    is updated to match. Returns the relative paths synced, or `None` if
+    everything was.
+    """
     
-    log.debug(subprocess.list2cmdline(display_cmd))
+    if log is None:
+        log = logging.getLogger('markdoc.build')
     
-    subprocess.check_call(command)
+    if plan.full or (manifest.static is None and not plan.partial):
+        sync_html(config, None)
+        manifest.static = static_files(config)
+        return None
     
-    log.debug('rsync completed')
+    rendered = [output_name(path) for path, _ in plan.render]
+    paths = rendered + [output for _, output in plan.removed]
+    if not plan.partial:
+        current = static_files(config)
+        paths.extend(current)
+        paths.extend(sorted(set(manifest.static) - set(current)))
+        manifest.static = current
+    else:
+        paths.extend(static_paths)
+        if manifest.static is not None and static_paths:
+            prefixes = [p.normpath(path) for path in static_paths]
+            kept = [path for path in manifest.static
+                    if not any(path == prefix or path.startswith(prefix + p.sep)
+                               for prefix in prefixes)]
+            directories, files = select_trees(static_sources(config), prefixes,
+                                              cvs_exclude=config['cvs-exclude'])
+            manifest.static = sorted(set(kept) | set(files))
+    
+    stats = sync([config.temp_dir] + static_sources(config), config.html_dir,
+                 delete=True, cvs_exclude=config['cvs-exclude'],
+                 link=config['sync.link'], keep=keep_generated(config),
+                 paths=paths, force=rendered, log=log)
+    log.info('sync completed: %s' % stats)
+    return paths
 
 
 ## Building
@@ -246,71 +335,474 @@ def sync_html(config, args):
 def build(config, args):
     """Compile wiki to HTML and sync to the HTML root."""
     
+    from markdoc.builder import Builder
+    from markdoc.parallel import job_count
+    
     log = logging.getLogger('markdoc.build')
     
-    clean_temp(config, args)
+    shard = None
+    if args.shard:
+        if args.plan or args.atomic:
+            build.parser.error('--shard cannot be used with --plan or --atomic')
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError, exc:
+            build.parser.error(str(exc))
+    
+    if args.atomic:
+        config['publish-mode'] = 'atomic'
+    atomic = config['publish-mode'] == 'atomic'
+    previous = None
+    if atomic:
+        previous = current_generation(config)
+    
+    jobs = job_count(config, args.jobs)
+    profile = None
+    stage = no_profile
+    if args.profile:
+        profile = BuildProfile(jobs=jobs)
+        stage = profile.stage
+    
+    if shard is not None:
+        build_shard(config, shard[0], shard[1], jobs=jobs, profile=profile)
+        report_profile(profile, args)
+        return
+    
+    with stage('plan'):
+        builder = Builder(config)
+        manifest = BuildManifest.for_config(config)
+        signature = build_signature(config)
+        plan = plan_build(config, manifest, builder.walk(),
+                          signature=signature, force=args.force,
+                          output_dir=(previous if atomic else config.temp_dir))
+    
+    if args.plan:
+        for line in plan.lines():
+            print line
+        return
+    
+    execute_plan(config, builder, manifest, plan, signature, jobs=jobs,
+                 profile=profile)
+    report_profile(profile, args)
+
+build.parser.add_argument('--plan', action='store_true', default=False,
+    help="Print the documents which would be rebuilt, without building them")
+build.parser.add_argument('-f', '--force', action='store_true', default=False,
+    help="Rebuild every document, ignoring the build manifest")
+build.parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+    help="Render documents using N processes (0 means one per CPU core; "
+         "the default is the 'build-jobs' setting)")
+build.parser.add_argument('--atomic', action='store_true', default=False,
+    help="Build into a new generation of the HTML root and publish it "
+         "atomically (the default is the 'publish-mode' setting)")
+build.parser.add_argument('--profile', nargs='?', const='build-profile.json',
+    default=None, metavar='FILE',
+    help="Time each stage of the build and each document, print a report and "
+         "write it as JSON to FILE (default build-profile.json)")
+build.parser.add_argument('--top', type=int, default=10, metavar='N',
+    help="Show the N slowest documents in the profile report (default 10)")
+build.parser.add_argument('--shard', default=None, metavar='K/N',
+    help="Only render the Kth of N shards of the wiki, into the shard "
+         "directory (see merge-shards)")
+
+
+def report_profile(profile, args):
+    """Print a build profile, and save it where `build --profile` asked."""
+    
+    if profile is None:
+        return
+    for line in profile.report(top=args.top):
+        print line
+    profile.save(args.profile)
+    logging.getLogger('markdoc.build').info('Profile written to %s' % args.profile)
+
+
+def build_shard(config, index, count, jobs=1, profile=None):
+    
+    """
+    Render the documents in one shard of a wiki (see `markdoc.shard`).
+    
+    The outputs and the shard's `shard.json` are written to a fresh
+    `K-of-N` directory beneath the shard directory. Nothing is synced to the
+    HTML root; that's left to `merge-shards`.
+    """
+    
+    from markdoc.builder import Builder
+    from markdoc.parallel import render_documents
     
-    builder = Builder(config)
-    for rel_filename in builder.walk():
-        html = builder.render_document(rel_filename)
-        out_filename = p.join(config.temp_dir,
-            p.splitext(rel_filename)[0] + p.extsep + 'html')
+    log = logging.getLogger('markdoc.build')
+    stage = no_profile
+    if profile is not None:
+        stage = profile.stage
+    
+    with stage('plan'):
+        builder = Builder(config)
+        shard = Shard(p.join(config.shard_dir, shard_name(index, count)),
+                      index, count, build_signature(config))
+        # Taken before rendering, so a document edited in the meantime will
+        # be caught by `merge-shards`.
+        digests = dict((path, file_digest(p.join(config.wiki_dir, path)))
+                       for path in builder.walk()
+                       if shard_of(path, count) == index)
+    
+    with stage('prepare'):
+        if p.exists(shard.directory):
+            log.debug('rm -Rf %s' % shard.directory)
+            shutil.rmtree(shard.directory)
+        os.makedirs(shard.directory)
+    
+    with stage('render'):
+        outputs = [(path, p.join(shard.directory, output_name(path)))
+                   for path in sorted(digests)]
+        rendered = render_documents(builder, outputs, jobs, profile=profile)
+        for rel_filename, size, metadata in rendered:
+            shard.documents[rel_filename] = {
+                'digest': digests[rel_filename],
+                'output': output_name(rel_filename),
+                'title': metadata.title_for(rel_filename),
+                'output_size': size,
+                'metadata': metadata.to_dict()}
+    
+    with stage('finish'):
+        shard.save()
+    log.info('Rendered %d documents into shard %s' % (len(digests), shard.name))
+
+
+def execute_plan(config, builder, manifest, plan, signature, jobs=1,
+                 static_paths=(), profile=None):
+    
+    """
+    Render, sync, list and publish according to a `BuildPlan`.
+    
+    The manifest is updated and saved once everything has succeeded. For a
+    partial plan (see `plan_changes()`), syncing and listings are restricted to
+    the outputs it affects, plus the given `static_paths` (relative to the
+    static directory). If a `BuildProfile` is given, each stage of the build
+    and each document rendered are timed.
+    """
+    
+    from markdoc.builder import Builder, humansize
+    from markdoc.listing import affected_directories, generate_listings
+    from markdoc.parallel import render_documents
+    
+    log = logging.getLogger('markdoc.build')
+    stage = no_profile
+    if profile is not None:
+        stage = profile.stage
+    
+    atomic = config['publish-mode'] == 'atomic'
+    previous = None
+    if atomic:
+        previous = current_generation(config)
+    
+    with stage('prepare'):
+        if plan.full:
+            if not atomic:
+                clean_temp(config, None)
+            manifest = BuildManifest(manifest.filename, signature=signature)
         
-        if not p.exists(p.dirname(out_filename)):
-            log.debug('makedirs %s' % p.dirname(out_filename))
-            os.makedirs(p.dirname(out_filename))
+        for rel_filename, output in plan.removed:
+            if not atomic:
+                remove_output(config.temp_dir, output)
+            manifest.forget(rel_filename)
         
-        log.debug('Creating %s' % p.relpath(out_filename, start=config.temp_dir))
-        fp = codecs.open(out_filename, 'w', encoding='utf-8')
-        try:
-            fp.write(html)
-        finally:
-            fp.close()
+        for rel_filename, digest in plan.touched.items():
+            manifest.touch(rel_filename, p.join(config.wiki_dir, rel_filename), digest)
+        
+        if atomic:
+            # Render straight into a fresh generation of the HTML root.
+            output_dir = new_generation(config)
+            log.debug('Staging build in %s' % output_dir)
+        else:
+            output_dir = config.temp_dir
+        
+        for rel_filename, filename, entry in plan.merged:
+            link_or_copy(filename, p.join(output_dir, entry['output']))
+            manifest.record(rel_filename, p.join(config.wiki_dir, rel_filename),
+                            entry['output'], digest=entry['digest'],
+                            title=entry['title'], output_size=entry['output_size'],
+                            metadata=entry['metadata'])
+    
+    try:
+        if atomic:
+            with stage('prepare'):
+                for rel_filename in plan.unchanged:
+                    out_rel_filename = output_name(rel_filename)
+                    link_or_copy(p.join(previous, out_rel_filename),
+                                 p.join(output_dir, out_rel_filename))
+        
+        if jobs > 1 and len(plan.render) > 1:
+            log.debug('Rendering with %d processes' % jobs)
+        
+        with stage('render'):
+            reasons = dict(plan.render)
+            outputs = [(path, p.join(output_dir, output_name(path)))
+                       for path, _ in plan.render]
+            rendered = render_documents(builder, outputs, jobs, profile=profile)
+            for rel_filename, size, metadata in rendered:
+                out_rel_filename = output_name(rel_filename)
+                log.debug('Created %s (%s)' % (out_rel_filename, reasons[rel_filename]))
+                manifest.record(rel_filename, p.join(config.wiki_dir, rel_filename),
+                                out_rel_filename, output_size=size,
+                                title=metadata.title_for(rel_filename),
+                                metadata=metadata.to_dict())
+        
+        log.info('Rendered %d of %d documents' % (
+            len(plan.render),
+            len(plan.render) + len(plan.unchanged) + len(plan.merged)))
+        
+        if atomic:
+            with stage('sync'):
+                stats = sync(static_sources(config), output_dir,
+                             cvs_exclude=config['cvs-exclude'],
+                             link=config['sync.link'], link_dest=previous, log=log)
+                log.info('Static media: %s' % stats)
+            with stage('fingerprint'):
+                config.assets.publish(output_dir, log=log)
+            
+            with stage('listings'):
+                staging_config = config.copy()
+                staging_config['html-dir'] = output_dir
+                generate_listings(staging_config, Builder(staging_config),
+                                  index=manifest.index(), signature=signature,
+                                  jobs=jobs, previous=previous)
+            with stage('compress'):
+                compress_outputs(config, root=output_dir, previous=previous,
+                                 log=log)
+            with stage('publish'):
+                publish(config, output_dir)
+        elif plan.partial:
+            with stage('sync'):
+                paths = sync_outputs(config, manifest, plan,
+                                     static_paths=static_paths, log=log)
+            with stage('fingerprint'):
+                paths.extend(config.assets.publish(config.html_dir, log=log))
+            with stage('listings'):
+                directories = affected_directories(config.html_dir, paths)
+                generate_listings(config, builder, index=manifest.index(),
+                                  signature=signature, jobs=jobs,
+                                  directories=directories)
+            with stage('compress'):
+                for directory in directories:
+                    directory = directory.strip('/')
+                    paths.append(p.join(directory, config['listing-filename']))
+                    paths.append(p.join(directory, 'index.html'))
+                compress_outputs(config, paths=paths, log=log)
+        else:
+            with stage('sync'):
+                sync_outputs(config, manifest, plan, log=log)
+            with stage('fingerprint'):
+                config.assets.publish(config.html_dir, log=log)
+            with stage('listings'):
+                generate_listings(config, builder, index=manifest.index(),
+                                  signature=signature, jobs=jobs)
+            with stage('compress'):
+                compress_outputs(config, log=log)
+    except:
+        if atomic:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+    
+    with stage('finish'):
+        # Only save the manifest once the whole build has succeeded.
+        manifest.save()
+        
+        if atomic:
+            prune_generations(config)
+        
+        if plan.render and builder.disk_cache is not None:
+            removed, freed = builder.disk_cache.gc_if_full()
+            if removed:
+                log.debug('Evicted %d render cache entries (%s)' % (
+                    removed, humansize(freed)))
+
+
+def remove_output(root, rel_filename):
+    """Remove an output file and any directories left empty by its removal."""
+    
+    log = logging.getLogger('markdoc.build')
+    filename = p.join(root, rel_filename)
+    if p.exists(filename):
+        log.debug('rm %s' % rel_filename)
+        os.remove(filename)
     
-    sync_html(config, args)
-    build_listing(config, args)
+    directory = p.dirname(filename)
+    while directory != root and p.isdir(directory) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = p.dirname(directory)
+
+
+@command
+def merge_shards(config, args):
+    """Merge the shards of a build and publish them to the HTML root."""
+    
+    from markdoc.builder import Builder
+    from markdoc.parallel import job_count
+    
+    log = logging.getLogger('markdoc.merge-shards')
+    
+    directories = args.shards or find_shards(config.shard_dir)
+    shards = [Shard.load(directory) for directory in directories]
+    
+    builder = Builder(config)
+    signature = build_signature(config)
+    plan = plan_merge(config, builder.walk(), shards, signature)
+    
+    manifest = BuildManifest.for_config(config)
+    execute_plan(config, builder, manifest, plan, signature,
+                 jobs=job_count(config))
+    log.info('Merged %d documents from %d shards' % (len(plan.merged), len(shards)))
+
+merge_shards.parser.add_argument('shards', nargs='*', metavar='SHARD',
+    help="Shard directories to merge (by default, every shard in the shard "
+         "directory)")
+
+
+@command
+def compile_templates(config, args):
+    """Precompile the templates, for use with templates.auto-reload off."""
+    
+    from markdoc.templates import bundle_filename, compile_bundle
+    
+    log = logging.getLogger('markdoc.compile-templates')
+    filename = bundle_filename(config)
+    count = compile_bundle(config, filename)
+    log.info('Compiled %d templates into %s' % (
+        count, p.relpath(filename, start=config['meta.root'])))
+    if config['templates.auto-reload']:
+        log.warning('The bundle is only used with templates.auto-reload off')
 
 
 @command
 def build_listing(config, args):
     """Create listings for all directories in the HTML root (post-build)."""
     
-    log = logging.getLogger('markdoc.build-listing')
+    from markdoc.builder import Builder
+    from markdoc.listing import generate_listings
+    from markdoc.parallel import job_count
     
-    list_basename = config['listing-filename']
-    builder = Builder(config)
-    generate_listing = config.get('generate-listing', 'always').lower()
-    always_list = True
-    if generate_listing == 'never':
-        log.debug("No listing generated (generate-listing == never)")
-        return # No need to continue.
-    
-    for fs_dir, _, _ in os.walk(config.html_dir):
-        index_file_exists = any([
-            p.exists(p.join(fs_dir, 'index.html')),
-            p.exists(p.join(fs_dir, 'index'))])
-        
-        directory = '/' + '/'.join(p.relpath(fs_dir, start=config.html_dir).split(p.sep))
-        if directory == '/' + p.curdir:
-            directory = '/'
-        
-        if (generate_listing == 'sometimes') and index_file_exists:
-            log.debug("No listing generated for %s" % directory)
+    manifest = BuildManifest.for_config(config)
+    generate_listings(config, Builder(config), index=manifest.index(),
+                      jobs=job_count(config))
+    mark_changed(config)
+
+
+@command
+def watch(config, args):
+    """Build the wiki, then rebuild it whenever it changes."""
+    
+    from markdoc.config import Config
+    from markdoc.watch import Overflow, make_watcher, wait_for_changes
+    
+    log = logging.getLogger('markdoc.watch')
+    
+    build(config, build.parser.parse_args([]))
+    
+    config_file = config['meta.config-file']
+    roots = [config.wiki_dir, config.static_dir, config.template_dir, config_file]
+    watcher = make_watcher([root for root in roots if p.exists(root)],
+                           poll=args.poll, interval=config['watch.poll-interval'])
+    log.info('Watching for changes (press Ctrl-C to stop)')
+    
+    try:
+        while True:
+            try:
+                changed = wait_for_changes(watcher, config['watch.debounce'])
+            except Overflow:
+                log.warning('Too many changes at once; checking everything')
+                changed = None
+            
+            start = time.time()
+            try:
+                if changed and config_file in changed:
+                    log.info('Configuration changed; reloading')
+                    config = Config.for_file(config_file)
+                    changed = None
+                plan = rebuild_changes(config, changed)
+            except Exception:
+                log.exception('Rebuild failed')
+                continue
+            
+            if plan is None:
+                continue
+            elapsed = time.time() - start
+            log.info('Rebuilt %d documents in %.3fs' % (len(plan.render), elapsed))
+            if elapsed > config['watch.latency']:
+                log.warning('Rebuild took longer than %.3fs (watch.latency)' %
+                            config['watch.latency'])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+watch.parser.add_argument('--poll', action='store_true', default=False,
+    help="Poll the filesystem for changes instead of using inotify")
+
+
+def rebuild_changes(config, changed):
+    
+    """
+    Bring a build up to date after the given (absolute) paths have changed.
+    
+    Changes to documents and static media result in a partial plan which only
+    examines those paths. Anything else (including `changed` being `None`,
+    meaning that some changes may have been missed) falls back to the full
+    scan which `build` performs. Returns the plan which was executed, or `None`
+    if there was nothing to do.
+    """
+    
+    from markdoc.builder import Builder
+    from markdoc.parallel import job_count
+    
+    def relative_to(path, directory):
+        if path == directory or path.startswith(directory + p.sep):
+            return p.relpath(path, start=directory)
+        return None
+    
+    ignored = [config.temp_dir, config.html_dir, config.cache_dir,
+               config.shard_dir, generations_dir(config)]
+    documents, static_paths, full_scan = set(), set(), changed is None
+    for path in changed or ():
+        if any(relative_to(path, directory) for directory in ignored):
             continue
-        
-        log.debug("Generating listing for %s" % directory)
-        listing = builder.render_listing(directory)
-        list_filename = p.join(fs_dir, list_basename)
-        
-        fp = codecs.open(list_filename, 'w', encoding='utf-8')
-        try:
-            fp.write(listing)
-        finally:
-            fp.close()
-        
-        if not index_file_exists:
-            log.debug("cp %s/%s %s/%s" % (directory, list_basename, directory, 'index.html'))
-            shutil.copyfile(list_filename, p.join(fs_dir, 'index.html'))
+        elif relative_to(path, config.template_dir):
+            full_scan = True
+        elif relative_to(path, config.static_dir):
+            static_paths.add(relative_to(path, config.static_dir))
+        elif relative_to(path, config.wiki_dir):
+            documents.add(relative_to(path, config.wiki_dir))
+        else:
+            full_scan = True
+    
+    if static_paths or full_scan:
+        config.assets.scan()
+    
+    builder = Builder(config)
+    manifest = BuildManifest.for_config(config)
+    signature = build_signature(config)
+    
+    atomic = config['publish-mode'] == 'atomic'
+    output_dir = config.temp_dir
+    if atomic:
+        output_dir = current_generation(config)
+    
+    if p.curdir in static_paths or p.curdir in documents:
+        full_scan = True
+    
+    if full_scan or signature != manifest.signature:
+        plan = plan_build(config, manifest, builder.walk(),
+                          signature=signature, output_dir=output_dir)
+    elif documents or static_paths:
+        plan = plan_changes(config, manifest, documents, builder.is_document,
+                            output_dir=output_dir)
+        if not (plan or static_paths):
+            return None
+    else:
+        return None
+    
+    execute_plan(config, builder, manifest, plan, signature,
+                 jobs=job_count(config), static_paths=sorted(static_paths))
+    return plan
 
 
 ## Serving
@@ -333,6 +825,8 @@ def serve(config, args):
         config['server.name'] = args.server_name
     config['server.request-queue-size'] = args.queue_size
     config['server.timeout'] = args.timeout
+    if args.backend:
+        config['server.backend'] = args.backend
     if args.interface:
         if not IPV4_RE.match(args.interface):
             serve.parser.error('invalid interface specifier: %r' % args.interface)
@@ -340,6 +834,10 @@ def serve(config, args):
     
     server = config.server_maker()(app)
     
+    preloaded = app.preload()
+    if preloaded:
+        log.info('Preloaded %d files into the response cache' % preloaded)
+    
     try:
         log.info('Serving on http://%s:%d' % server.bind_addr)
         server.start()
@@ -348,6 +846,10 @@ def serve(config, args):
     finally:
         log.info('Shutting down gracefully')
         server.stop()
+        if app.cache is not None:
+            log.debug('Response cache: %d hits, %d misses' % (
+                app.cache.hits, app.cache.misses))
+        app.save_hits()
 
 serve.parser.add_argument('-p', '--port', type=int, default=8008,
     help="Listen on specified port (default is 8008)")
@@ -361,4 +863,7 @@ serve.parser.add_argument('-q', '--queue-size', type=int, default=5, metavar='SI
     help="Set request queue size (default is 5)")
 serve.parser.add_argument('--timeout', type=int, default=10,
     help="Set the socket timeout for connections (default is 10)")
+serve.parser.add_argument('-b', '--backend', choices=['cherrypy', 'async'],
+    default=None,
+    help="Serve with a CherryPy thread pool or a single-threaded event loop")
 
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+Precompressed variants of files in the HTML root.
+
+After a build, every HTML, CSS and JavaScript file in the HTML root above a
+certain size gets a gzipped copy alongside it (`index.html.gz`), and a Brotli
+one (`index.html.br`) if the `brotli` module is installed. A variant is only
+kept if it is actually smaller than the original. The WSGI server (or a
+suitably-configured front-end server) can then send these to clients which
+accept them, instead of compressing each response on the fly.
+
+The size and modification time of each variant's original, at the time the
+variant was made, are recorded in `.compressed.json` at the top of the root;
+a variant is only used (or kept) while its original still matches, so it only
+needs to be produced again when the original changes.
+"""
+
+import gzip
+import logging
+import os
+import os.path as p
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from markdoc.cache import write_to
+from markdoc.config import Config
+
+
+Config.register_default('compress.enabled', True)
+Config.register_default('compress.min-size', 1024)
+Config.register_default('compress.extensions', ['.html', '.css', '.js'])
+
+# `(encoding, suffix)` pairs, in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Records the original each variant was made from; see `variant_stamp()`.
+STAMPS_FILENAME = '.compressed.json'
+
+
+def gzip_data(data):
+    from cStringIO import StringIO
+    
+    buf = StringIO()
+    # A fixed mtime keeps the output identical for identical input.
+    fp = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0)
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    return buf.getvalue()
+
+
+def brotli_data(data):
+    import brotli
+    return brotli.compress(data, quality=11)
+
+
+def available_encodings():
+    """Return `(encoding, suffix, function)` for each usable compression."""
+    
+    encodings = []
+    for encoding, suffix in ENCODINGS:
+        if encoding == 'br':
+            try:
+                import brotli
+            except ImportError:
+                continue
+            encodings.append((encoding, suffix, brotli_data))
+        else:
+            encodings.append((encoding, suffix, gzip_data))
+    return encodings
+
+
+def variant_base(filename, extensions):
+    
+    """
+    If `filename` is a compressed variant, return its original's filename.
+    
+    Only variants of files with one of the given extensions count; anything
+    else (like a `.tar.gz` file in the static media) returns `None`.
+        
+        >>> variant_base('a/index.html.gz', ['.html'])
+        'a/index.html'
+        >>> variant_base('style.css.br', ['.css'])
+        'style.css'
+        >>> print variant_base('archive.tar.gz', ['.html'])
+        None
+        >>> print variant_base('index.html', ['.html'])
+        None
+    """
+    
+    for _, suffix in ENCODINGS:
+        if filename.endswith(suffix):
+            base = filename[:-len(suffix)]
+            if p.splitext(base)[1] in extensions:
+                return base
+    return None
+
+
+def variant_stamp(stat):
+    """Identify the version of an original which a variant was made from."""
+    
+    return [stat.st_size, stat.st_mtime]
+
+
+def load_stamps(root):
+    
+    """
+    Load the stamps of the variants beneath a root.
+    
+    Returns a dictionary mapping the relative path of each variant to the
+    `variant_stamp()` of its original, which is empty if there's no record.
+    """
+    
+    try:
+        fp = open(p.join(root, STAMPS_FILENAME))
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(fp)
+        except ValueError:
+            return {}
+    finally:
+        fp.close()
+
+
+class CompressStats(object):
+    
+    def __init__(self):
+        self.compressed = 0
+        self.linked = 0
+        self.unchanged = 0
+        self.removed = 0
+    
+    def __str__(self):
+        return '%d compressed, %d linked, %d unchanged, %d removed' % (
+            self.compressed, self.linked, self.unchanged, self.removed)
+
+
+class Compressor(object):
+    
+    """
+    Produces and prunes the compressed variants of files beneath a root.
+    
+    If `previous` is given (the previous generation of the HTML root, when
+    publishing atomically), variants of unchanged files are hard-linked from
+    there instead of being compressed again.
+    """
+    
+    def __init__(self, config, root, previous=None, log=None):
+        self.root = root
+        self.previous = previous
+        self.min_size = int(config['compress.min-size'])
+        self.extensions = frozenset(config['compress.extensions'])
+        self.encodings = available_encodings()
+        self.log = log or logging.getLogger('markdoc.compress')
+        self.stats = CompressStats()
+        # The stamps on record, and those which will be saved after a `run()`.
+        self.recorded = load_stamps(root)
+        self.stamps = dict(self.recorded)
+        self.previous_stamps = {}
+        if previous is not None:
+            self.previous_stamps = load_stamps(previous)
+    
+    def is_candidate(self, rel_path):
+        return (p.splitext(rel_path)[1] in self.extensions and
+                not p.basename(rel_path).startswith('.'))
+    
+    def run(self, paths=None):
+        
+        """
+        Bring the variants of some paths (relative to the root) up to date.
+        
+        If `paths` is `None`, the whole root is processed. Otherwise, each path
+        may be a file or a directory (which is processed in full); variants of
+        paths which no longer exist are removed.
+        """
+        
+        if paths is None:
+            # Only the variants found on the way will be remembered.
+            paths, self.stamps = [''], {}
+        for rel_path in paths:
+            rel_path = p.normpath(rel_path)
+            if rel_path == p.curdir:
+                rel_path = ''
+            filename = p.join(self.root, rel_path)
+            
+            if p.isdir(filename):
+                for dirpath, subdirs, files in os.walk(filename):
+                    subdirs[:] = [name for name in subdirs
+                                  if not name.startswith('.')]
+                    rel_dir = p.relpath(dirpath, start=self.root)
+                    for name in files:
+                        self.process(p.normpath(p.join(rel_dir, name)))
+            else:
+                self.process(rel_path)
+                for _, suffix in ENCODINGS:
+                    self.process(rel_path + suffix)
+        
+        if self.stamps != self.recorded:
+            write_to(p.join(self.root, STAMPS_FILENAME),
+                     json.dumps(self.stamps, sort_keys=True), encoding=None)
+        return self.stats
+    
+    def process(self, rel_path):
+        filename = p.join(self.root, rel_path)
+        base = variant_base(rel_path, self.extensions)
+        if base is not None:
+            # Remove variants whose original has gone.
+            if p.lexists(filename) and not p.exists(p.join(self.root, base)):
+                self.remove(filename, rel_path)
+        elif self.is_candidate(rel_path) and p.isfile(filename):
+            self.compress(rel_path)
+    
+    def compress(self, rel_path):
+        filename = p.join(self.root, rel_path)
+        stat = os.stat(filename)
+        
+        data = None
+        for encoding, suffix, function in self.encodings:
+            variant, rel_variant = filename + suffix, rel_path + suffix
+            if stat.st_size < self.min_size:
+                self.remove(variant, rel_variant)
+                continue
+            
+            if self.up_to_date(rel_variant, stat):
+                self.stats.unchanged += 1
+                continue
+            if self.link_previous(rel_path, suffix, stat):
+                continue
+            
+            if data is None:
+                fp = open(filename, 'rb')
+                try:
+                    data = fp.read()
+                finally:
+                    fp.close()
+            
+            compressed = function(data)
+            if len(compressed) >= len(data):
+                # Not worth it; make sure there's no stale variant.
+                self.remove(variant, rel_variant)
+                continue
+            
+            temp = p.join(p.dirname(variant), '.%s.new' % p.basename(variant))
+            fp = open(temp, 'wb')
+            try:
+                fp.write(compressed)
+            finally:
+                fp.close()
+            os.utime(temp, (stat.st_atime, stat.st_mtime))
+            os.rename(temp, variant)
+            self.stamps[rel_variant] = variant_stamp(stat)
+            self.log.debug('%s %s' % (encoding, rel_path))
+            self.stats.compressed += 1
+    
+    def up_to_date(self, rel_variant, stat):
+        """Check that a variant exists, and was made from the original as it is."""
+        
+        stamp = variant_stamp(stat)
+        if (self.recorded.get(rel_variant) != stamp or
+            not p.isfile(p.join(self.root, rel_variant))):
+            return False
+        self.stamps[rel_variant] = stamp
+        return True
+    
+    def link_previous(self, rel_path, suffix, stat):
+        if self.previous is None:
+            return False
+        
+        rel_variant = rel_path + suffix
+        previous = p.join(self.previous, rel_variant)
+        if (self.previous_stamps.get(rel_variant) != variant_stamp(stat) or
+            not p.isfile(previous)):
+            return False
+        
+        variant = p.join(self.root, rel_variant)
+        try:
+            if p.lexists(variant):
+                os.remove(variant)
+            os.link(previous, variant)
+        except OSError:
+            return False
+        self.stamps[rel_variant] = variant_stamp(stat)
+        self.stats.linked += 1
+        return True
+    
+    def remove(self, variant, rel_variant):
+        self.stamps.pop(rel_variant, None)
+        if p.lexists(variant):
+            self.log.debug('rm %s' % rel_variant)
+            os.remove(variant)
+            self.stats.removed += 1
+
+
+def compress_outputs(config, root=None, paths=None, previous=None, log=None):
+    
+    """
+    Update the compressed variants in the HTML root (or another `root`).
+    
+    Does nothing if `compress.enabled` is false. See `Compressor.run()` for
+    the meaning of `paths`. Returns a `CompressStats`, or `None`.
+    """
+    
+    if not config['compress.enabled']:
+        return None
+    if root is None:
+        root = config.html_dir
+    return Compressor(config, root, previous=previous, log=log).run(paths)
+
+
+def keep_variants(config):
+    """Return a `keep` callable for `sync()` which protects variants."""
+    
+    extensions = frozenset(config['compress.extensions'])
+    return lambda rel_path: variant_base(rel_path, extensions) is not None
@@ -6,12 +6,14 @@ import copy
 import os
 import os.path as p
 
-import markdown
-import yaml
-
 import markdoc.exc
 
 
+# Parsed and flattened configuration files, keyed by absolute filename; see
+# `Config.for_file()`.
+_file_cache = {}
+
+
 class ConfigNotFound(markdoc.exc.AbortError):
     """The configuration file was not found."""
     pass
@@ -62,6 +64,10 @@ class Config(dict):
     __metaclass__ = ConfigMeta
     
     def __init__(self, config_file, config):
+        # Values computed from the configuration (like the `paths` snapshot
+        # from `markdoc.directories`), which are thrown away whenever it's
+        # modified.
+        self._derived = {}
         super(Config, self).__init__(flatten(config))
         
         self['meta.config-file'] = config_file
@@ -71,19 +77,61 @@ class Config(dict):
         try:
             return dict.__getitem__(self, key)
         except KeyError:
+            # Filling in a default doesn't change the configuration, so it
+            # leaves the derived values alone.
             if key in self._defaults:
-                self[key] = copy.copy(self._defaults[key])
+                dict.__setitem__(self, key, copy.copy(self._defaults[key]))
             elif key in self._func_defaults:
-                self[key] = self._func_defaults[key](self, key)
+                dict.__setitem__(self, key, self._func_defaults[key](self, key))
             else:
                 raise
             return dict.__getitem__(self, key)
     
+    def __setitem__(self, key, value):
+        self._derived.clear()
+        dict.__setitem__(self, key, value)
+    
     def __delitem__(self, key):
         if (key not in self):
             return # fail silently.
+        self._derived.clear()
         return dict.__delitem__(self, key)
     
+    def update(self, *args, **kwargs):
+        self._derived.clear()
+        dict.update(self, *args, **kwargs)
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._derived.clear()
+        return dict.setdefault(self, key, default)
+    
+    def pop(self, key, *default):
+        self._derived.clear()
+        return dict.pop(self, key, *default)
+    
+    def popitem(self):
+        self._derived.clear()
+        return dict.popitem(self)
+    
+    def clear(self):
+        self._derived.clear()
+        dict.clear(self)
+    
+    def copy(self):
+        """Return a shallow copy of this config, as another `Config`."""
+        
+        config = type(self)(self['meta.config-file'], {})
+        config.update(self)
+        return config
+    
+    def __reduce__(self):
+        # Pickled (as for worker processes) as a fresh config with the same
+        # settings, so that `__init__()` runs before they're restored, and
+        # derived values and cached attributes are left behind.
+        return (type(self), (self['meta.config-file'], {}), None, None,
+                self.iteritems())
+    
     @classmethod
     def for_directory(cls, directory=None):
         
@@ -105,7 +153,15 @@ class Config(dict):
     
     @classmethod
     def for_file(cls, filename):
-        """Get the configuration from a given YAML file."""
+        
+        """
+        Get the configuration from a given YAML file.
+        
+        The parsed (and flattened) file is cached for as long as its size and
+        modification time stay the same, so loading the same file again, as
+        the `watch` command and long-running servers may do, doesn't need to
+        parse it again. Each call still returns a new, independent `Config`.
+        """
         
         if not p.exists(filename):
             relpath = p.relpath(p.dirname(filename), start=os.getcwd())
@@ -114,13 +170,39 @@ class Config(dict):
                 raise ConfigNotFound("%s was not found in the current directory" % basename)
             raise ConfigNotFound("%s was not found in %s" % (basename, relpath))
         
-        fp = open(filename)
-        try:
-            config = yaml.load(fp) or {}
-        finally:
-            fp.close()
+        stat = os.stat(filename)
+        key = (stat.st_mtime, stat.st_size)
+        cached = _file_cache.get(p.abspath(filename))
+        if cached is None or cached[0] != key:
+            cached = (key, flatten(load_yaml(filename)))
+            _file_cache[p.abspath(filename)] = cached
         
-        return cls(filename, config)
+        # Values (such as lists) may be modified in place, so each config gets
+        # its own copy.
+        return cls(filename, copy.deepcopy(cached[1]))
+
+
+def load_yaml(filename):
+    
+    """
+    Parse a YAML file, returning an empty dictionary if it's empty.
+    
+    Only plain YAML (no Python-specific tags) is accepted. libyaml's parser is
+    used if PyYAML was built with it, since it's many times faster than the
+    pure-Python one.
+    """
+    
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    
+    fp = open(filename)
+    try:
+        return yaml.load(fp, Loader=SafeLoader) or {}
+    finally:
+        fp.close()
 
 
 def flatten(dictionary, prefix=''):
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
 import os.path as p
 
+import markdoc
 from markdoc.config import Config
 
 
@@ -23,22 +25,73 @@ def temp_dir(config):
         config.get('temp-dir', config['hide-prefix'] + 'tmp')))
 
 
+def cache_dir(config):
+    return p.abspath(p.join(config['meta.root'],
+        config.get('cache-dir', config['hide-prefix'] + 'cache')))
+
+
+def shard_dir(config):
+    return p.abspath(p.join(config['meta.root'],
+        config.get('shard-dir', config['hide-prefix'] + 'shards')))
+
+
 def template_dir(config):
     return p.abspath(p.join(config['meta.root'],
         config.get('template-dir', config['hide-prefix'] + 'templates')))
 
 
+def static_sources(config):
+    """Return the directories static media is synced from, in order."""
+    
+    sources = []
+    if config['use-default-static']:
+        sources.append(markdoc.default_static_dir)
+    if p.isdir(config.static_dir):
+        sources.append(config.static_dir)
+    return sources
+
+
 Config.register_default('hide-prefix', '.')
 Config.register_default('use-default-static', True)
+Config.register_default('use-default-templates', True)
 Config.register_default('cvs-exclude', True)
 Config.register_func_default('html-dir', lambda cfg, key: html_dir(cfg))
 Config.register_func_default('static-dir', lambda cfg, key: static_dir(cfg))
 Config.register_func_default('wiki-dir', lambda cfg, key: wiki_dir(cfg))
 Config.register_func_default('temp-dir', lambda cfg, key: temp_dir(cfg))
 Config.register_func_default('template-dir', lambda cfg, key: template_dir(cfg))
+Config.register_func_default('cache-dir', lambda cfg, key: cache_dir(cfg))
+Config.register_func_default('shard-dir', lambda cfg, key: shard_dir(cfg))
+
+
+Paths = namedtuple('Paths', ['html_dir', 'static_dir', 'wiki_dir', 'temp_dir',
+                             'template_dir', 'cache_dir', 'shard_dir'])
+
+
+def paths(config):
+    
+    """
+    Return a snapshot of the absolute paths of a wiki's directories.
+    
+    The paths are worked out once and kept until the config is next modified,
+    so the `Config.html_dir` (etc.) properties, which are read on every
+    request by the server and for every document by the builder, are simple
+    lookups.
+    """
+    
+    snapshot = config._derived.get('paths')
+    if snapshot is None:
+        snapshot = config._derived['paths'] = Paths(
+            html_dir(config), static_dir(config), wiki_dir(config),
+            temp_dir(config), template_dir(config), cache_dir(config),
+            shard_dir(config))
+    return snapshot
 
-Config.html_dir = property(html_dir)
-Config.static_dir = property(static_dir)
-Config.wiki_dir = property(wiki_dir)
-Config.temp_dir = property(temp_dir)
-Config.template_dir = property(template_dir)
+Config.paths = property(paths)
+Config.html_dir = property(lambda config: paths(config).html_dir)
+Config.static_dir = property(lambda config: paths(config).static_dir)
+Config.wiki_dir = property(lambda config: paths(config).wiki_dir)
+Config.temp_dir = property(lambda config: paths(config).temp_dir)
+Config.template_dir = property(lambda config: paths(config).template_dir)
+Config.cache_dir = property(lambda config: paths(config).cache_dir)
+Config.shard_dir = property(lambda config: paths(config).shard_dir)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""Generation of directory listings from build metadata."""
+
+import hashlib
+import logging
+import os
+import os.path as p
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from markdoc.cache import write_to
+
+
+LISTING_STATE_FILENAME = '.listings.json'
+
+
+class ListingState(object):
+    
+    """
+    The digests of the listings generated by the last build.
+    
+    For each directory in the HTML root, this holds a digest of the template
+    context its listing was rendered from, along with the build signature (see
+    `markdoc.manifest.build_signature()`) of the build in question. A listing
+    only needs to be re-rendered if its digest or the signature has changed.
+    """
+    
+    def __init__(self, filename, signature=None, digests=None):
+        self.filename = filename
+        self.signature = signature
+        self.digests = digests or {}
+    
+    @classmethod
+    def for_config(cls, config):
+        filename = p.join(config.temp_dir, LISTING_STATE_FILENAME)
+        if not p.isfile(filename):
+            return cls(filename)
+        
+        fp = open(filename)
+        try:
+            try:
+                data = json.load(fp)
+            except ValueError:
+                return cls(filename)
+        finally:
+            fp.close()
+        return cls(filename, signature=data.get('signature'),
+                   digests=data.get('digests'))
+    
+    def save(self):
+        directory = p.dirname(self.filename)
+        if not p.isdir(directory):
+            os.makedirs(directory)
+        write_to(self.filename, json.dumps(
+            {'signature': self.signature, 'digests': self.digests},
+            sort_keys=True), encoding=None)
+
+
+def picklable_context(context):
+    """Strip the `make_relative` callable from a listing context."""
+    
+    context = dict(context)
+    context.pop('make_relative', None)
+    return context
+
+
+def context_digest(context, index_file_exists):
+    """Return a digest of everything which a listing is rendered from."""
+    
+    data = json.dumps([index_file_exists, picklable_context(context)],
+                      sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def html_directories(html_dir, top=None):
+    """Yield `(fs_dir, directory)` for every directory in the HTML root."""
+    
+    for fs_dir, subdirs, _ in os.walk(top or html_dir):
+        subdirs.sort()
+        directory = '/' + '/'.join(p.relpath(fs_dir, start=html_dir).split(p.sep))
+        if directory == '/' + p.curdir:
+            directory = '/'
+        yield fs_dir, directory
+
+
+def affected_directories(html_dir, paths):
+    
+    """
+    Return the directories whose listings may be changed by the given paths.
+    
+    `paths` are relative to the HTML root. The result holds every directory
+    containing one of them, along with each path which is itself a directory
+    (and all the directories beneath it), in the form used by
+    `generate_listings()`.
+    """
+    
+    directories = set(['/'])
+    for path in paths:
+        components = p.normpath(path).split(p.sep)
+        for i in range(1, len(components)):
+            directories.add('/' + '/'.join(components[:i]))
+        
+        fs_dir = p.join(html_dir, path)
+        if p.isdir(fs_dir):
+            for _, directory in html_directories(html_dir, fs_dir):
+                directories.add(directory)
+    return directories
+
+
+def has_index(config, fs_dir, directory, index=None):
+    
+    """
+    Determine whether a directory has an index page of its own.
+    
+    That is, an `index.html` (or `index`) which comes from a document or from
+    the static media, as opposed to one copied from the directory's listing.
+    Given the build manifest's `index`, this is decided from the documents and
+    static directories, since a copied listing stays in the HTML root after the
+    build which made it; without one, only the HTML root can be checked.
+    """
+    
+    from markdoc.directories import static_sources
+    
+    if index is None:
+        return (p.exists(p.join(fs_dir, 'index.html')) or
+                p.exists(p.join(fs_dir, 'index')))
+    
+    rel_dir = p.sep.join(directory.strip('/').split('/'))
+    if p.join(rel_dir, 'index.html') in index:
+        return True
+    for source in static_sources(config):
+        if (p.exists(p.join(source, rel_dir, 'index.html')) or
+            p.exists(p.join(source, rel_dir, 'index'))):
+            return True
+    return False
+
+
+def generate_listings(config, builder, index=None, signature=None, jobs=1,
+                      previous=None, directories=None):
+    
+    """
+    Create listings for all directories in the HTML root.
+    
+    `index` maps page filenames to their entries in the build manifest (see
+    `BuildManifest.index()`); page titles and sizes are taken from there rather
+    than by reading back the HTML. Listings whose context is unchanged since
+    the last build are left alone, or (when building a new generation of the
+    HTML root) linked from the `previous` generation; the remainder are
+    rendered in parallel across `jobs` processes.
+    
+    If a set of `directories` is given (see `affected_directories()`), only
+    their listings are considered; those of all other directories are assumed
+    to be up to date.
+    """
+    
+    from markdoc.parallel import render_listings
+    from markdoc.publish import link_or_copy
+    
+    log = logging.getLogger('markdoc.build-listing')
+    
+    generate_listing = config.get('generate-listing', 'always').lower()
+    if generate_listing == 'never':
+        log.debug("No listing generated (generate-listing == never)")
+        return # No need to continue.
+    
+    if signature is None:
+        from markdoc.manifest import build_signature
+        signature = build_signature(config)
+    
+    list_basename = config['listing-filename']
+    state = ListingState.for_config(config)
+    if state.signature != signature:
+        state.digests = {}
+        directories = None
+    
+    if directories is None:
+        targets = html_directories(config.html_dir)
+        digests = {}
+    else:
+        targets = []
+        for directory in sorted(directories):
+            fs_dir = p.join(config.html_dir, *directory.strip('/').split('/'))
+            if p.isdir(fs_dir):
+                targets.append((fs_dir, directory))
+        # Carry over the digests of everything else which still exists.
+        digests = dict((directory, digest)
+                       for directory, digest in state.digests.iteritems()
+                       if directory not in directories or
+                       p.isdir(p.join(config.html_dir,
+                                      *directory.strip('/').split('/'))))
+    
+    def copy_to_index(fs_dir, directory):
+        list_filename = p.join(fs_dir, list_basename)
+        index_filename = p.join(fs_dir, 'index.html')
+        if (p.exists(index_filename) and
+            p.samestat(os.stat(list_filename), os.stat(index_filename))):
+            return
+        log.debug("cp %s/%s %s/%s" % (directory, list_basename, directory, 'index.html'))
+        # Replace any index copied by an earlier build in a single step.
+        temp = p.join(fs_dir, '.index.html.new')
+        if p.lexists(temp):
+            os.remove(temp)
+        link_or_copy(list_filename, temp)
+        os.rename(temp, index_filename)
+    
+    to_render, index_exists = [], {}
+    for fs_dir, directory in targets:
+        index_file_exists = has_index(config, fs_dir, directory, index=index)
+        
+        if (generate_listing == 'sometimes') and index_file_exists:
+            log.debug("No listing generated for %s" % directory)
+            digests.pop(directory, None)
+            continue
+        
+        context = builder.listing_context(directory, index=index)
+        digest = digests[directory] = context_digest(context, index_file_exists)
+        
+        list_filename = p.join(fs_dir, list_basename)
+        if state.digests.get(directory) == digest:
+            if previous is not None and not p.exists(list_filename):
+                rel_dir = p.relpath(fs_dir, start=config.html_dir)
+                previous_list = p.join(previous, rel_dir, list_basename)
+                if p.exists(previous_list):
+                    link_or_copy(previous_list, list_filename)
+            
+            if p.exists(list_filename):
+                log.debug("Listing unchanged for %s" % directory)
+                if not index_file_exists:
+                    copy_to_index(fs_dir, directory)
+                continue
+        
+        to_render.append((directory, picklable_context(context)))
+        index_exists[directory] = (fs_dir, index_file_exists)
+    
+    for directory, listing in render_listings(builder, to_render, jobs):
+        log.debug("Generating listing for %s" % directory)
+        fs_dir, index_file_exists = index_exists[directory]
+        write_to(p.join(fs_dir, list_basename), listing)
+        if not index_file_exists:
+            copy_to_index(fs_dir, directory)
+    
+    state.signature = signature
+    state.digests = digests
+    state.save()
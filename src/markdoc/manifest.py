@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent build manifests, used to drive incremental builds."""
+
+import hashlib
+import os
+import os.path as p
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import markdoc
+from markdoc.config import Config
+
+
+Config.register_default('manifest-filename', '.manifest.json')
+
+# Keys which have no bearing on the rendered output of a wiki.
+IGNORED_CONFIG_PREFIXES = ('meta.', 'server.', 'cache.', 'sync.', 'watch.',
+                           'compress.', 'templates.',
+                           'build-jobs', 'publish-keep', 'shard-dir')
+
+
+class BuildManifest(object):
+    
+    """
+    A record of the inputs to the last successful build of a wiki.
+    
+    The manifest is stored as a JSON file in the temporary directory. For each
+    source document it holds the file's modification time, size and a SHA-1
+    digest of its content, along with the name of the rendered output (relative
+    to the temporary directory). It also holds a single *signature* for the
+    template set and the output-affecting parts of the configuration; if that
+    changes, every document needs to be rebuilt.
+    
+    Finally, `static` lists the files (relative to the HTML root) which were
+    synced from the static directories, so that files removed from them can be
+    removed from the HTML root without walking it; it's `None` if unknown.
+    """
+    
+    version = 2
+    
+    def __init__(self, filename, documents=None, signature=None, static=None):
+        self.filename = filename
+        self.documents = documents or {}
+        self.signature = signature
+        self.static = static
+    
+    @classmethod
+    def for_config(cls, config):
+        """Load the manifest for a given config, or an empty one."""
+        
+        return cls.load(manifest_filename(config))
+    
+    @classmethod
+    def load(cls, filename):
+        """Load a manifest from a file, returning an empty one on failure."""
+        
+        if not p.isfile(filename):
+            return cls(filename)
+        
+        fp = open(filename)
+        try:
+            try:
+                data = json.load(fp)
+            except ValueError:
+                return cls(filename)
+        finally:
+            fp.close()
+        
+        if data.get('version') != cls.version:
+            return cls(filename)
+        return cls(filename, documents=data.get('documents'),
+                   signature=data.get('signature'), static=data.get('static'))
+    
+    def save(self):
+        """Atomically write the manifest back to its file."""
+        
+        data = {'version': self.version,
+                'signature': self.signature,
+                'documents': self.documents,
+                'static': self.static}
+        
+        directory = p.dirname(self.filename)
+        if not p.isdir(directory):
+            os.makedirs(directory)
+        
+        temp_filename = self.filename + '.new'
+        fp = open(temp_filename, 'w')
+        try:
+            json.dump(data, fp, sort_keys=True)
+        finally:
+            fp.close()
+        os.rename(temp_filename, self.filename)
+    
+    def record(self, path, abs_path, output, digest=None, title=None,
+               output_size=None, metadata=None):
+        
+        """
+        Record the current state of a source document and its output.
+        
+        Besides the source's state, each entry also holds the title and size
+        (in bytes) of the output, so that listings can be generated without
+        reading back every page, and the document's metadata (as produced by
+        `DocumentMetadata.to_dict()`).
+        """
+        
+        stat = os.stat(abs_path)
+        if digest is None:
+            digest = file_digest(abs_path)
+        self.documents[path] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'digest': digest,
+            'output': output,
+            'title': title,
+            'output_size': output_size,
+            'metadata': metadata}
+    
+    def touch(self, path, abs_path, digest):
+        """Update the entry for a document whose content hasn't changed."""
+        
+        entry = self.documents[path]
+        self.record(path, abs_path, entry['output'], digest=digest,
+                    title=entry.get('title'), output_size=entry.get('output_size'),
+                    metadata=entry.get('metadata'))
+    
+    def index(self):
+        """Return a dictionary mapping output filenames to entries."""
+        
+        return dict((entry['output'], entry)
+                    for entry in self.documents.itervalues()
+                    if entry.get('output_size') is not None)
+    
+    def forget(self, path):
+        self.documents.pop(path, None)
+
+
+class BuildPlan(object):
+    
+    """
+    The set of actions needed to bring a build up to date.
+    
+    `render` is a list of `(path, reason)` pairs for documents which need to be
+    (re-)rendered, where `reason` is one of `'new'`, `'changed'`, `'missing'`
+    (the output has disappeared) or `'rebuild'` (a full rebuild is needed).
+    `removed` is a list of `(path, output)` pairs for documents which no longer
+    exist. `unchanged` lists the documents which can be left as they are, and
+    `touched` maps documents whose mtime changed without their content changing
+    to their new digest.
+    
+    A *partial* plan (see `plan_changes()`) only covers the documents known to
+    have changed; everything else in the manifest is assumed to be unchanged.
+    A plan for merging shards (see `markdoc.shard.plan_merge()`) instead lists
+    documents which have already been rendered elsewhere in `merged`.
+    """
+    
+    def __init__(self, full=False, partial=False):
+        self.full = full
+        self.partial = partial
+        self.render = []
+        self.removed = []
+        self.unchanged = []
+        self.touched = {}
+        self.merged = []
+    
+    def __nonzero__(self):
+        return bool(self.full or self.render or self.removed or self.merged)
+    
+    def lines(self):
+        """Yield human-readable lines describing this plan."""
+        
+        if self.full:
+            yield 'full rebuild (templates or configuration changed)'
+        for path, reason in self.render:
+            yield '%-8s %s' % (reason, path)
+        for path, _, _ in self.merged:
+            yield '%-8s %s' % ('merged', path)
+        for path, output in self.removed:
+            yield '%-8s %s' % ('removed', path)
+
+
+def output_name(path):
+    """Return the output filename (relative) for a relative document path."""
+    
+    return p.splitext(path)[0] + p.extsep + 'html'
+
+
+def file_digest(filename):
+    """Return the hex SHA-1 digest of a file's contents."""
+    
+    digest = hashlib.sha1()
+    fp = open(filename, 'rb')
+    try:
+        data = fp.read(65536)
+        while data:
+            digest.update(data)
+            data = fp.read(65536)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+
+def manifest_filename(config):
+    """Return the filename of the build manifest for a config."""
+    
+    return p.join(config.temp_dir, config['manifest-filename'])
+
+
+def template_paths(config):
+    """Yield the absolute paths of all templates in the template load path."""
+    
+    load_path = []
+    if p.isdir(config.template_dir):
+        load_path.append(config.template_dir)
+    if config['use-default-templates']:
+        load_path.append(markdoc.default_template_dir)
+    
+    for directory in load_path:
+        for dirpath, subdirs, files in os.walk(directory):
+            subdirs.sort()
+            for filename in sorted(files):
+                yield p.join(dirpath, filename)
+
+
+def explicit_settings(config):
+    
+    """
+    Yield the `(key, value)` pairs of a config which differ from the defaults.
+    
+    Defaults are stored in a config when they are first accessed, and they may
+    be registered by modules which haven't been imported yet, so comparing
+    against them keeps the result independent of both.
+    """
+    
+    for key in sorted(config):
+        # This is just the unflattened form of the
+        # `markdown.extension-configs.*` keys, and is mutated as such.
+        if (key.startswith(IGNORED_CONFIG_PREFIXES) or
+            key == 'markdown.extension-configs'):
+            continue
+        
+        value = config[key]
+        if key in Config._defaults and value == Config._defaults[key]:
+            continue
+        elif (key in Config._func_defaults and
+              value == Config._func_defaults[key](config, key)):
+            continue
+        yield key, value
+
+
+def build_signature(config):
+    
+    """
+    Return a digest of everything besides the documents which affects output.
+    
+    This covers the Markdoc version, every template which could be loaded (by
+    path, modification time and size) and every explicitly-set configuration
+    key except for those (like `meta.*` and `server.*`) which don't affect the
+    output. Because `publish-mode` is included, switching between publishing
+    modes forces a full rebuild. So does a change to the fingerprinted name of
+    any static file (see `markdoc.assets`), since pages link to those names.
+    """
+    
+    digest = hashlib.sha1()
+    digest.update('markdoc %s\n' % markdoc.__version__)
+    
+    if config.assets.enabled:
+        digest.update('assets %s\n' % config.assets.digest())
+    
+    for filename in template_paths(config):
+        stat = os.stat(filename)
+        digest.update('template %s %r %d\n' % (filename, stat.st_mtime, stat.st_size))
+    
+    for key, value in explicit_settings(config):
+        digest.update('config %s %r\n' % (key, value))
+    
+    return digest.hexdigest()
+
+
+def plan_build(config, manifest, documents, signature=None, force=False,
+               output_dir=False):
+    
+    """
+    Work out what needs to be done to update a build.
+    
+    `documents` is an iterable of document paths relative to the wiki
+    directory (as produced by `Builder.walk()`). Previous outputs are looked
+    for in `output_dir`, which defaults to the temporary directory; if it is
+    `None`, there are no previous outputs and everything will be rendered.
+    Returns a `BuildPlan`.
+    """
+    
+    if signature is None:
+        signature = build_signature(config)
+    if output_dir is False:
+        output_dir = config.temp_dir
+    
+    plan = BuildPlan(full=(force or signature != manifest.signature))
+    
+    seen = set()
+    for path in documents:
+        seen.add(path)
+        check_document(config, plan, manifest, path, output_dir)
+    
+    for path in sorted(set(manifest.documents) - seen):
+        plan.removed.append((path, manifest.documents[path]['output']))
+    
+    return plan
+
+
+def plan_changes(config, manifest, paths, is_document, output_dir=False):
+    
+    """
+    Work out what needs to be done after a known set of paths have changed.
+    
+    `paths` are relative to the wiki directory, and may name documents or
+    directories which have been created, modified or deleted; `is_document` is
+    a callable which says whether a relative path is a document (see
+    `Builder.is_document()`). Only those paths are examined, so the result is a
+    partial `BuildPlan`. The caller is responsible for checking that the build
+    signature hasn't changed.
+    """
+    
+    if output_dir is False:
+        output_dir = config.temp_dir
+    
+    plan = BuildPlan(partial=True)
+    seen = set()
+    
+    def examine(path):
+        if path in seen:
+            return
+        seen.add(path)
+        if p.isfile(p.join(config.wiki_dir, path)):
+            check_document(config, plan, manifest, path, output_dir)
+        elif path in manifest.documents:
+            plan.removed.append((path, manifest.documents[path]['output']))
+    
+    for path in sorted(set(p.normpath(path) for path in paths)):
+        abs_path = p.join(config.wiki_dir, path)
+        if p.isdir(abs_path):
+            for dirpath, subdirs, files in os.walk(abs_path):
+                subdirs[:] = sorted(name for name in subdirs
+                                    if not name.startswith('.'))
+                for filename in sorted(files):
+                    rel_path = p.relpath(p.join(dirpath, filename),
+                                         start=config.wiki_dir)
+                    if is_document(rel_path):
+                        examine(rel_path)
+        
+        # Documents which used to be at or beneath this path.
+        prefix = path + p.sep
+        for known in sorted(manifest.documents):
+            if known == path or known.startswith(prefix):
+                examine(known)
+        if is_document(path):
+            examine(path)
+    
+    plan.unchanged.extend(sorted(set(manifest.documents) - seen))
+    return plan
+
+
+def check_document(config, plan, manifest, path, output_dir):
+    """Add a single existing document to a `BuildPlan`."""
+    
+    entry = manifest.documents.get(path)
+    
+    if plan.full:
+        plan.render.append((path, 'rebuild'))
+        return
+    elif entry is None:
+        plan.render.append((path, 'new'))
+        return
+    
+    if output_dir is None or not p.exists(p.join(output_dir, entry['output'])):
+        plan.render.append((path, 'missing'))
+        return
+    
+    abs_path = p.join(config.wiki_dir, path)
+    stat = os.stat(abs_path)
+    if stat.st_size != entry['size']:
+        plan.render.append((path, 'changed'))
+    elif stat.st_mtime == entry['mtime']:
+        plan.unchanged.append(path)
+    else:
+        # Only the mtime has changed; check the content itself.
+        digest = file_digest(abs_path)
+        if digest == entry['digest']:
+            plan.unchanged.append(path)
+            plan.touched[path] = digest
+        else:
+            plan.render.append((path, 'changed'))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Render documents across several processes."""
+
+import os
+import os.path as p
+import traceback
+
+from markdoc.builder import Builder, RenderError
+from markdoc.cache import write_stream
+from markdoc.config import Config
+
+
+# Each worker process holds its own `Builder` (and hence its own `Config`,
+# caches and template environment) in this global.
+_worker_builder = None
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def job_count(config, jobs=None):
+    
+    """
+    Resolve the number of rendering processes to use.
+    
+    An explicit `jobs` value (e.g. from the command line) takes precedence over
+    the `build-jobs` setting. A value of 0 means 'one per CPU core'.
+    """
+    
+    if jobs is None:
+        jobs = config['build-jobs']
+    jobs = int(jobs)
+    if jobs <= 0:
+        jobs = cpu_count()
+    return jobs
+
+
+def init_worker(config_file, config_items):
+    """Set up the `Builder` for a worker process."""
+    
+    global _worker_builder
+    config = Config(config_file, {})
+    config.update(config_items)
+    _worker_builder = Builder(config)
+
+
+def call_in_worker(task):
+    """Run a single task, returning `(key, result, error)`."""
+    
+    function, key, arg = task
+    try:
+        return key, function(_worker_builder, arg), None
+    except Exception:
+        return key, None, traceback.format_exc()
+
+
+def run_tasks(builder, function, tasks, jobs=1):
+    
+    """
+    Run `function(builder, arg)` for several tasks, yielding results in order.
+    
+    `tasks` is a sequence of `(key, arg)` pairs, and `(key, result)` pairs are
+    yielded. If `jobs` is greater than 1, the tasks are fanned out to a pool of
+    that many worker processes, each with its own `Builder` for a copy of the
+    builder's configuration (so `function` and `arg` must be picklable).
+    Results are always yielded in the same order as `tasks`, so output can be
+    written deterministically. Any failure is raised as a `RenderError` which
+    carries the key of the failing task.
+    """
+    
+    tasks = list(tasks)
+    
+    if jobs <= 1 or len(tasks) <= 1:
+        for key, arg in tasks:
+            try:
+                result = function(builder, arg)
+            except Exception:
+                raise RenderError(key, traceback.format_exc())
+            yield key, result
+        return
+    
+    import multiprocessing
+    
+    config = builder.config
+    pool = multiprocessing.Pool(jobs, init_worker,
+                                (config['meta.config-file'], dict(config)))
+    chunksize = max(1, min(32, len(tasks) // (jobs * 4)))
+    
+    finished = False
+    try:
+        results = pool.imap(call_in_worker,
+                            [(function, key, arg) for key, arg in tasks],
+                            chunksize)
+        for key, result, error in results:
+            if error is not None:
+                raise RenderError(key, error)
+            yield key, result
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def write_document(builder, task):
+    
+    """
+    Render a document straight into its output file.
+    
+    `task` is a `(path, filename)` pair. The page is streamed from the template
+    to the file, so it never needs to be held in memory (or sent back from a
+    worker process) as a whole. Returns `(size, metadata)`.
+    """
+    
+    path, filename = task
+    directory = p.dirname(filename)
+    if not p.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker may have created it in the meantime.
+            if not p.isdir(directory):
+                raise
+    size = write_stream(filename, builder.stream_document(path))
+    return size, builder.metadata(path)
+
+
+def profile_document(builder, task):
+    
+    """
+    Write a document as `write_document()` does, but also time each stage.
+    
+    Each stage fills the builder's in-memory caches for the next, so the time
+    for `markdown` doesn't include reading the document again, and so on;
+    `output` covers rendering the template and writing the file, since the
+    two are interleaved. Returns `(size, metadata, timings)`.
+    """
+    
+    from markdoc.profile import Timings
+    
+    path, filename = task
+    timings = Timings()
+    with timings.time('read'):
+        builder.doc_cache.get(path)
+    with timings.time('markdown'):
+        builder.metadata(path)
+    with timings.time('output'):
+        size, metadata = write_document(builder, task)
+    return size, metadata, timings
+
+
+def render_listing(builder, task):
+    directory, context = task
+    return builder.render_listing(directory, context=context)
+
+
+def render_documents(builder, outputs, jobs=1, profile=None):
+    
+    """
+    Render documents to files, yielding `(path, size, metadata)` in order.
+    
+    `outputs` is a sequence of `(path, filename)` pairs, giving the absolute
+    filename to write each document to. If a `BuildProfile` is given, the time
+    spent on each document is recorded in it.
+    """
+    
+    tasks = [(path, (path, filename)) for path, filename in outputs]
+    if profile is None:
+        for path, (size, metadata) in run_tasks(builder, write_document, tasks, jobs):
+            yield path, size, metadata
+        return
+    
+    for path, (size, metadata, timings) in run_tasks(builder, profile_document,
+                                                     tasks, jobs):
+        profile.documents[path] = timings
+        yield path, size, metadata
+
+
+def render_listings(builder, listings, jobs=1):
+    
+    """
+    Render directory listings, yielding `(directory, html)` pairs in order.
+    
+    `listings` is a sequence of `(directory, context)` pairs, where each context
+    is as produced by `Builder.listing_context()` minus the (unpicklable)
+    `make_relative` callable.
+    """
+    
+    tasks = [(directory, (directory, context)) for directory, context in listings]
+    return run_tasks(builder, render_listing, tasks, jobs)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Timing of builds, by stage and by document (for `markdoc build --profile`)."""
+
+from contextlib import contextmanager
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import markdoc
+
+
+def cpu_time():
+    """Return the user plus system CPU time used by this process."""
+    
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Timings(object):
+    
+    """
+    Wall-clock and CPU time accumulated under a set of names.
+    
+    Use `timings.time(name)` as a context manager to time a block of code;
+    repeated blocks with the same name are added together. `items()` returns
+    `(name, wall, cpu)` triples in the order the names were first used.
+    """
+    
+    def __init__(self):
+        self.names = []
+        self.totals = {}
+    
+    @contextmanager
+    def time(self, name):
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - wall, cpu_time() - cpu)
+    
+    def add(self, name, wall, cpu):
+        if name not in self.totals:
+            self.names.append(name)
+            self.totals[name] = (0.0, 0.0)
+        old_wall, old_cpu = self.totals[name]
+        self.totals[name] = (old_wall + wall, old_cpu + cpu)
+    
+    def items(self):
+        return [(name,) + self.totals[name] for name in self.names]
+    
+    def total(self):
+        return (sum(wall for wall, _ in self.totals.itervalues()),
+                sum(cpu for _, cpu in self.totals.itervalues()))
+
+
+class BuildProfile(object):
+    
+    """
+    A record of where the time in a build went.
+    
+    Stages (such as `render`, `sync` and `listings`) are timed in the building
+    process, so their CPU times don't include work done by other rendering
+    processes. The time taken to read, convert, template and write out each
+    document is measured by whichever process renders it (writing is part of
+    its `output` stage), and sent back along with the document.
+    """
+    
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.started = time.time()
+        self.stages = Timings()
+        self.documents = {}
+    
+    def stage(self, name):
+        return self.stages.time(name)
+    
+    def slowest(self, count=10):
+        """Return the `count` slowest documents as `(path, Timings)` pairs."""
+        
+        documents = sorted(self.documents.iteritems(),
+                           key=lambda item: item[1].total()[0],
+                           reverse=True)
+        return documents[:count]
+    
+    def report(self, top=10):
+        """Yield the lines of a human-readable report."""
+        
+        wall, cpu = self.stages.total()
+        yield '%-24s %10s %10s' % ('stage', 'wall (s)', 'cpu (s)')
+        for name, stage_wall, stage_cpu in self.stages.items():
+            yield '%-24s %10.3f %10.3f' % (name, stage_wall, stage_cpu)
+        yield '%-24s %10.3f %10.3f' % ('total', wall, cpu)
+        
+        if not self.documents:
+            return
+        
+        names = []
+        for timings in self.documents.itervalues():
+            names.extend(name for name in timings.names if name not in names)
+        
+        yield ''
+        yield 'slowest %d of %d documents (wall time, ms):' % (
+            min(top, len(self.documents)), len(self.documents))
+        yield '%-40s %9s' % ('document', 'total') + ''.join(
+            ' %9s' % name for name in names)
+        for path, timings in self.slowest(top):
+            if len(path) > 40:
+                path = '...' + path[-37:]
+            yield '%-40s %9.1f' % (path, 1000 * timings.total()[0]) + ''.join(
+                ' %9.1f' % (1000 * timings.totals.get(name, (0, 0))[0])
+                for name in names)
+    
+    def to_dict(self):
+        def timings_dict(timings):
+            result = dict((name, {'wall': wall, 'cpu': cpu})
+                          for name, wall, cpu in timings.items())
+            wall, cpu = timings.total()
+            result['total'] = {'wall': wall, 'cpu': cpu}
+            return result
+        
+        wall, cpu = self.stages.total()
+        return {
+            'markdoc': markdoc.__version__,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                     time.localtime(self.started)),
+            'jobs': self.jobs,
+            'total': {'wall': wall, 'cpu': cpu},
+            'stages': [{'name': name, 'wall': stage_wall, 'cpu': stage_cpu}
+                       for name, stage_wall, stage_cpu in self.stages.items()],
+            'documents': dict((path, timings_dict(timings))
+                              for path, timings in self.documents.iteritems())}
+    
+    def save(self, filename):
+        """Write the profile to a file, as JSON."""
+        
+        fp = open(filename, 'w')
+        try:
+            json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+
+
+@contextmanager
+def no_profile(name):
+    """A stand-in for `BuildProfile.stage()` when not profiling."""
+    
+    yield
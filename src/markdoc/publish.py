@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Atomic publishing of builds into the HTML root.
+
+In the `atomic` publish mode, every build is rendered into a fresh *generation*
+directory, and the HTML root is a symbolic link to the current generation. Once
+a generation is complete, the link is replaced in a single `rename()`, so a
+running server sees either the old tree or the new one, never a mixture. Files
+which haven't changed since the previous generation are hard-linked into the
+new one rather than written again.
+"""
+
+import logging
+import os
+import os.path as p
+import shutil
+import tempfile
+import time
+
+from markdoc.config import Config
+
+
+Config.register_default('publish-mode', 'sync')
+Config.register_default('publish-keep', 1)
+
+
+def generations_dir(config):
+    """Return the directory holding all generations of the HTML root."""
+    
+    return config.html_dir + p.extsep + 'generations'
+
+
+def current_generation(config):
+    """Return the absolute path of the published generation, or `None`."""
+    
+    if not p.islink(config.html_dir):
+        return None
+    target = os.readlink(config.html_dir)
+    target = p.normpath(p.join(p.dirname(config.html_dir), target))
+    if not p.isdir(target):
+        return None
+    return target
+
+
+def new_generation(config):
+    """Create and return an empty staging directory for a new generation."""
+    
+    directory = generations_dir(config)
+    if not p.isdir(directory):
+        os.makedirs(directory)
+    
+    staging = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d%H%M%S-'),
+                               dir=directory)
+    os.chmod(staging, 0755)
+    return staging
+
+
+def link_or_copy(src, dst):
+    """Hard-link `src` to `dst`, copying it if that isn't possible."""
+    
+    directory = p.dirname(dst)
+    if not p.isdir(directory):
+        os.makedirs(directory)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def publish(config, staging):
+    
+    """
+    Atomically make `staging` the current generation of the HTML root.
+    
+    The HTML root is replaced by a relative symbolic link to the staging
+    directory. If the HTML root is still a plain directory (i.e. the first time
+    the atomic mode is used), it is first moved into the generations directory;
+    only this initial switch-over is not atomic.
+    """
+    
+    log = logging.getLogger('markdoc.publish')
+    html_dir = config.html_dir
+    target = p.relpath(staging, start=p.dirname(html_dir))
+    
+    if p.isdir(html_dir) and not p.islink(html_dir):
+        legacy = p.join(generations_dir(config), 'legacy-%d' % os.getpid())
+        log.info('Moving existing HTML root to %s' % p.basename(legacy))
+        os.rename(html_dir, legacy)
+    
+    temp_link = html_dir + p.extsep + 'new-link'
+    if p.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(target, temp_link)
+    os.rename(temp_link, html_dir)
+    log.debug('%s -> %s' % (p.basename(html_dir), target))
+
+
+def prune_generations(config, keep=None):
+    """Delete all but the current and the `keep` most recent older generations."""
+    
+    log = logging.getLogger('markdoc.publish')
+    if keep is None:
+        keep = config['publish-keep']
+    
+    directory = generations_dir(config)
+    if not p.isdir(directory):
+        return []
+    
+    current = current_generation(config)
+    old = [p.join(directory, name) for name in os.listdir(directory)]
+    old = [gen for gen in old if gen != current and p.isdir(gen)]
+    old.sort(key=lambda gen: os.stat(gen).st_mtime, reverse=True)
+    
+    removed = old[max(0, int(keep)):]
+    for generation in removed:
+        log.debug('rm -Rf %s' % p.basename(generation))
+        shutil.rmtree(generation)
+    return removed
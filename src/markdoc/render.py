@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os.path as p
+import re
+import threading
 
 from markdoc.config import Config
 import markdown
@@ -32,6 +34,106 @@ class RelativeLinksTreeProcessor(markdown.treeprocessors.Treeprocessor):
         return tree
 
 
+class DocumentMetadata(object):
+    
+    """
+    Information about a document, gathered while it is rendered.
+    
+    `title` is the text of a `<!-- title: ... -->` comment in the document,
+    or failing that of its first `<h1>` (or `None` if it has neither).
+    `first_heading` is the text of the first heading of any level, `outline`
+    is a list of `(level, text, id)` triples for every heading (`id` is `None`
+    unless an extension like `headerid` has set one), and `word_count` is the
+    number of words in the document's text.
+    """
+    
+    def __init__(self, title=None, first_heading=None, outline=(), word_count=0):
+        self.title = title
+        self.first_heading = first_heading
+        self.outline = [tuple(heading) for heading in outline]
+        self.word_count = word_count
+    
+    def __repr__(self):
+        return '<DocumentMetadata: %r>' % (self.title,)
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**dict((str(key), value) for key, value in data.iteritems()))
+    
+    def to_dict(self):
+        return {'title': self.title,
+                'first_heading': self.first_heading,
+                'outline': [list(heading) for heading in self.outline],
+                'word_count': self.word_count}
+    
+    def title_for(self, filename):
+        """Return the title, falling back to one made from the filename."""
+        
+        if self.title:
+            return self.title
+        name = p.splitext(p.basename(filename))[0]
+        return re.sub(r'[-_]+', ' ', name).title()
+
+
+class MetadataTreeProcessor(markdown.treeprocessors.Treeprocessor):
+    
+    """
+    A Markdown tree processor to gather `DocumentMetadata`.
+    
+    This should run after every other tree processor, so that it sees the
+    final headings (and their IDs). The result of the last run is left in the
+    `metadata` attribute.
+    """
+    
+    TITLE_COMMENT_RE = re.compile(r'<!-- ?title:(.+)-->', re.IGNORECASE)
+    PLACEHOLDER_RE = re.compile(u'%s[^%s]*%s' % (markdown.STX, markdown.ETX,
+                                                 markdown.ETX))
+    WORD_RE = re.compile(r'\w+', re.UNICODE)
+    HEADING_RE = re.compile(r'^h([1-6])$')
+    
+    def __init__(self, md_instance):
+        self.markdown = md_instance
+        self.metadata = None
+    
+    def text_of(self, element):
+        chunks = []
+        for node in element.getiterator():
+            chunks.append(node.text or '')
+            if node is not element:
+                chunks.append(node.tail or '')
+        return self.PLACEHOLDER_RE.sub('', u''.join(chunks))
+    
+    def run(self, tree):
+        metadata = DocumentMetadata()
+        
+        for html, _ in self.markdown.htmlStash.rawHtmlBlocks:
+            match = self.TITLE_COMMENT_RE.search(html)
+            if match:
+                metadata.title = match.group(1).strip()
+                break
+        
+        words = 0
+        for element in tree.getiterator():
+            if not isinstance(element.tag, basestring):
+                continue # Comments and processing instructions.
+            words += len(self.WORD_RE.findall(self.PLACEHOLDER_RE.sub(
+                '', (element.text or '') + (element.tail or ''))))
+            
+            heading = self.HEADING_RE.match(element.tag)
+            if heading:
+                text = self.text_of(element).strip()
+                metadata.outline.append((int(heading.group(1)), text,
+                                         element.get('id')))
+                if metadata.first_heading is None:
+                    metadata.first_heading = text
+                if metadata.title is None and element.tag == 'h1' and text:
+                    metadata.title = text
+        
+        metadata.word_count = words
+        self.metadata = metadata
+        return tree
+
+
 def make_relative(curr_path, href):
     """Given a current path and a href, return an equivalent relative path."""
     
@@ -65,6 +167,26 @@ def unflatten_extension_configs(config):
     return configs
 
 
+def markdown_signature(config):
+    
+    """
+    Return a string identifying all of the settings which affect rendering.
+    
+    Two configs with the same signature will render the same Markdown document
+    (at the same path) to the same HTML.
+    """
+    
+    import markdoc
+    
+    return repr((
+        markdoc.__version__,
+        markdown.version,
+        list(config['markdown.extensions']),
+        sorted(unflatten_extension_configs(config).items()),
+        config['markdown.safe-mode'],
+        config['markdown.output-format']))
+
+
 def get_markdown_instance(config, curr_path='/', **extra_config):
     """Return a `markdown.Markdown` instance for a given configuration."""
     
@@ -78,7 +200,70 @@ def get_markdown_instance(config, curr_path='/', **extra_config):
     
     md_instance = markdown.Markdown(**mdconfig)
     md_instance.treeprocessors['relative_links'] = RelativeLinksTreeProcessor(curr_path=curr_path)
+    md_instance.treeprocessors['metadata'] = MetadataTreeProcessor(md_instance)
     return md_instance
 
+
+class MarkdownPool(object):
+    
+    """
+    Pre-configured `markdown.Markdown` instances, one per thread.
+    
+    Creating a `markdown.Markdown` instance imports and initializes every
+    configured extension, which can take longer than rendering a small page.
+    A pool creates one instance per thread on first use; after that, each
+    document just `reset()`s it and points its `RelativeLinksTreeProcessor` at
+    the document's path. Pools aren't shared between processes, so every
+    worker in a parallel build has its own.
+    
+    The configuration is read once, when an instance is first created, so a
+    pool should not outlive changes to the `markdown.*` settings.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.local = threading.local()
+    
+    def get(self, curr_path='/'):
+        """Return this thread's instance, ready to render a new document."""
+        
+        md_instance = getattr(self.local, 'instance', None)
+        if md_instance is None:
+            md_instance = self.local.instance = get_markdown_instance(self.config)
+            self.local.patterns = set(md_instance.inlinePatterns.keys())
+            self.local.prefixes = [(extension, extension.unique_prefix)
+                                   for extension in md_instance.registeredExtensions
+                                   if hasattr(extension, 'unique_prefix')]
+        else:
+            md_instance.reset()
+            # Some extensions keep per-document state which `reset()` misses:
+            # `abbr` adds an inline pattern for every abbreviation defined,
+            # and `footnotes` numbers its IDs by the number of resets when
+            # `UNIQUE_IDS` is on. Put both back as a fresh instance has them.
+            for key in md_instance.inlinePatterns.keys():
+                if key not in self.local.patterns:
+                    del md_instance.inlinePatterns[key]
+            for extension, unique_prefix in self.local.prefixes:
+                extension.unique_prefix = unique_prefix
+        
+        md_instance.treeprocessors['relative_links'].curr_path = curr_path
+        return md_instance
+    
+    def convert(self, curr_path, text):
+        """Render a document at the given path to HTML."""
+        
+        return self.get(curr_path).convert(text)
+    
+    def render(self, curr_path, text):
+        """Render a document to an `(html, metadata)` pair."""
+        
+        md_instance = self.get(curr_path)
+        processor = md_instance.treeprocessors['metadata']
+        # Markdown skips processing entirely for a blank document.
+        processor.metadata = None
+        html = md_instance.convert(text)
+        return html, processor.metadata or DocumentMetadata()
+
+
 # Add it as a method to `markdoc.config.Config`.
 Config.markdown = get_markdown_instance
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+A table of every URL path the server can answer, built from the HTML root.
+
+Resolving a request path by probing the filesystem (is it a file? a file with
+an '.html' extension? a directory with an index?) costs several `stat()` calls
+per request. Instead, `MarkdocWSGIApplication` scans the HTML root once, into a
+`RouteTable` which maps each URL path to the file it serves or the path it
+redirects to, so resolving a request is a dictionary lookup. Paths which aren't
+in the table are 404s.
+
+The table also holds the `stat()` of every file, taken as it was scanned, so a
+request needn't touch the disk at all unless the file has to be read. It is
+rebuilt whenever a new build is published, or anything else changes the HTML
+root (see `routes_stamp()`), and replaced as a whole, so every request sees
+either the old table or the new one, never a mixture.
+"""
+
+import os
+import os.path as p
+
+from markdoc.manifest import manifest_filename
+
+
+FILE = 'file'
+REDIRECT = 'redirect'
+
+# Touched by commands which change the HTML root; see `mark_changed()`.
+CHANGED_FILENAME = '.html-changed'
+
+
+def normalize_path(path_info):
+    
+    """
+    Resolve '.' and '..' segments and repeated slashes in a request path.
+    
+    A trailing slash is kept. Returns `None` if the path points above the root.
+        
+        >>> normalize_path('/a//b/./c/../d/')
+        '/a/b/d/'
+        >>> normalize_path('')
+        '/'
+        >>> print normalize_path('/a/../../etc/passwd')
+        None
+    """
+    
+    parts = []
+    for part in path_info.split('/'):
+        if part == '..':
+            if not parts:
+                return None
+            parts.pop()
+        elif part and part != '.':
+            parts.append(part)
+    
+    path = '/' + '/'.join(parts)
+    if parts and path_info.endswith('/'):
+        path += '/'
+    return path
+
+
+class RouteTable(object):
+    
+    """
+    A mapping from normalized URL paths to `(FILE, filename)` or
+    `(REDIRECT, location)` pairs.
+    
+    The routes follow the same rules the server has always used:
+    
+    *   `/a/b` serves the file `a/b`, or failing that `a/b.html`, or
+        failing that redirects to `/a/b/` if `a/b` is a directory.
+    *   `/a/b/` serves `a/b/index.html`, or failing that redirects to `/a/b`
+        if that would serve a file.
+        
+        >>> table = RouteTable({'/a/b.html': (FILE, 'b.html'),
+        ...                     '/a/b': (FILE, 'b.html'),
+        ...                     '/a': (REDIRECT, '/a/')})
+        >>> table.resolve('/a/b')
+        ('file', 'b.html')
+        >>> table.resolve('/a/b/')
+        ('redirect', '/a/b')
+        >>> print table.resolve('/a/')
+        None
+    """
+    
+    def __init__(self, routes=None, stamp=None, stats=None):
+        self.routes = routes or {}
+        # Identifies the build the table was made from; see `routes_stamp()`.
+        self.stamp = stamp
+        # Maps the filename of each file to its `os.stat()` result.
+        self.stats = stats or {}
+        # Anything else the application loads along with the routes.
+        self.metadata = {}
+    
+    def __len__(self):
+        return len(self.routes)
+    
+    @classmethod
+    def scan(cls, root, stamp=None, hidden=()):
+        """Build the table for the HTML root at `root`, except `hidden` files."""
+        
+        files, directories = {}, set()
+        seen = set()
+        if p.isdir(root):
+            for dirpath, subdirs, filenames in os.walk(root, followlinks=True):
+                # Symbolic links are followed, as they always have been, but
+                # mustn't lead round in circles.
+                real_path = p.realpath(dirpath)
+                if real_path in seen:
+                    subdirs[:] = []
+                    continue
+                seen.add(real_path)
+                
+                rel_dir = p.relpath(dirpath, start=root)
+                prefix = ''
+                if rel_dir != p.curdir:
+                    prefix = '/'.join(rel_dir.split(p.sep)) + '/'
+                    directories.add(prefix[:-1])
+                for name in filenames:
+                    if prefix + name in hidden:
+                        continue
+                    try:
+                        files[prefix + name] = os.stat(p.join(dirpath, name))
+                    except OSError:
+                        continue # A broken link, or it's gone already.
+        
+        routes, stats = {}, {}
+        for rel_path, stat in files.iteritems():
+            filename = p.join(root, *rel_path.split('/'))
+            routes['/' + rel_path] = (FILE, filename)
+            stats[filename] = stat
+        for rel_path in files:
+            if rel_path.endswith(p.extsep + 'html'):
+                routes.setdefault('/' + rel_path[:-5], routes['/' + rel_path])
+        for rel_dir in directories:
+            routes.setdefault('/' + rel_dir, (REDIRECT, '/' + rel_dir + '/'))
+        for rel_dir in directories | set(['']):
+            prefix = rel_dir and rel_dir + '/'
+            if prefix + 'index.html' in files:
+                routes['/' + prefix] = routes['/' + prefix + 'index.html']
+        return cls(routes, stamp=stamp, stats=stats)
+    
+    def resolve(self, path):
+        """Return the route for a normalized path, or `None` for a 404."""
+        
+        route = self.routes.get(path)
+        if route is None and len(path) > 1 and path.endswith('/'):
+            # A file requested as though it were a directory.
+            route = self.routes.get(path[:-1])
+            if route is None or route[0] != FILE:
+                return None
+            return (REDIRECT, path[:-1])
+        return route
+
+
+def mark_changed(config):
+    
+    """
+    Record that the HTML root has been changed by something besides a build.
+    
+    Commands like `sync-static` and `build-listing` call this, so that a
+    running server notices their changes (see `routes_stamp()`).
+    """
+    
+    filename = p.join(config.temp_dir, CHANGED_FILENAME)
+    if not p.isdir(config.temp_dir):
+        os.makedirs(config.temp_dir)
+    open(filename, 'a').close()
+    os.utime(filename, None)
+
+
+def routes_stamp(config):
+    
+    """
+    Return a value which changes whenever the HTML root is changed by Markdoc.
+    
+    This is the modification time of the build manifest, which is saved once
+    every build (including those made by `markdoc watch` and `markdoc
+    merge-shards`) has finished, and that of the file touched by
+    `mark_changed()`, along with the target of the HTML root if it's a
+    symbolic link, which changes when a build is published atomically.
+    """
+    
+    stamp = []
+    for filename in (manifest_filename(config),
+                     p.join(config.temp_dir, CHANGED_FILENAME)):
+        try:
+            stamp.append(os.stat(filename).st_mtime)
+        except OSError:
+            stamp.append(None)
+    try:
+        stamp.append(os.readlink(config.html_dir))
+    except OSError:
+        stamp.append(None)
+    return tuple(stamp)
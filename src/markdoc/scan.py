@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast discovery of the documents in a wiki.
+
+`scan_tree()` lists a directory tree much as `os.walk()` would, but it uses
+`scandir()` (from the `os` module on Python 3.5+, or the `scandir` package
+where it's installed), which reports each entry's type without a separate
+`stat()` call.
+
+A `DirectoryCache` can also be passed in. It remembers the listing of every
+directory along with that directory's modification time. Creating, removing or
+renaming an entry changes the modification time of the directory containing
+it, so a directory whose modification time hasn't changed can be reused from
+the cache with a single `stat()`, and need not be listed again.
+"""
+
+import logging
+import os
+import os.path as p
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from markdoc.cache import write_to
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+SCAN_CACHE_FILENAME = 'scan.json'
+SCAN_CACHE_VERSION = 1
+
+# Directories modified this recently (in seconds) aren't cached, since they
+# could change again within the resolution of their modification time.
+RACY_INTERVAL = 2
+
+
+def list_directory(directory):
+    
+    """
+    Return the sorted `(subdirs, files)` names in a directory.
+    
+    Hidden entries (those whose names start with '.') are left out, as are
+    symbolic links to directories, which `os.walk()` doesn't follow.
+    """
+    
+    subdirs, files = [], []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                subdirs.append(entry.name)
+    else:
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            filename = p.join(directory, name)
+            if not p.isdir(filename):
+                files.append(name)
+            elif not p.islink(filename):
+                subdirs.append(name)
+    subdirs.sort()
+    files.sort()
+    return subdirs, files
+
+
+class DirectoryCache(object):
+    
+    """
+    The listings of the directories beneath a root, keyed by modification time.
+    
+    `directories` maps each directory's path (relative to the root, with `''`
+    for the root itself) to a `[mtime, subdirs, files]` list. Entries which
+    were not used by the last scan are dropped when it is saved.
+    """
+    
+    def __init__(self, filename, root, directories=None):
+        self.filename = filename
+        self.root = root
+        self.directories = directories or {}
+        self.seen = {}
+        self.changed = False
+    
+    @classmethod
+    def load(cls, filename, root):
+        try:
+            fp = open(filename)
+        except IOError:
+            return cls(filename, root)
+        try:
+            try:
+                data = json.load(fp)
+            except ValueError:
+                return cls(filename, root)
+        finally:
+            fp.close()
+        
+        # JSON gives back unicode; paths are handled as (UTF-8) bytestrings.
+        cached_root = data.get('root')
+        if isinstance(cached_root, unicode):
+            cached_root = cached_root.encode('utf-8')
+        if data.get('version') != SCAN_CACHE_VERSION or cached_root != root:
+            return cls(filename, root)
+        
+        encode = lambda names: [name.encode('utf-8') for name in names]
+        directories = dict(
+            (rel_dir.encode('utf-8'), [mtime, encode(subdirs), encode(files)])
+            for rel_dir, (mtime, subdirs, files) in data['directories'].iteritems())
+        return cls(filename, root, directories=directories)
+    
+    def listing(self, rel_dir, directory):
+        """Return the `(subdirs, files)` in a directory, from the cache if possible."""
+        
+        mtime = os.stat(directory).st_mtime
+        cached = self.directories.get(rel_dir)
+        if cached is not None and cached[0] == mtime:
+            self.seen[rel_dir] = cached
+            return cached[1], cached[2]
+        
+        subdirs, files = list_directory(directory)
+        if mtime < time.time() - RACY_INTERVAL:
+            self.seen[rel_dir] = [mtime, subdirs, files]
+        self.changed = True
+        return subdirs, files
+    
+    def save(self):
+        if not self.changed and len(self.seen) == len(self.directories):
+            return
+        
+        directory = p.dirname(self.filename)
+        try:
+            if not p.isdir(directory):
+                os.makedirs(directory)
+            write_to(self.filename, json.dumps(
+                {'version': SCAN_CACHE_VERSION, 'root': self.root,
+                 'directories': self.seen}), encoding=None)
+        except (IOError, OSError, UnicodeDecodeError), exc:
+            # Only a cache; the next scan will just list every directory.
+            logging.getLogger('markdoc.scan').warning(
+                'Could not save directory listings: %s' % exc)
+        self.directories, self.seen, self.changed = self.seen, {}, False
+
+
+def scan_tree(root, cache=None):
+    
+    """
+    Walk a directory tree, yielding the relative path of every file within.
+    
+    Hidden files and directories, and symbolic links to directories, are
+    skipped. Paths are yielded in the same order as a top-down
+    `os.walk()` with sorted names would produce: the files in a directory,
+    then the contents of each of its subdirectories in turn. If a
+    `DirectoryCache` is given, it's used to avoid listing unchanged
+    directories (it's up to the caller to `save()` it afterwards).
+    """
+    
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        directory = rel_dir and p.join(root, rel_dir) or root
+        try:
+            if cache is not None:
+                subdirs, files = cache.listing(rel_dir, directory)
+            else:
+                subdirs, files = list_directory(directory)
+        except OSError:
+            continue # It's been removed (or never existed).
+        
+        prefix = rel_dir and rel_dir + p.sep or ''
+        for name in files:
+            yield prefix + name
+        stack.extend(prefix + name for name in reversed(subdirs))
@@ -3,6 +3,7 @@
 from markdoc.config import Config
 
 
+Config.register_default('server.backend', 'cherrypy')
 Config.register_default('server.bind', '127.0.0.1')
 Config.register_default('server.port', 8008)
 Config.register_default('server.num-threads', 10)
@@ -14,26 +15,33 @@ Config.register_default('server.timeout', 10)
 def server_maker(config, **extra_config):
     
     """
-    Return a server-making callable to create a CherryPy WSGI server.
+    Return a server-making callable to create a WSGI server.
     
     The server-making callable should be passed a WSGI application, and it
-    will return an instance of `cherrypy.wsgiserver.CherryPyWSGIServer`.
+    will return an instance of `cherrypy.wsgiserver.CherryPyWSGIServer`, or
+    of `markdoc.asyncserver.AsyncWSGIServer` if `server.backend` is `async`.
     
     You can optionally override any of the hardwired configuration
     parameters by passing in keyword arguments which will be passed along to
-    the `CherryPyWSGIServer` constructor.
+    the server's constructor.
     """
     
-    from cherrypy.wsgiserver import CherryPyWSGIServer
-    
     bind_addr = (config['server.bind'], config['server.port'])
     kwargs = dict(
-        numthreads=config['server.num-threads'],
         server_name=config['server.name'],
         request_queue_size=config['server.request-queue-size'],
         timeout=config['server.timeout'])
+    
+    backend = config['server.backend']
+    if backend == 'async':
+        from markdoc.asyncserver import AsyncWSGIServer as server_class
+    elif backend == 'cherrypy':
+        from cherrypy.wsgiserver import CherryPyWSGIServer as server_class
+        kwargs['numthreads'] = config['server.num-threads']
+    else:
+        raise ValueError('unknown server backend: %r' % (backend,))
     kwargs.update(extra_config)
     
-    return lambda wsgi_app: CherryPyWSGIServer(bind_addr, wsgi_app, **kwargs)
+    return lambda wsgi_app: server_class(bind_addr, wsgi_app, **kwargs)
 
 Config.server_maker = server_maker
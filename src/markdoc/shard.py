@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Splitting a build across machines, and merging the results.
+
+`markdoc build --shard K/N` renders only the documents which hash into the
+`K`th of `N` shards, into a directory of their own beneath the shard directory
+(`.shards/K-of-N/` by default), along with a `shard.json` file describing what
+was rendered. Once every shard has been built (and the shard directories
+gathered onto one machine), `markdoc merge-shards` checks that they fit
+together and publishes them as a single build.
+"""
+
+import hashlib
+import os
+import os.path as p
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import markdoc.exc
+from markdoc.cache import write_to
+from markdoc.manifest import BuildPlan, file_digest
+
+
+SHARD_FILENAME = 'shard.json'
+SHARD_VERSION = 1
+
+
+class ShardError(markdoc.exc.AbortError):
+    """A set of shards can't be merged."""
+    pass
+
+
+def parse_shard(spec):
+    
+    """
+    Parse a `K/N` shard specification into a `(K, N)` tuple.
+        
+        >>> parse_shard('2/4')
+        (2, 4)
+        >>> parse_shard('5/4')
+        Traceback (most recent call last):
+        ...
+        ValueError: invalid shard '5/4' (expected K/N, with 1 <= K <= N)
+    """
+    
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        raise ValueError('invalid shard %r (expected K/N, with 1 <= K <= N)' % spec)
+    return index, count
+
+
+def shard_of(path, count):
+    
+    """
+    Return the (1-based) shard a document belongs to, out of `count`.
+    
+    This depends only on the document's path, so every machine assigns each
+    document to the same shard.
+        
+        >>> shard_of('index.md', 1)
+        1
+        >>> shard_of('a/b.md', 4) == shard_of('a/b.md', 4)
+        True
+    """
+    
+    digest = hashlib.sha1('/'.join(path.split(p.sep))).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+def shard_name(index, count):
+    return '%d-of-%d' % (index, count)
+
+
+class Shard(object):
+    
+    """
+    The documents rendered by one shard of a build.
+    
+    `documents` maps each document path to a dictionary holding the digest of
+    the source it was rendered from, along with the `output`, `title`,
+    `output_size` and `metadata` that would go into the build manifest.
+    """
+    
+    def __init__(self, directory, index, count, signature, documents=None):
+        self.directory = directory
+        self.index = index
+        self.count = count
+        self.signature = signature
+        self.documents = documents or {}
+    
+    @classmethod
+    def load(cls, directory):
+        filename = p.join(directory, SHARD_FILENAME)
+        try:
+            fp = open(filename)
+        except IOError:
+            raise ShardError('%s is not a shard (it has no %s)' % (
+                directory, SHARD_FILENAME))
+        try:
+            try:
+                data = json.load(fp)
+            except ValueError, exc:
+                raise ShardError('%s is corrupt: %s' % (filename, exc))
+        finally:
+            fp.close()
+        
+        if data.get('version') != SHARD_VERSION:
+            raise ShardError('%s was written by an incompatible version of '
+                             'Markdoc' % filename)
+        return cls(directory, data['shard'], data['shards'], data['signature'],
+                   documents=data['documents'])
+    
+    @property
+    def name(self):
+        return shard_name(self.index, self.count)
+    
+    def save(self):
+        write_to(p.join(self.directory, SHARD_FILENAME), json.dumps(
+            {'version': SHARD_VERSION, 'shard': self.index,
+             'shards': self.count, 'signature': self.signature,
+             'documents': self.documents}, sort_keys=True), encoding=None)
+
+
+def find_shards(shard_dir):
+    """Return the directories beneath `shard_dir` which hold shards."""
+    
+    if not p.isdir(shard_dir):
+        return []
+    return [p.join(shard_dir, name) for name in sorted(os.listdir(shard_dir))
+            if p.isfile(p.join(shard_dir, name, SHARD_FILENAME))]
+
+
+def plan_merge(config, documents, shards, signature):
+    
+    """
+    Check that a set of shards make up a whole build, and plan their merge.
+    
+    `documents` are the document paths in the wiki (from `Builder.walk()`).
+    The shards must all have been built with the given build signature, must
+    include every one of the `N` shards exactly once, and must between them
+    have rendered every document; no two shards may have produced the same
+    output, and each document's source must be the same here as it was when
+    its shard was built. A `ShardError` describing every problem found is
+    raised if any of this isn't true.
+    
+    Returns a full `BuildPlan` whose `merged` list holds a `(path, filename,
+    entry)` triple for each document, where `filename` is the rendered output
+    in its shard directory, and `entry` is its entry for the build manifest.
+    """
+    
+    if not shards:
+        raise ShardError('There are no shards to merge')
+    
+    problems = []
+    counts = set(shard.count for shard in shards)
+    if len(counts) > 1:
+        raise ShardError('The shards were split different ways (%s)' % ', '.join(
+            shard.name for shard in shards))
+    count = counts.pop()
+    
+    indices = {}
+    for shard in shards:
+        if shard.signature != signature:
+            problems.append('shard %s was built with different templates or '
+                            'configuration' % shard.name)
+        indices.setdefault(shard.index, []).append(shard)
+    for index in xrange(1, count + 1):
+        if index not in indices:
+            problems.append('shard %s is missing' % shard_name(index, count))
+        elif len(indices[index]) > 1:
+            problems.append('shard %s appears more than once (in %s)' % (
+                shard_name(index, count),
+                ', '.join(shard.directory for shard in indices[index])))
+    
+    sources, outputs = {}, {}
+    for shard in shards:
+        for path, entry in sorted(shard.documents.iteritems()):
+            output = entry['output']
+            if output in outputs:
+                problems.append('%s was produced by both %s and %s' % (
+                    output, outputs[output].directory, shard.directory))
+                continue
+            outputs[output] = shard
+            sources.setdefault(path, (shard, entry))
+    
+    documents = set(documents)
+    for path in sorted(documents - set(sources)):
+        problems.append('%s was not rendered by any shard' % path)
+    for path in sorted(set(sources) - documents):
+        problems.append('%s was rendered by shard %s, but no longer exists' % (
+            path, sources[path][0].name))
+    
+    plan = BuildPlan(full=True)
+    for path in sorted(documents & set(sources)):
+        shard, entry = sources[path]
+        if file_digest(p.join(config.wiki_dir, path)) != entry['digest']:
+            problems.append('%s has changed since shard %s was built' % (
+                path, shard.name))
+            continue
+        plan.merged.append((path, p.join(shard.directory, entry['output']), entry))
+    
+    if problems:
+        raise ShardError('Cannot merge shards:\n    ' + '\n    '.join(problems))
+    return plan
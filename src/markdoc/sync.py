@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+"""
+An in-process replacement for `rsync`, used to populate the HTML root.
+
+The semantics follow those of the `rsync -vaxq --cvs-exclude --ignore-errors
+--include=.htaccess --exclude=.* --exclude=_*` invocations which Markdoc used
+to shell out to: several source trees are merged into one destination, files
+are only transferred if their size or modification time differ, and hidden or
+underscore-prefixed files are skipped (and, when deleting, left alone).
+"""
+
+import fnmatch
+import logging
+import os
+import os.path as p
+import shutil
+import stat as stat_module
+
+import markdoc.exc
+from markdoc.config import Config
+
+
+Config.register_default('sync.link', 'copy')
+
+# The patterns excluded by `rsync --cvs-exclude`. Those ending in '/' only
+# apply to directories.
+CVS_EXCLUDE_PATTERNS = (
+    'RCS', 'SCCS', 'CVS', 'CVS.adm', 'RCSLOG', 'cvslog.*', 'tags', 'TAGS',
+    '.make.state', '.nse_depinfo', '*~', '#*', '.#*', ',*', '_$*', '*$',
+    '*.old', '*.bak', '*.BAK', '*.orig', '*.rej', '.del-*', '*.a', '*.olb',
+    '*.o', '*.obj', '*.so', '*.exe', '*.Z', '*.elc', '*.ln', 'core',
+    '.svn/', '.git/', '.hg/', '.bzr/')
+
+# The precision to which modification times are compared (see `same_mtime()`).
+MTIME_RESOLUTION = 1e-6
+
+# From <linux/fs.h>; clones a file's extents on filesystems which support it.
+FICLONE = 0x40049409
+
+
+class SyncError(markdoc.exc.AbortError):
+    """One or more files could not be synchronized."""
+    pass
+
+
+class SyncStats(object):
+    
+    """Counters describing the work done by a `sync()`."""
+    
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.linked = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self.errors = []
+    
+    def __str__(self):
+        from markdoc.builder import humansize
+        return '%d files (%s) transferred, %d linked, %d unchanged, %d deleted' % (
+            self.files, humansize(self.bytes), self.linked, self.unchanged,
+            self.deleted)
+
+
+def is_excluded(name, is_dir=False, cvs_exclude=True):
+    
+    """
+    Determine whether a file or directory name should be skipped.
+        
+        >>> is_excluded('.htaccess')
+        False
+        >>> is_excluded('.hidden'), is_excluded('_list.html')
+        (True, True)
+        >>> is_excluded('style.css'), is_excluded('style.css~')
+        (False, True)
+        >>> is_excluded('style.css~', cvs_exclude=False)
+        False
+        >>> is_excluded('core'), is_excluded('.git', is_dir=True)
+        (True, True)
+    """
+    
+    if name == '.htaccess':
+        return False
+    if name.startswith('.') or name.startswith('_'):
+        return True
+    if cvs_exclude:
+        for pattern in CVS_EXCLUDE_PATTERNS:
+            if pattern.endswith('/'):
+                if is_dir and name == pattern[:-1]:
+                    return True
+            elif fnmatch.fnmatchcase(name, pattern):
+                return True
+    return False
+
+
+def merge_trees(sources, cvs_exclude=True):
+    
+    """
+    Merge several source directories into a single listing.
+    
+    Returns a `(directories, files)` pair. `directories` is a sorted list of
+    relative directory paths; `files` is a dictionary mapping relative paths to
+    absolute source filenames. As with rsync, when the same path appears in
+    more than one source the first source takes precedence.
+    """
+    
+    directories, files = set(), {}
+    for source in sources:
+        if not p.isdir(source):
+            continue
+        for dirpath, subdirs, filenames in os.walk(source):
+            rel_dir = p.relpath(dirpath, start=source)
+            if rel_dir == p.curdir:
+                rel_dir = ''
+            
+            subdirs[:] = sorted(name for name in subdirs
+                                if not is_excluded(name, True, cvs_exclude))
+            for name in subdirs:
+                # Symlinks to directories are transferred as symlinks.
+                if p.islink(p.join(dirpath, name)):
+                    files.setdefault(p.join(rel_dir, name), p.join(dirpath, name))
+                else:
+                    directories.add(p.join(rel_dir, name))
+            subdirs[:] = [name for name in subdirs
+                          if not p.islink(p.join(dirpath, name))]
+            
+            for name in filenames:
+                if not is_excluded(name, False, cvs_exclude):
+                    files.setdefault(p.join(rel_dir, name), p.join(dirpath, name))
+    
+    # A path can't be both a directory and a file; the directory wins.
+    for rel_path in directories:
+        files.pop(rel_path, None)
+    return sorted(directories), files
+
+
+def select_trees(sources, paths, cvs_exclude=True):
+    
+    """
+    Like `merge_trees()`, but only for the given relative paths.
+    
+    Each path may name a file or a directory (which is included in full) in
+    any of the sources; paths which exist in none of them are ignored. The
+    directories containing the selected paths are included too.
+    """
+    
+    directories, files = set(), {}
+    for rel_path in sorted(set(p.normpath(path) for path in paths)):
+        components = rel_path.split(p.sep)
+        if any(is_excluded(name, True, cvs_exclude) for name in components[:-1]):
+            continue
+        
+        found = False
+        for source in sources:
+            src = p.join(source, rel_path)
+            if p.isdir(src) and not p.islink(src):
+                if is_excluded(components[-1], True, cvs_exclude):
+                    continue
+                sub_dirs, sub_files = merge_trees([src], cvs_exclude=cvs_exclude)
+                directories.add(rel_path)
+                directories.update(p.join(rel_path, d) for d in sub_dirs)
+                for sub_path, filename in sub_files.iteritems():
+                    files.setdefault(p.join(rel_path, sub_path), filename)
+                found = True
+            elif p.lexists(src) and not is_excluded(components[-1], False, cvs_exclude):
+                files.setdefault(rel_path, src)
+                found = True
+        
+        if found:
+            for i in range(1, len(components)):
+                directories.add(p.join(*components[:i]))
+    
+    for rel_path in directories:
+        files.pop(rel_path, None)
+    return sorted(directories), files
+
+
+def same_mtime(mtime, other_mtime):
+    
+    """
+    Determine whether two modification times are the same.
+    
+    `shutil.copystat()` only preserves modification times to the microsecond,
+    so anything closer than that is considered equal; comparing whole seconds
+    would miss a file which was rewritten within the same second.
+        
+        >>> same_mtime(1300000000.1234567, 1300000000.123456)
+        True
+        >>> same_mtime(1300000000.25, 1300000000.75)
+        False
+    """
+    
+    return abs(mtime - other_mtime) < MTIME_RESOLUTION
+
+
+def up_to_date(src_stat, dst_stat):
+    """rsync's 'quick check': same type, same size and same mtime."""
+    
+    if p.samestat(src_stat, dst_stat):
+        return True
+    return (stat_module.S_IFMT(src_stat.st_mode) == stat_module.S_IFMT(dst_stat.st_mode) and
+            src_stat.st_size == dst_stat.st_size and
+            same_mtime(src_stat.st_mtime, dst_stat.st_mtime))
+
+
+class Transferrer(object):
+    
+    """
+    Puts a single file in place, by reflink, hardlink or copy.
+    
+    The `link` mode is one of `'copy'` (the default), `'hardlink'`, `'reflink'`
+    or `'auto'` (try a reflink, then a hardlink, then fall back to copying). A
+    hard link shares its contents with the source, so editing the source in
+    place changes the destination too. Whenever a link fails between two
+    devices, that method isn't tried again for them. Files are always written
+    to a temporary name and renamed into place, so readers of the destination
+    never see a partially-written file.
+    """
+    
+    def __init__(self, link='copy'):
+        if link not in ('auto', 'copy', 'hardlink', 'reflink'):
+            raise ValueError('unknown link mode: %r' % (link,))
+        self.link = link
+        self.failed = set()
+    
+    def methods(self):
+        if self.link == 'auto':
+            return ('reflink', 'hardlink', 'copy')
+        elif self.link == 'copy':
+            return ('copy',)
+        return (self.link, 'copy')
+    
+    def transfer(self, src, dst, src_stat):
+        """Transfer `src` to `dst`, returning the method used."""
+        
+        temp = p.join(p.dirname(dst), '.%s.markdoc-sync' % p.basename(dst))
+        if p.lexists(temp):
+            os.remove(temp)
+        
+        if stat_module.S_ISLNK(src_stat.st_mode):
+            os.symlink(os.readlink(src), temp)
+            os.rename(temp, dst)
+            return 'symlink'
+        
+        devices = (src_stat.st_dev, os.stat(p.dirname(dst)).st_dev)
+        for method in self.methods():
+            if (method, devices) in self.failed:
+                continue
+            try:
+                getattr(self, method)(src, temp)
+            except (IOError, OSError), exc:
+                if p.lexists(temp):
+                    os.remove(temp)
+                if method == 'copy':
+                    raise
+                self.failed.add((method, devices))
+                continue
+            
+            if method != 'hardlink':
+                shutil.copystat(src, temp)
+            os.rename(temp, dst)
+            return method
+    
+    def reflink(self, src, dst):
+        import fcntl
+        src_fp = open(src, 'rb')
+        try:
+            dst_fp = open(dst, 'wb')
+            try:
+                fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+            finally:
+                dst_fp.close()
+        finally:
+            src_fp.close()
+    
+    def hardlink(self, src, dst):
+        os.link(src, dst)
+    
+    def copy(self, src, dst):
+        shutil.copyfile(src, dst)
+
+
+def link_from(candidate, dst, src_stat):
+    """Hard-link `candidate` to `dst` if it is up to date with the source."""
+    
+    if not stat_module.S_ISREG(src_stat.st_mode):
+        return False
+    try:
+        if not up_to_date(src_stat, os.lstat(candidate)):
+            return False
+        temp = p.join(p.dirname(dst), '.%s.markdoc-sync' % p.basename(dst))
+        if p.lexists(temp):
+            os.remove(temp)
+        os.link(candidate, temp)
+        os.rename(temp, dst)
+    except OSError:
+        return False
+    return True
+
+
+def remove(path):
+    if p.isdir(path) and not p.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def prune_empty(destination, rel_dir, sources, log):
+    """Remove empty directories upwards from `rel_dir`, unless in a source."""
+    
+    while rel_dir:
+        directory = p.join(destination, rel_dir)
+        if (any(p.isdir(p.join(source, rel_dir)) for source in sources) or
+            not p.isdir(directory) or os.listdir(directory)):
+            break
+        log.debug('rmdir %s' % rel_dir)
+        os.rmdir(directory)
+        rel_dir = p.dirname(rel_dir)
+
+
+def sync(sources, destination, delete=False, cvs_exclude=True, link='copy',
+         keep=None, link_dest=None, paths=None, force=(), log=None):
+    
+    """
+    Synchronize several source directories into a destination directory.
+    
+    Only files which are missing from the destination, or whose size or
+    modification time differ from the source, are transferred. If `delete` is
+    true, destination files which are in none of the sources are removed;
+    excluded names are never deleted, and nor is any relative path for which
+    the `keep` callable (if given) returns true.
+    
+    As with rsync's `--link-dest`, if `link_dest` is given then any file which
+    is unchanged relative to the same path in that directory will be
+    hard-linked from there instead of being transferred from the source.
+    
+    If `paths` is given, only those relative paths (and everything beneath
+    them) are synchronized, rather than walking the whole of every tree. Any
+    of them which no longer exist in the sources are deleted (if `delete` is
+    true), along with any directories which that leaves empty.
+    
+    Files whose relative paths are in `force` are always transferred, without
+    the quick check; this is for outputs which are known to have just been
+    rewritten (according to the build manifest).
+    
+    Errors with individual files are logged and do not stop the rest of the
+    sync; once it has finished, a `SyncError` is raised if any occurred.
+    Returns a `SyncStats` instance.
+    """
+    
+    if log is None:
+        log = logging.getLogger('markdoc.sync')
+    
+    stats = SyncStats()
+    transferrer = Transferrer(link)
+    force = set(p.normpath(path) for path in force)
+    if paths is None:
+        directories, files = merge_trees(sources, cvs_exclude=cvs_exclude)
+        roots = ['']
+    else:
+        directories, files = select_trees(sources, paths, cvs_exclude=cvs_exclude)
+        roots = sorted(set(p.normpath(path) for path in paths))
+    
+    def error(message, exc):
+        log.error('%s: %s' % (message, exc))
+        stats.errors.append((message, exc))
+    
+    if not p.isdir(destination):
+        os.makedirs(destination)
+    
+    for rel_dir in directories:
+        dst = p.join(destination, rel_dir)
+        try:
+            if p.lexists(dst) and not (p.isdir(dst) and not p.islink(dst)):
+                os.remove(dst)
+            if not p.isdir(dst):
+                os.mkdir(dst)
+        except (IOError, OSError), exc:
+            error('mkdir %s' % rel_dir, exc)
+    
+    for rel_path in sorted(files):
+        src, dst = files[rel_path], p.join(destination, rel_path)
+        try:
+            src_stat = os.lstat(src)
+            try:
+                dst_stat = os.lstat(dst)
+            except OSError:
+                dst_stat = None
+            
+            if dst_stat is not None:
+                if stat_module.S_ISLNK(src_stat.st_mode):
+                    if (stat_module.S_ISLNK(dst_stat.st_mode) and
+                        os.readlink(src) == os.readlink(dst)):
+                        stats.unchanged += 1
+                        continue
+                elif rel_path not in force and up_to_date(src_stat, dst_stat):
+                    stats.unchanged += 1
+                    continue
+                if stat_module.S_ISDIR(dst_stat.st_mode):
+                    shutil.rmtree(dst)
+            
+            if link_dest is not None and link_from(p.join(link_dest, rel_path),
+                                                   dst, src_stat):
+                log.debug('link-dest %s' % rel_path)
+                stats.linked += 1
+                continue
+            
+            method = transferrer.transfer(src, dst, src_stat)
+            log.debug('%s %s' % (method, rel_path))
+            if method in ('hardlink', 'reflink'):
+                stats.linked += 1
+            else:
+                stats.files += 1
+                stats.bytes += src_stat.st_size
+        except (IOError, OSError), exc:
+            error('transfer %s' % rel_path, exc)
+    
+    if delete:
+        wanted = set(directories) | set(files)
+        
+        def delete_path(rel_path, is_dir):
+            if (is_excluded(p.basename(rel_path), is_dir, cvs_exclude) or
+                (keep is not None and keep(rel_path))):
+                return False
+            try:
+                log.debug('deleting %s' % rel_path)
+                remove(p.join(destination, rel_path))
+                stats.deleted += 1
+            except (IOError, OSError), exc:
+                error('delete %s' % rel_path, exc)
+            return True
+        
+        for root in roots:
+            root_dst = p.join(destination, root)
+            if root and root not in wanted:
+                # A targeted path which has disappeared from the sources.
+                if (p.lexists(root_dst) and
+                    delete_path(root, p.isdir(root_dst) and not p.islink(root_dst))):
+                    prune_empty(destination, p.dirname(root), sources, log)
+                continue
+            elif not p.isdir(root_dst) or p.islink(root_dst):
+                continue
+            
+            for dirpath, subdirs, filenames in os.walk(root_dst, topdown=True):
+                rel_dir = p.relpath(dirpath, start=destination)
+                if rel_dir == p.curdir:
+                    rel_dir = ''
+                
+                for name in sorted(subdirs + filenames):
+                    rel_path = p.join(rel_dir, name)
+                    if rel_path not in wanted:
+                        delete_path(rel_path, name in subdirs and
+                                    not p.islink(p.join(dirpath, name)))
+                
+                # Don't descend into excluded or deleted directories.
+                subdirs[:] = [name for name in subdirs
+                              if p.join(rel_dir, name) in wanted]
+    
+    if stats.errors:
+        raise SyncError('%d errors occurred during sync' % len(stats.errors))
+    return stats
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import logging
+import os
 import os.path as p
+import zipfile
 
 import jinja2
 import markdoc
+from markdoc.assets import static_url
 from markdoc.config import Config
 
 
-Config.register_default('use-default-templates', True)
+Config.register_default('templates.auto-reload', True)
+Config.register_default('templates.bytecode-cache', True)
 
+BUNDLE_FILENAME = 'templates.zip'
+# Records which templates a bundle was compiled from; see `bundle_loader()`.
+BUNDLE_STAMP = 'markdoc-stamp.txt'
 
-def build_template_env(config):
-    """Build a Jinja2 template environment for a given config."""
+
+def template_load_path(config):
+    """Return the directories templates are loaded from, in order."""
     
     load_path = []
     
@@ -21,8 +31,33 @@ def build_template_env(config):
     if config['use-default-templates']:
         load_path.append(markdoc.default_template_dir)
     
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(load_path))
+    return load_path
+
+
+def build_template_env(config):
+    
+    """
+    Build a Jinja2 template environment for a given config.
+    
+    Compiled templates are kept in a bytecode cache in the cache directory
+    (unless `templates.bytecode-cache` is false), so each process only has to
+    parse and compile a template the first time it's ever used. With
+    `templates.auto-reload` off, templates are never checked for changes once
+    they've been loaded, and are loaded from the bundle produced by `markdoc
+    compile-templates` if there's an up-to-date one.
+    """
+    
+    loader = jinja2.FileSystemLoader(template_load_path(config))
+    
+    auto_reload = config['templates.auto-reload']
+    if not auto_reload:
+        # The bundle holds every template (see `bundle_loader()`).
+        loader = bundle_loader(config) or loader
+    
+    environment = jinja2.Environment(loader=loader, auto_reload=auto_reload,
+                                     bytecode_cache=bytecode_cache(config))
     environment.globals['config'] = config
+    environment.globals['static_url'] = lambda path: static_url(config, path)
     return environment
 
 
@@ -32,3 +67,106 @@ def template_env(config):
     return config._template_env
 
 Config.template_env = property(template_env)
+
+
+def bytecode_cache(config):
+    """Return the Jinja2 bytecode cache for a config, or `None` if disabled."""
+    
+    if not config['templates.bytecode-cache']:
+        return None
+    
+    directory = p.join(config.cache_dir, 'templates')
+    if not p.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, exc:
+            if not p.isdir(directory):
+                logging.getLogger('markdoc.templates').warning(
+                    'Template bytecode cache disabled: %s' % exc)
+                return None
+    return jinja2.FileSystemBytecodeCache(directory)
+
+
+def templates_stamp(config):
+    """Return a digest of the name, size and modification time of every template."""
+    
+    from markdoc.manifest import template_paths
+    
+    digest = hashlib.sha1()
+    for filename in template_paths(config):
+        stat = os.stat(filename)
+        digest.update('%s %r %d\n' % (filename, stat.st_mtime, stat.st_size))
+    return digest.hexdigest()
+
+
+def bundle_filename(config):
+    return p.join(config.cache_dir, BUNDLE_FILENAME)
+
+
+def compile_bundle(config, filename=None):
+    
+    """
+    Precompile every template into a zipped bundle of Python modules.
+    
+    The bundle is written to `templates.zip` in the cache directory, unless
+    another `filename` is given. Returns the number of templates compiled.
+    """
+    
+    if filename is None:
+        filename = bundle_filename(config)
+    directory = p.dirname(filename)
+    if not p.isdir(directory):
+        os.makedirs(directory)
+    
+    log = logging.getLogger('markdoc.templates')
+    def log_function(message):
+        if message.startswith('Could not compile'):
+            log.warning(message)
+        else:
+            log.debug(message)
+    
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_load_path(config)))
+    temp_filename = filename + '.new'
+    environment.compile_templates(temp_filename, zip='deflated',
+                                  log_function=log_function)
+    
+    archive = zipfile.ZipFile(temp_filename, 'a')
+    try:
+        count = len(archive.namelist())
+        archive.writestr(BUNDLE_STAMP, templates_stamp(config))
+    finally:
+        archive.close()
+    os.rename(temp_filename, filename)
+    return count
+
+
+def bundle_loader(config):
+    
+    """
+    Return a loader for the precompiled template bundle, if it's up to date.
+    
+    The bundle is only used if the templates haven't been modified (or added
+    or removed) since it was compiled; otherwise a warning is logged and `None`
+    is returned, as it is when there's no bundle at all.
+    """
+    
+    filename = bundle_filename(config)
+    if not p.isfile(filename):
+        return None
+    
+    try:
+        archive = zipfile.ZipFile(filename)
+        try:
+            stamp = archive.read(BUNDLE_STAMP)
+        finally:
+            archive.close()
+    except (IOError, KeyError, zipfile.BadZipfile):
+        stamp = None
+    
+    if stamp != templates_stamp(config):
+        logging.getLogger('markdoc.templates').warning(
+            'Ignoring out-of-date template bundle; '
+            'run `markdoc compile-templates` to update it')
+        return None
+    return jinja2.ModuleLoader(filename)
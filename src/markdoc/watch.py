@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+"""
+Watching a wiki for changes, so that it can be rebuilt as it is edited.
+
+Two watchers are provided: one using Linux's `inotify` (through `ctypes`, so no
+extra dependencies are required), and a portable fallback which polls the
+filesystem. Both report the set of absolute paths which have changed; after the
+first change, further changes are collected until none have arrived for the
+`watch.debounce` interval, so that (for example) an editor's save-and-rename
+results in a single rebuild.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path as p
+import select
+import struct
+import time
+
+from markdoc.config import Config
+
+
+Config.register_default('watch.debounce', 0.1)
+Config.register_default('watch.latency', 1.0)
+Config.register_default('watch.poll-interval', 1.0)
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Overflow(Exception):
+    """Raised by a watcher when some changes may have been missed."""
+    pass
+
+
+class PollingWatcher(object):
+    
+    """
+    Detects changes by periodically comparing snapshots of a set of paths.
+    
+    Each snapshot records the modification time and size of every file beneath
+    the watched paths (directories are only reported when they come or go), so
+    each poll costs a walk of those trees; the inotify watcher should be
+    preferred where it's available.
+    """
+    
+    def __init__(self, paths, interval=1.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self.state = self.snapshot()
+    
+    def snapshot(self):
+        state = {}
+        for path in self.paths:
+            for dirpath, subdirs, files in walk(path):
+                for name in subdirs + files:
+                    filename = p.join(dirpath, name)
+                    if name in subdirs:
+                        state[filename] = 'directory'
+                        continue
+                    try:
+                        stat = os.lstat(filename)
+                    except OSError:
+                        continue
+                    state[filename] = (stat.st_mtime, stat.st_size)
+            if p.isfile(path):
+                stat = os.lstat(path)
+                state[path] = (stat.st_mtime, stat.st_size)
+        return state
+    
+    def poll(self, timeout=None):
+        
+        """
+        Return the set of paths changed since the last call.
+        
+        If nothing has changed, this sleeps for up to `timeout` seconds (or
+        indefinitely, if it's `None`) waiting for changes.
+        """
+        
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            state = self.snapshot()
+            changed = set(filename for filename in set(state) | set(self.state)
+                          if state.get(filename) != self.state.get(filename))
+            self.state = state
+            if changed:
+                return changed
+            
+            if deadline is not False:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return changed
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+    
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    
+    """
+    Detects changes using Linux's inotify API.
+    
+    inotify watches are not recursive, so every directory beneath the watched
+    paths gets its own watch, and new directories are watched as they appear.
+    Files are watched through the directories containing them (see
+    `add_file()`). If the kernel's event queue overflows, `poll()` raises
+    `Overflow`.
+    """
+    
+    def __init__(self, paths):
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        self.watches = {}
+        # The names of interest in directories watched only for some files.
+        self.file_names = {}
+        for path in paths:
+            if p.isdir(path):
+                self.add_tree(path)
+            elif p.exists(path):
+                self.add_file(path)
+    
+    def add_watch(self, path, names=None):
+        
+        """
+        Watch a single directory, returning the watch descriptor.
+        
+        If `names` is given, only changes to the files with those names in the
+        directory are reported (unless the whole directory is watched too).
+        """
+        
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return None # It's gone again already.
+            raise OSError(code, 'inotify_add_watch(%r) failed' % path)
+        
+        if names is None:
+            self.file_names.pop(wd, None)
+        elif wd not in self.watches or wd in self.file_names:
+            self.file_names.setdefault(wd, set()).update(names)
+        self.watches[wd] = path
+        return wd
+    
+    def add_file(self, path):
+        
+        """
+        Watch a single file, through the directory containing it.
+        
+        A watch on the file itself would be dropped as soon as the file was
+        replaced by a rename (which is how most editors save files), and any
+        later changes would go unnoticed.
+        """
+        
+        directory, name = p.split(path)
+        self.add_watch(directory, names=[name])
+    
+    def add_tree(self, path):
+        """Watch a directory and all of its subdirectories."""
+        
+        added = []
+        for dirpath, subdirs, files in walk(path):
+            self.add_watch(dirpath)
+            added.append(dirpath)
+            added.extend(p.join(dirpath, name) for name in files)
+        return added
+    
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+    
+    def poll(self, timeout=None):
+        
+        """
+        Return the set of paths changed since the last call.
+        
+        If nothing has changed, this waits for up to `timeout` seconds (or
+        indefinitely, if it's `None`) for changes.
+        """
+        
+        changed = set()
+        while True:
+            try:
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+            except select.error, exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                return changed
+            
+            for wd, mask, name in self.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    raise Overflow('inotify event queue overflowed')
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    self.file_names.pop(wd, None)
+                    continue
+                
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                names = self.file_names.get(wd)
+                if names is not None:
+                    if name in names:
+                        changed.add(p.join(directory, name))
+                    continue
+                if name:
+                    path = p.join(directory, name)
+                elif p.isdir(directory) and not mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    continue # Only a directory's own attributes changed.
+                else:
+                    path = directory
+                changed.add(path)
+                
+                if (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)):
+                    # Anything created before the watch was added would
+                    # otherwise go unnoticed.
+                    changed.update(self.add_tree(path))
+            if changed:
+                return changed
+    
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def load_libc():
+    """Load the C library, checking that it supports inotify."""
+    
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not supported')
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+def walk(path):
+    """Walk a directory tree, skipping hidden directories."""
+    
+    for dirpath, subdirs, files in os.walk(path):
+        subdirs[:] = sorted(name for name in subdirs if not name.startswith('.'))
+        yield dirpath, subdirs, files
+
+
+def make_watcher(paths, poll=False, interval=1.0):
+    
+    """
+    Return the best available watcher for the given paths.
+    
+    This is an `InotifyWatcher` where possible, and otherwise (or if `poll` is
+    true) a `PollingWatcher` with the given polling interval.
+    """
+    
+    log = logging.getLogger('markdoc.watch')
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError), exc:
+            log.debug('inotify unavailable (%s); polling instead' % exc)
+    return PollingWatcher(paths, interval=interval)
+
+
+def wait_for_changes(watcher, debounce=0.1):
+    
+    """
+    Block until something changes, then return the set of changed paths.
+    
+    Once a change has been seen, changes continue to be collected until none
+    have arrived for `debounce` seconds.
+    """
+    
+    changed = set(watcher.poll())
+    while True:
+        more = watcher.poll(timeout=debounce)
+        if not more:
+            return changed
+        changed.update(more)
@@ -1,13 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import calendar
+import email.utils
+import fnmatch
 import logging
 import mimetypes
+import os
 import os.path as p
+import re
+import threading
+import time
+import uuid
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import webob
 
+from markdoc.assets import ASSETS_FILENAME, load_json, url_path
+from markdoc.cache import MemoryCache, parse_size, write_to
+from markdoc.compress import (ENCODINGS, STAMPS_FILENAME, load_stamps,
+    variant_stamp)
+from markdoc.config import Config
 from markdoc.render import make_relative
+from markdoc.routes import FILE, RouteTable, normalize_path, routes_stamp
+import markdoc.templates # Provides `Config.template_env`.
+
+
+# Fingerprinted static media never change, so can be cached indefinitely.
+Config.register_default('server.cache-policies', [
+    {'fingerprinted': True,
+     'cache-control': 'public, max-age=31536000, immutable'}])
+Config.register_default('server.chunk-size', '256K')
+Config.register_default('server.route-check-interval', 1)
+Config.register_default('server.response-cache.max-size', '32M')
+Config.register_default('server.response-cache.max-file-size', '256K')
+Config.register_default('server.response-cache.preload', 'none')
 
+# Where the number of requests for each file is kept between runs of the
+# server, in the cache directory (see `MarkdocWSGIApplication.preload()`).
+HITS_FILENAME = 'server-hits.json'
 
 if not mimetypes.inited:
     mimetypes.init()
@@ -42,11 +76,39 @@ class MarkdocWSGIApplication(object):
     In the context of Markdoc, if a directory does not contain an 'index.md'
     file, a listing will be generated and saved as the 'index.html' file for
     that directory.
+    
+    Rather than checking the filesystem on every request, these rules are
+    applied to the whole HTML root up front, producing a route table (see
+    `markdoc.routes`) which is rebuilt whenever Markdoc changes the HTML
+    root, and (at most once every `server.route-check-interval` seconds) when
+    a request isn't found in it.
     """
     
     def __init__(self, config):
         self.config = config
         self.log = logging.getLogger('markdoc.wsgi')
+        
+        self.cache = None
+        max_size = parse_size(config['server.response-cache.max-size'])
+        if max_size > 0:
+            self.cache = MemoryCache(max_size)
+        self.max_file_size = parse_size(config['server.response-cache.max-file-size'])
+        self.chunk_size = parse_size(config['server.chunk-size'])
+        # The number of times each file has been served, if it's needed for
+        # preloading the next time round. Updates from concurrent requests
+        # may occasionally be lost, which is fine for this purpose.
+        self.hits = None
+        if str(config['server.response-cache.preload']).lower() == 'popular':
+            self.hits = {}
+        
+        self.route_check_interval = float(config['server.route-check-interval'])
+        self.routes_lock = threading.Lock()
+        self.routes = RouteTable()
+        # Set when a file turns out to have changed since it was scanned.
+        self.routes_stale = False
+        self.routes_scanned = 0
+        self.refresh_routes()
+        self.routes_checked = time.time()
     
     def __call__(self, environ, start_response):
         request = webob.Request(environ)
@@ -60,63 +122,355 @@ class MarkdocWSGIApplication(object):
         return p.pardir not in p.relpath(directory, start=self.config.html_dir).split(p.sep)
     
     def get_response(self, request):
-        if request.path_info.endswith('/'):
-            return self.directory(request)
-        return self.file(request)
+        path = normalize_path(request.path_info)
+        if path is None:
+            return self.forbidden(request)
+        
+        routes = self.route_table()
+        route = routes.resolve(path)
+        if route is None and time.time() - self.routes_scanned >= self.route_check_interval:
+            # The file may have been added since the table was built, by
+            # `markdoc sync-static` or by hand, so look again (but not too
+            # often, since every request for a missing page would).
+            routes = self.refresh_routes()
+            route = routes.resolve(path)
+        
+        if route is not None and route[0] == FILE:
+            try:
+                return self.serve(request, route[1], routes)
+            except (IOError, OSError):
+                # The file has gone since the table was built, so the HTML
+                # root has changed under us; look again in an up-to-date one.
+                routes = self.refresh_routes(wait=True)
+                route = routes.resolve(path)
+                if route is not None and route[0] == FILE:
+                    try:
+                        return self.serve(request, route[1], routes)
+                    except (IOError, OSError):
+                        route = None
+        
+        if route is None:
+            return self.not_found(request)
+        return temp_redirect(route[1])
     
-    def directory(self, request):
+    def route_table(self):
         
         """
-        Serve a request which points to a directory.
+        Return the current `RouteTable`, rebuilding it if there's been a build.
         
-        * If the directory exists, look for an 'index.html' file inside it, and
-          serve it if it exists; else
-        * If a file of the same name exists in the parent directory, return a
-          redirect to it (without the trailing slash); else
-        * If a file of the same name with a 'html' extension exists in the
-          parent directory, redirect to it (without the trailing slash); else
-        * Return a HTTP 404 ‘Not Found’.
+        Builds are only looked for once every `server.route-check-interval`
+        seconds, so most requests are resolved without touching the disk.
         """
         
-        path_parts = request.path_info.strip('/').split('/')
-        index_filename = p.join(self.config.html_dir, *(path_parts + ['index.html']))
-        if p.exists(index_filename) and self.is_safe(index_filename):
-            return serve_file(index_filename)
+        now = time.time()
+        if self.routes_stale or now - self.routes_checked >= self.route_check_interval:
+            self.routes_checked = now
+            if self.routes_stale or routes_stamp(self.config) != self.routes.stamp:
+                self.refresh_routes()
+        return self.routes
+    
+    def refresh_routes(self, wait=False):
         
-        directory_filename = p.join(self.config.html_dir, *path_parts)
-        if p.isfile(directory_filename) or p.isfile(directory_filename + p.extsep + 'html'):
-            return temp_redirect(request.path_info.rstrip('/'))
+        """
+        Rescan the HTML root, swap the new route table in, and return it.
         
-        return self.not_found(request)
+        If another thread is already rescanning, this carries on with the old
+        table, or with `wait`, waits for the new one. If the scan fails, the
+        old table is kept, and used until the next time round.
+        """
+        
+        routes = self.routes
+        if not self.routes_lock.acquire(wait):
+            return self.routes
+        try:
+            if self.routes is not routes:
+                return self.routes # Another thread has just rescanned.
+            
+            start = time.time()
+            self.routes_scanned, self.routes_stale = start, False
+            try:
+                stamp = routes_stamp(self.config)
+                routes = RouteTable.scan(self.config.html_dir, stamp=stamp,
+                                         hidden=[STAMPS_FILENAME])
+                routes.metadata['variants'] = load_stamps(self.config.html_dir)
+                routes.metadata['fingerprinted'] = frozenset(load_json(
+                    p.join(self.config.html_dir, ASSETS_FILENAME)).itervalues())
+            except Exception:
+                self.log.exception('Could not scan the HTML root; using the old routes')
+                return self.routes
+            self.routes = routes
+            self.log.debug('Found %d routes in %.3fs' % (
+                len(routes), time.time() - start))
+            return routes
+        finally:
+            self.routes_lock.release()
     
-    def file(self, request):
+    def serve(self, request, filename, routes):
         
         """
-        Serve a request which points to a file.
+        Serve a file, or a precompressed variant of it if the client accepts it.
         
-        * If the file exists relative to the docroot, serve it; else
-        * If the filename with the extension 'html' exists relative to the
-          docroot, serve it; else
-        * If a directory exists with that name, return a redirect to it (with a
-          trailing slash); else
-        * Return a HTTP 404 ‘Not Found’.
+        Variants are produced by `markdoc build` (see `markdoc.compress`). The
+        one with the best quality in the request's `Accept-Encoding` is sent
+        (Brotli is preferred on a tie), unless it was made from an earlier
+        version of the original (by size and modification time).
+        Responses for files which have variants always carry a `Vary:
+        Accept-Encoding` header, so that caches don't mix them up. Requests for
+        byte ranges are always given ranges of the original, since a
+        `multipart/byteranges` response can't be content-encoded as a whole.
+        
+        Which variants there are, and the size and modification time of every
+        file, are taken from the route table `routes`, not the disk.
         """
         
-        path_parts = request.path_info.strip('/').split('/')
-        filename = p.abspath(p.join(self.config.html_dir, *path_parts))
-        if not self.is_safe(filename):
-            return self.forbidden(request)
+        cache_control = self.cache_control(filename, routes)
+        stat = routes.stats[filename]
+        if p.splitext(filename)[1] not in self.config['compress.extensions']:
+            self.count_hit(filename)
+            response = self.file_response(request, filename, stat=stat)
+            if cache_control:
+                response.headers['Cache-Control'] = cache_control
+            return response
+        
+        content_type = guess_type(filename)
+        
+        chosen, chosen_encoding, best_quality, vary = filename, None, 0, False
+        rel_path = p.relpath(filename, start=self.config.html_dir)
+        stamps, stamp = routes.metadata.get('variants', {}), variant_stamp(stat)
+        for encoding, suffix in ENCODINGS:
+            if filename + suffix not in routes.stats or rel_path + suffix not in stamps:
+                continue
+            if stamps[rel_path + suffix] != stamp:
+                continue # Stale; the original has changed since.
+            
+            vary = True
+            if 'HTTP_RANGE' in request.environ:
+                continue
+            quality = request.accept_encoding.quality(encoding) or 0
+            if quality > best_quality:
+                chosen, chosen_encoding, best_quality = filename + suffix, encoding, quality
+        
+        self.count_hit(chosen)
+        response = self.file_response(request, chosen, content_type=content_type,
+                                      stat=routes.stats[chosen])
+        if chosen_encoding is not None:
+            response.content_encoding = chosen_encoding
+        if vary:
+            response.vary = ('Accept-Encoding',)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return response
+    
+    def file_response(self, request, filename, content_type=None, stat=None):
+        
+        """
+        Return a response for a file, from the response cache if possible.
+        
+        Every response carries a strong `ETag` and a `Last-Modified` header,
+        and conditional requests for a file which hasn't changed are answered
+        with a '304 Not Modified' (see `not_modified()`). `HEAD` requests are
+        answered from the file's metadata alone, without opening it. `GET`
+        requests with a `Range` header get only the bytes they ask for (see
+        `range_response()`), unless an `If-Range` condition fails.
+        
+        `HEAD` requests, and responses from the response cache, are decided
+        from `stat`, the file's entry in the route table, which is only
+        `stat()`ed afresh if it isn't given. Any other request opens the file
+        first, and goes by the `fstat()` of what it will actually send.
+        
+        Files no bigger than `server.response-cache.max-file-size` are read
+        whole and kept in memory, along with their content type, until the
+        route table gives them a different size or modification time, or they
+        are evicted to make room for others. If a file turns out to have
+        changed since the table was built, it's served as it is now, and the
+        table is rebuilt. Larger files, and all files when the cache is
+        disabled, are streamed from disk: through the server's
+        `wsgi.file_wrapper` if it has one, or otherwise in chunks of
+        `server.chunk-size` bytes.
+        """
+        
+        if stat is None:
+            stat = os.stat(filename)
+        
+        body = fp = None
+        if request.method != 'HEAD':
+            if self.cache is not None and stat.st_size <= self.max_file_size:
+                validator = (stat.st_mtime, stat.st_size)
+                entry = (self.cache.get(filename, validator) or
+                         self.load(filename, validator, content_type=content_type))
+                if entry is None:
+                    # It's changed since the route table was built.
+                    self.routes_stale = True
+                    return self.file_response(request, filename, content_type=content_type)
+                body, content_type = entry
+            else:
+                fp = open(filename, 'rb')
+                fresh = os.fstat(fp.fileno())
+                if (fresh.st_mtime, fresh.st_size) != (stat.st_mtime, stat.st_size):
+                    # It's changed since the route table was built.
+                    self.routes_stale = True
+                    stat = fresh
         
-        if p.isfile(filename):
-            pass
-        elif p.isfile(filename + p.extsep + 'html'):
-            filename = filename + p.extsep + 'html'
+        etag = file_etag(stat)
+        if not_modified(request, etag, stat.st_mtime):
+            if fp is not None:
+                fp.close()
+            response = webob.Response(status=304)
+            del response.content_type
+            del response.content_length
+        elif request.method == 'HEAD':
+            response = webob.Response(content_type=content_type or guess_type(filename))
+            response.content_length = stat.st_size
         else:
-            if p.isdir(filename):
-                return temp_redirect(request.path_info + '/')
-            return self.not_found(request)
+            ranges = None
+            if (request.method == 'GET' and 'HTTP_RANGE' in request.environ and
+                if_range_matches(request, etag, stat.st_mtime)):
+                ranges = parse_ranges(request.environ['HTTP_RANGE'], stat.st_size)
+            
+            if ranges is not None:
+                response = range_response(filename, stat.st_size,
+                                          content_type or guess_type(filename),
+                                          ranges, body=body, fp=fp,
+                                          chunk_size=self.chunk_size)
+            elif body is None:
+                response = serve_file(filename, content_type=content_type,
+                                      chunk_size=self.chunk_size,
+                                      file_wrapper=request.environ.get('wsgi.file_wrapper'),
+                                      fp=fp)
+            else:
+                response = webob.Response(content_type=content_type)
+                response.body = body
+        
+        response.etag = etag
+        response.last_modified = int(stat.st_mtime)
+        response.accept_ranges = 'bytes'
+        return response
+    
+    def load(self, filename, validator, content_type=None):
+        
+        """
+        Read a file into the response cache, returning its entry.
+        
+        Returns `None` instead if the file's `(mtime, size)` no longer match
+        `validator`.
+        """
+        
+        fp = open(filename, 'rb')
+        try:
+            stat = os.fstat(fp.fileno())
+            if (stat.st_mtime, stat.st_size) != validator:
+                return None
+            body = fp.read()
+        finally:
+            fp.close()
+        
+        entry = (body, content_type or guess_type(filename))
+        self.cache.set(filename, validator, entry, len(body))
+        return entry
+    
+    def preload(self):
         
-        return serve_file(filename)
+        """
+        Fill the response cache, as directed by `server.response-cache.preload`.
+        
+        With `all`, every file in the HTML root small enough to be cached is
+        loaded, smallest first, until the cache is full. With `popular`, the
+        files which were requested most often by previous runs of the server
+        (as recorded by `save_hits()`) are loaded first. Returns the number of
+        files loaded.
+        """
+        
+        mode = str(self.config['server.response-cache.preload']).lower()
+        if self.cache is None or mode not in ('all', 'popular'):
+            return 0
+        
+        root = self.config.html_dir
+        if mode == 'popular':
+            counts = load_json(p.join(self.config.cache_dir, HITS_FILENAME))
+            rel_paths = sorted(counts, key=lambda rel_path: (-counts[rel_path], rel_path))
+        else:
+            sizes = []
+            for dirpath, subdirs, files in os.walk(root):
+                subdirs[:] = sorted(name for name in subdirs if not name.startswith('.'))
+                for name in files:
+                    filename = p.join(dirpath, name)
+                    try:
+                        sizes.append((os.stat(filename).st_size,
+                                      p.relpath(filename, start=root)))
+                    except OSError:
+                        continue
+            rel_paths = [rel_path for _, rel_path in sorted(sizes)]
+        
+        loaded = 0
+        for rel_path in rel_paths:
+            filename = p.join(root, *rel_path.split('/'))
+            if not self.is_safe(filename):
+                continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if stat.st_size > self.max_file_size:
+                continue
+            if self.cache.size + stat.st_size > self.cache.max_size:
+                break
+            if self.load(filename, (stat.st_mtime, stat.st_size)) is not None:
+                loaded += 1
+        return loaded
+    
+    def count_hit(self, filename):
+        """Count a request for a file, if `preload()` will need to know."""
+        
+        if self.hits is not None:
+            self.hits[filename] = self.hits.get(filename, 0) + 1
+    
+    def save_hits(self):
+        
+        """
+        Add the number of requests for each file to those from previous runs.
+        
+        The counts are kept in the cache directory, for `preload()`. Does
+        nothing unless `server.response-cache.preload` is `popular`.
+        """
+        
+        if not self.hits:
+            return
+        
+        filename = p.join(self.config.cache_dir, HITS_FILENAME)
+        counts = load_json(filename)
+        for path, hits in self.hits.items():
+            rel_path = '/'.join(p.relpath(path, start=self.config.html_dir).split(p.sep))
+            counts[rel_path] = counts.get(rel_path, 0) + hits
+        
+        try:
+            if not p.isdir(self.config.cache_dir):
+                os.makedirs(self.config.cache_dir)
+            write_to(filename, json.dumps(counts, sort_keys=True), encoding=None)
+        except (IOError, OSError), exc:
+            self.log.warning('Could not save request counts: %s' % exc)
+    
+    def cache_control(self, filename, routes):
+        
+        """
+        Return the `Cache-Control` header for a file, or `None`.
+        
+        The first policy in `server.cache-policies` which matches the file's
+        URL path is used. A policy matches if its `pattern` (a shell-style
+        wildcard) matches the path, and, if it has `fingerprinted: true`, the
+        file is one of the fingerprinted copies listed in `_assets.json` (as
+        loaded into the route table `routes`). A policy with neither key
+        matches everything.
+        """
+        
+        path = url_path(p.relpath(filename, start=self.config.html_dir))
+        for policy in self.config['server.cache-policies']:
+            if 'pattern' in policy and not fnmatch.fnmatchcase(path, policy['pattern']):
+                continue
+            if (policy.get('fingerprinted') and
+                path not in routes.metadata.get('fingerprinted', ())):
+                continue
+            return policy.get('cache-control')
+        return None
     
     def error(self, request, status):
         
@@ -161,8 +515,11 @@ class MarkdocWSGIApplication(object):
             context['reason'] = webob.util.status_reasons[status]
             
             template = self.config.template_env.get_template('%d.html' % status)
-            response.unicode_body = template.render(context)
             response.content_type = mimetypes.types_map['.xhtml']
+            response.charset = 'utf-8'
+            # Stream the page to the client as the template produces it.
+            response.app_iter = encode_chunks(template.generate(context), 'utf-8')
+            del response.content_length
         else:
             del response.content_length
             del response.content_type
@@ -173,6 +530,14 @@ class MarkdocWSGIApplication(object):
     not_found = lambda self, request: self.error(request, 404)
 
 
+def encode_chunks(chunks, encoding):
+    """Encode an iterable of unicode chunks, skipping empty ones."""
+    
+    for chunk in chunks:
+        if chunk:
+            yield chunk.encode(encoding)
+
+
 def redirect(location, permanent=False):
     """Issue an optionally-permanent redirect to another location."""
     
@@ -189,7 +554,222 @@ temp_redirect = lambda location: redirect(location, permanent=False)
 perm_redirect = lambda location: redirect(location, permanent=True)
 
 
-def serve_file(filename, content_type=None, chunk_size=4096):
+def file_etag(stat):
+    
+    """
+    Return a strong entity tag for a file, from the result of `os.stat()`.
+    
+    The tag is made from the file's size and modification time (to the
+    millisecond), so it changes whenever the file is rebuilt with different
+    contents. Precompressed variants have tags of their own, as they must.
+    """
+    
+    return '%x-%x' % (stat.st_size, int(stat.st_mtime * 1000))
+
+
+def not_modified(request, etag, mtime):
+    
+    """
+    Check whether a request can be answered with '304 Not Modified'.
+    
+    Only `GET` and `HEAD` requests are conditional in this way. If the request
+    has an `If-None-Match` header, it must list the current entity tag (or be
+    `*`); `If-Modified-Since` is only considered when there isn't one, as RFC
+    7232 requires.
+    """
+    
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if 'HTTP_IF_NONE_MATCH' in request.environ:
+        return etag in request.if_none_match
+    since = request.if_modified_since
+    if since is None:
+        return False
+    return int(mtime) <= calendar.timegm(since.utctimetuple())
+
+
+def if_range_matches(request, etag, mtime):
+    
+    """
+    Check a request's `If-Range` condition (which is met if there is none).
+    
+    The condition may be an entity tag, which must match the current one
+    exactly (weak tags never match), or a date, which must be the file's
+    modification time.
+    """
+    
+    header = request.environ.get('HTTP_IF_RANGE', '').strip()
+    if not header:
+        return True
+    if header.startswith('"') or header.upper().startswith('W/'):
+        return header == '"%s"' % etag
+    date = email.utils.parsedate_tz(header)
+    return date is not None and email.utils.mktime_tz(date) == int(mtime)
+
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_ranges(header, length):
+    
+    """
+    Parse a `Range` header into a list of `(start, stop)` byte offsets.
+    
+    `stop` is exclusive, and both are clipped to a file of `length` bytes.
+    Ranges which start beyond the end of the file are dropped, so an empty list
+    means that none of them can be satisfied. Overlapping ranges are merged.
+    `None` is returned for a header which is malformed or not in bytes, and
+    should therefore be ignored.
+    
+        >>> parse_ranges('bytes=0-9', 100)
+        [(0, 10)]
+        >>> parse_ranges('bytes=90-, -5', 100)
+        [(90, 100)]
+        >>> parse_ranges('bytes=50-59,0-9,200-', 100)
+        [(50, 60), (0, 10)]
+        >>> parse_ranges('bytes=100-', 100)
+        []
+        >>> print parse_ranges('bytes=9-3', 100)
+        None
+        >>> print parse_ranges('lines=1-2', 100)
+        None
+    """
+    
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    
+    ranges, valid = [], False
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        valid = True
+        
+        if not first:
+            # A suffix: the last N bytes.
+            start, stop = max(length - int(last), 0), length
+        else:
+            start, stop = int(first), length
+            if last:
+                if int(last) < start:
+                    return None
+                stop = min(int(last) + 1, length)
+        if start < stop:
+            ranges.append((start, stop))
+    
+    if not valid:
+        return None
+    
+    ordered = sorted(ranges)
+    if any(ordered[i][1] > ordered[i + 1][0] for i in xrange(len(ordered) - 1)):
+        # Merge overlapping ranges, so no byte is sent more than once.
+        ranges = ordered[:1]
+        for start, stop in ordered[1:]:
+            if start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(stop, ranges[-1][1]))
+            else:
+                ranges.append((start, stop))
+    return ranges
+
+
+def range_response(filename, length, content_type, ranges, body=None,
+                   chunk_size=4096, fp=None):
+    
+    """
+    Return a response with some byte ranges of a file (see `parse_ranges()`).
+    
+    A single range is sent as '206 Partial Content' with a `Content-Range`
+    header, and several as a `multipart/byteranges` document. Only the
+    requested bytes are read from the file (or from `fp`, if it's already
+    open, which is closed once they've been sent), or sliced from its `body`
+    if it's already in memory. With no ranges, the response is '416 Requested
+    Range Not Satisfiable'.
+    """
+    
+    response = webob.Response()
+    if not ranges:
+        if fp is not None:
+            fp.close()
+        response.status = 416
+        response.headers['Content-Range'] = 'bytes */%d' % length
+        del response.content_type
+        return response
+    
+    if body is None and fp is None:
+        fp = open(filename, 'rb')
+    
+    def read_range(start, stop):
+        if body is not None:
+            yield body[start:stop]
+            return
+        fp.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = fp.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    
+    def closing(chunks):
+        try:
+            for data in chunks:
+                yield data
+        finally:
+            if fp is not None:
+                fp.close()
+    
+    response.status = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.content_type = content_type
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+        response.app_iter = closing(read_range(start, stop))
+        response.content_length = stop - start
+        return response
+    
+    boundary = uuid.uuid4().hex
+    parts = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                  boundary, content_type, start, stop - 1, length), start, stop)
+             for start, stop in ranges]
+    trailer = '\r\n--%s--\r\n' % boundary
+    
+    def read_parts():
+        for header, start, stop in parts:
+            yield header
+            for data in read_range(start, stop):
+                yield data
+        yield trailer
+    
+    response.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    response.app_iter = closing(read_parts())
+    response.content_length = (sum(len(header) + stop - start
+                                   for header, start, stop in parts) +
+                               len(trailer))
+    return response
+
+
+def guess_type(filename):
+    
+    """
+    Guess the content type of a file from its name.
+    
+    HTML is always served as XHTML, and anything unrecognized as
+    'application/octet-stream'.
+    """
+    
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if content_type.startswith('text/html'):
+        content_type = content_type.replace('text/html', 'application/xhtml+xml')
+    return content_type
+
+
+def serve_file(filename, content_type=None, chunk_size=4096, file_wrapper=None,
+               fp=None):
     
     """
     Serve the specified file as a chunked response.
@@ -197,21 +777,37 @@ def serve_file(filename, content_type=None, chunk_size=4096):
     Return a `webob.Response` instance which will serve up the file in chunks,
     as specified by the `chunk_size` parameter (default 4KB).
     
+    If the WSGI server's `wsgi.file_wrapper` is given as `file_wrapper`, the
+    open file is handed to it instead, so that a server which supports it can
+    send the file with `sendfile()`, without it passing through Python at all.
+    
     You can also specify a content type with the `content_type` keyword
     argument. If you do not, the content type will be inferred from the
     filename; so 'index.html' will be interpreted as 'application/xhtml+xml',
     'file.mp3' as 'audio/mpeg', et cetera. If none can be guessed, the content
     type will be reported as 'application/octet-stream'.
+    
+    If the file is already open, pass it as `fp`; its size is always taken
+    from the open file, so that it matches the bytes sent.
     """
     
     if content_type is None:
-        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-    
-    if content_type.startswith('text/html'):
+        content_type = guess_type(filename)
+    elif content_type.startswith('text/html'):
         content_type = content_type.replace('text/html', 'application/xhtml+xml')
     
-    def chunked_read(chunk_size=4096):
+    # Opened up front, so that a missing file is an error here rather than
+    # half-way through the response.
+    if fp is None:
         fp = open(filename, 'rb')
+    
+    if file_wrapper is not None:
+        response = webob.Response(content_type=content_type)
+        response.app_iter = file_wrapper(fp, chunk_size)
+        response.content_length = os.fstat(fp.fileno()).st_size
+        return response
+    
+    def chunked_read():
         try:
             data = fp.read(chunk_size)
             while data:
@@ -222,5 +818,5 @@ def serve_file(filename, content_type=None, chunk_size=4096):
     
     response = webob.Response(content_type=content_type)
     response.app_iter = chunked_read()
-    response.content_length = p.getsize(filename)
+    response.content_length = os.fstat(fp.fileno()).st_size
     return response
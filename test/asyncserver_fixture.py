@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from markdoc.asyncserver import AsyncWSGIServer
+
+
+def echo_app(environ, start_response):
+    
+    """
+    A WSGI application to serve over loopback.
+    
+    `/stream` responds with a body of unknown length; anything else responds
+    with the request body (or, failing that, the path).
+    """
+    
+    if environ['PATH_INFO'] == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return iter(['one', '', ' two', ' three'])
+    
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length) or environ['PATH_INFO']
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def setup_test(test):
+    server = AsyncWSGIServer(('127.0.0.1', 0), echo_app, timeout=5)
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    test.globs['SERVER'] = server
+    test.globs['SERVER_THREAD'] = thread
+
+
+def teardown_test(test):
+    test.globs['SERVER'].stop()
+    test.globs['SERVER_THREAD'].join(5)
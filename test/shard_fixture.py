@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+from builder_fixture import setup_test, teardown_test
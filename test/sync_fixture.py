@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+
+
+def setup_test(test):
+    test.globs['SYNC_ROOT'] = tempfile.mkdtemp()
+
+
+def teardown_test(test):
+    shutil.rmtree(test.globs['SYNC_ROOT'])